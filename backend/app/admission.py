@@ -0,0 +1,192 @@
+"""Admission control and load shedding for model-backed routes.
+
+Each limited endpoint has a gate on the event loop: at most `concurrency`
+requests run, up to `queue` more wait in FIFO order for at most
+`deadline` seconds, and anything beyond that is shed. Admission happens
+before a worker thread is taken, so a burst of /ranking or /timeseries
+requests can occupy only the gates' total concurrency of the shared
+threadpool, and the cheap /live/* routes keep their threads.
+
+A shed request is answered with the endpoint's last result for the same
+parameters and model version (AdmissionController.version), marked with
+X-AquaGuard-Stale and Age headers, and with 503 and Retry-After only if
+there is none. AQUAGUARD_ADMISSION=0 disables the gates.
+"""
+import asyncio
+import functools
+import math
+import os
+import time
+from collections import OrderedDict, deque
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+from app.metrics import count, registry, timer
+from app.profiling import run_profiled
+
+ADMISSION_ENV = "AQUAGUARD_ADMISSION"
+
+admission_requests = registry.counter(
+    "aquaguard_admission_requests_total",
+    "Model-backed requests by admission outcome (admitted, queued, stale, shed)",
+    ("endpoint", "outcome"),
+)
+admission_wait = registry.histogram(
+    "aquaguard_admission_wait_seconds",
+    "Time requests waited in the admission queue (admitted or timed out)",
+    ("endpoint",),
+)
+
+
+class Gate:
+    def __init__(self, name: str, concurrency: int, queue: int, deadline: float,
+                 stale_entries: int = 256):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.deadline = deadline
+        self.stale_entries = stale_entries
+        self.active = 0
+        self.shed = 0
+        self.stale_served = 0
+        self._waiters = deque()
+        self._last_results = OrderedDict()
+
+    @property
+    def depth(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        """Take a slot, waiting up to the deadline; False if the request should be shed"""
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            count(admission_requests, self.name, "admitted")
+            return True
+        if len(self._waiters) >= self.queue:
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        count(admission_requests, self.name, "queued")
+        try:
+            with timer(admission_wait, self.name):
+                await asyncio.wait_for(waiter, self.deadline)
+            return True
+        except asyncio.TimeoutError:
+            # The slot may have been handed over just as the deadline passed
+            return waiter.done() and not waiter.cancelled()
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # client went away after being handed a slot
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self):
+        """Hand the slot to the oldest live waiter, or free it"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def remember(self, key, result):
+        self._last_results[key] = (result, time.time())
+        self._last_results.move_to_end(key)
+        if len(self._last_results) > self.stale_entries:
+            self._last_results.popitem(last=False)
+
+    def overloaded(self, key):
+        """Stale result for the key if there is one, else 503"""
+        self.shed += 1
+        last = self._last_results.get(key)
+        if last is not None:
+            self.stale_served += 1
+            count(admission_requests, self.name, "stale")
+            result, computed_at = last
+            return JSONResponse(
+                jsonable_encoder(result),
+                headers={"X-AquaGuard-Stale": "true", "Age": str(int(time.time() - computed_at))},
+            )
+        count(admission_requests, self.name, "shed")
+        return JSONResponse(
+            {"detail": f"{self.name} is overloaded, retry later"},
+            status_code=503,
+            headers={"Retry-After": str(max(1, math.ceil(self.deadline)))},
+        )
+
+    def status(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "queue_limit": self.queue,
+            "queue_depth": self.depth,
+            "deadline_seconds": self.deadline,
+            "shed": self.shed,
+            "stale_served": self.stale_served,
+        }
+
+
+class AdmissionController:
+    def __init__(self):
+        self.enabled = os.environ.get(ADMISSION_ENV, "1") != "0"
+        self.gates = {}
+        # Version of the state results are computed from; part of the stale-result
+        # key so a reload, ingest or retrain never serves the previous model's results
+        self.version = lambda: None
+
+    def limit(self, name: str, concurrency: int = 2, queue: int = 16, deadline: float = 2.0):
+        """Decorate a sync endpoint so it runs only once admitted by the endpoint's gate
+
+        Limits can be overridden with AQUAGUARD_ADMISSION_<NAME>=concurrency,queue,deadline.
+        """
+        override = os.environ.get(f"{ADMISSION_ENV}_{name.upper()}")
+        if override:
+            concurrency, queue, deadline = override.split(",")
+            concurrency, queue, deadline = int(concurrency), int(queue), float(deadline)
+        gate = self.gates[name] = Gate(name, concurrency, queue, deadline)
+
+        def decorate(endpoint):
+            if not self.enabled:
+                return endpoint
+
+            @functools.wraps(endpoint)
+            async def admitted(**kwargs):
+                key = (self.version(), tuple(sorted(kwargs.items())))
+                if not await gate.acquire():
+                    return gate.overloaded(key)
+                try:
+                    result = await run_in_threadpool(run_profiled(endpoint), **kwargs)
+                finally:
+                    gate.release()
+                if not isinstance(result, Response):
+                    gate.remember(key, result)
+                return result
+
+            return admitted
+
+        return decorate
+
+    def status(self) -> dict:
+        return {name: gate.status() for name, gate in self.gates.items()}
+
+
+admission = AdmissionController()
+
+registry.gauge(
+    "aquaguard_admission_queue_depth",
+    "Requests waiting for admission, by endpoint",
+    lambda: {(name,): gate.depth for name, gate in admission.gates.items()},
+    ("endpoint",),
+)
+registry.gauge(
+    "aquaguard_admission_active",
+    "Admitted requests currently running, by endpoint",
+    lambda: {(name,): gate.active for name, gate in admission.gates.items()},
+    ("endpoint",),
+)
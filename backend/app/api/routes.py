@@ -1,31 +1,226 @@
-from fastapi import APIRouter
-from app.services.aquaguard_service import AquaGuardService
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from app.services.aquaguard_service import aquaguard_service, model_reloader
 from app.services.data_simulator import simulator
-from datetime import timedelta, datetime
-import random
+from app.services.hierarchy import LEAF_LEVEL, hierarchy_for
+from app.services.ingest import FORMATS, IngestError, IngestParser, UnsupportedFormat
+from app.services.live_buffer import STATUS_NAMES, downsample
+from app.services.rendering import KINDS, MEDIA_TYPES
+from app import startup_profile
+from app.admission import admission
+from app.metrics import registry
+from app.profiling import ProfilingRoute, profile_store
+from datetime import date, datetime
+import asyncio
+import json
+import os
+import time
 
-router = APIRouter()
-aquaguard_service = AquaGuardService()
-aquaguard_service.initialize_model()
+import numpy as np
+import pandas as pd
 
-@router.get("/regions")
+router = APIRouter(route_class=ProfilingRoute)
+admission.version = lambda: aquaguard_service.version
+
+
+def require_model_ready():
+    """Reject model-backed requests while the model is still loading"""
+    if not aquaguard_service.ready:
+        raise HTTPException(
+            status_code=503,
+            detail="Model is still loading",
+            headers={"Retry-After": "5"},
+        )
+
+def resolve_hierarchy(regions, level: str):
+    """Hierarchy over regions, rejecting levels it does not define"""
+    hierarchy = hierarchy_for(regions)
+    if level not in hierarchy.levels:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown level '{level}', expected one of {hierarchy.levels}",
+        )
+    return hierarchy
+
+def resolve_as_of(deployment_date):
+    """Scoring date for what-if requests, rejecting dates before the history starts"""
+    if deployment_date is None:
+        return None
+    as_of = pd.Timestamp(deployment_date)
+    first_date = aquaguard_service.state.first_date
+    if as_of < first_date:
+        raise HTTPException(
+            status_code=400,
+            detail=f"deployment_date is before the history starts ({first_date.date()})",
+        )
+    return as_of
+
+@router.get("/ready")
+def ready():
+    """Readiness probe: 200 once the model is loaded and the result cache is warm"""
+    if aquaguard_service.ready:
+        status = "ready"
+    else:
+        status = "failed" if aquaguard_service.startup_error else "loading"
+    body = {
+        "status": status,
+        "model_version": aquaguard_service.version,
+        "startup": startup_profile.get_report(),
+    }
+    if aquaguard_service.startup_error:
+        body["error"] = aquaguard_service.startup_error
+    return JSONResponse(body, status_code=200 if aquaguard_service.ready else 503)
+
+def require_admin(x_admin_token: str | None = Header(default=None)):
+    """Guard admin routes with AQUAGUARD_ADMIN_TOKEN when it is configured"""
+    expected = os.environ.get("AQUAGUARD_ADMIN_TOKEN")
+    if expected and x_admin_token != expected:
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@router.get("/admin/profiles", dependencies=[Depends(require_admin)])
+def list_profiles():
+    """Recently captured request profiles, newest first"""
+    return profile_store.list()
+
+@router.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+def get_profile(profile_id: str, format: str = "speedscope"):
+    """Download a profile as speedscope JSON or collapsed stacks (format=collapsed)"""
+    path = profile_store.path_for(profile_id, format)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    media_type = "application/json" if format == "speedscope" else "text/plain"
+    return FileResponse(path, media_type=media_type, filename=path.name)
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(
+        registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+@router.get("/regions", dependencies=[Depends(require_model_ready)])
 def regions():
     return aquaguard_service.get_available_regions()
 
-@router.get("/timeseries/{region}")
-def timeseries(region: str):
-    return aquaguard_service.get_timeseries_data(region)
+@router.get("/timeseries/{region}", dependencies=[Depends(require_model_ready)])
+@admission.limit("timeseries", concurrency=4, queue=32)
+def timeseries(region: str, deployment_date: date | None = None):
+    return aquaguard_service.get_timeseries_data(region, resolve_as_of(deployment_date))
+
+@router.get("/risk/{region}", dependencies=[Depends(require_model_ready)])
+@admission.limit("risk", concurrency=4, queue=32)
+def risk(region: str, deployment_date: date | None = None):
+    result = aquaguard_service.get_risk_analysis(region, resolve_as_of(deployment_date))
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"No data for region {region} by {deployment_date}")
+    return result
+
+@router.get("/ranking", dependencies=[Depends(require_model_ready)])
+@admission.limit("ranking", concurrency=2, queue=16)
+def rank(level: str = LEAF_LEVEL, deployment_date: date | None = None):
+    resolve_hierarchy(aquaguard_service.get_available_regions(), level)
+    return aquaguard_service.get_regional_ranking(level, resolve_as_of(deployment_date))
+
+@router.get("/balance", dependencies=[Depends(require_model_ready)])
+def water_balance(meter: str | None = None):
+    """Supply-meter water balance: latest day of every meter, or one meter's daily series"""
+    try:
+        result = aquaguard_service.get_water_balance(meter)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown supply meter: {meter}")
+    if result is None:
+        raise HTTPException(status_code=404, detail="No supply topology or inflow data configured")
+    return result
+
+@router.get("/hierarchy", dependencies=[Depends(require_model_ready)])
+def hierarchy():
+    """Levels and groups of the region hierarchy"""
+    return hierarchy_for(aquaguard_service.get_available_regions()).describe()
+
+@router.get("/forecast/{region}", dependencies=[Depends(require_model_ready)])
+def forecast(region: str, days: int | None = None):
+    """Expected consumption and uncertainty bounds for the coming days"""
+    result = aquaguard_service.get_forecast(region, days)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"No forecast for region: {region}")
+    return result
+
+@router.get("/plots/{region}", dependencies=[Depends(require_model_ready)])
+@admission.limit("plots", concurrency=2, queue=8, deadline=10.0)
+def plot(region: str, kind: str = "analysis", format: str = "png"):
+    """Analysis or consumption chart of a region, rendered once per data and model version"""
+    if kind not in KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown kind '{kind}', expected one of {list(KINDS)}")
+    if format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown format '{format}', expected one of {list(MEDIA_TYPES)}")
+    if region not in aquaguard_service.get_available_regions():
+        raise HTTPException(status_code=404, detail=f"Unknown region: {region}")
+    path = aquaguard_service.render_plot(region, kind, format)
+    return FileResponse(path, media_type=MEDIA_TYPES[format])
+
+@router.post("/ingest", dependencies=[Depends(require_model_ready)])
+async def ingest(request: Request, format: str | None = None, on_error: str = "reject"):
+    """Append batched readings (CSV, NDJSON or Arrow IPC stream) to the history
 
-@router.get("/risk/{region}")
-def risk(region: str):
-    return aquaguard_service.get_risk_analysis(region)
+    on_error=reject (default) ingests nothing if any row is invalid;
+    on_error=skip ingests the valid rows. Either way the response reports
+    rejected rows per validation rule.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    fmt = format or FORMATS.get(content_type)
+    if fmt not in FORMATS.values():
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported content type '{content_type}', expected one of {list(FORMATS)}",
+        )
+    if on_error not in ("reject", "skip"):
+        raise HTTPException(status_code=400, detail="on_error must be 'reject' or 'skip'")
+
+    started = time.perf_counter()
+    max_bytes = int(os.environ.get("AQUAGUARD_INGEST_MAX_BYTES", str(512 * 1024 * 1024)))
+    try:
+        parser = IngestParser(fmt)
+        async for chunk in request.stream():
+            if parser.feed(chunk):
+                await run_in_threadpool(parser.parse_pending)
+            if parser.bytes_received > max_bytes:
+                raise HTTPException(status_code=413, detail=f"Body exceeds {max_bytes} bytes")
+        raw = await run_in_threadpool(parser.finish)
+        outcome = await run_in_threadpool(aquaguard_service.ingest, raw, on_error == "skip")
+    except UnsupportedFormat as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except IngestError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    seconds = time.perf_counter() - started
+    outcome = {
+        "rows_received": len(raw),
+        **outcome,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(len(raw) / seconds) if seconds > 0 else None,
+    }
+    if not outcome["rows_ingested"] and outcome["rows_rejected"]:
+        return JSONResponse(outcome, status_code=422)
+    return outcome
 
-@router.get("/ranking")
-def rank():
-    return aquaguard_service.get_regional_ranking()
 @router.get("/models/status")
 def model_status():
-    return aquaguard_service.get_model_status()
+    return {**aquaguard_service.get_model_status(), "admission": admission.status()}
+
+@router.post("/models/reload", status_code=202, dependencies=[Depends(require_model_ready)])
+def reload_models():
+    """Load the model store and history in the background and swap them in"""
+    try:
+        return model_reloader.start_reload()
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@router.get("/models/reload")
+def reload_status():
+    return model_reloader.get_status()
 
 @router.get("/live/test")
 def test_live():
@@ -34,15 +229,21 @@ def test_live():
 
 # Real-time risk monitoring endpoints
 @router.get("/live/current")
-def get_live_risk_data():
+def get_live_risk_data(level: str = LEAF_LEVEL):
     """Get current real-time risk monitoring for all regions"""
-    return simulator.get_all_regions_data()
+    snapshot = simulator.latest()
+    hierarchy = resolve_hierarchy(snapshot.regions, level)
+    if level != LEAF_LEVEL:
+        return hierarchy.rollup_readings(level, snapshot.readings)
+    return snapshot.readings
 
 @router.get("/live/ranking")
-def get_live_ranking():
+def get_live_ranking(level: str = LEAF_LEVEL):
     """Get live ranking based on current risk data"""
+    snapshot = simulator.latest()
+    hierarchy = resolve_hierarchy(snapshot.regions, level)
     try:
-        live_data = simulator.get_all_regions_data()
+        live_data = snapshot.readings
         
         # Calculate priority scores and rank regions
         ranking = []
@@ -56,16 +257,19 @@ def get_live_ranking():
             elif data["risk_status"] == "new_elevation":
                 base_priority += 30
                 
-            # Add persistence factor if available
-            if data["risk_info"] and "start_time" in data["risk_info"]:
-                start_time = data["risk_info"]["start_time"]
-                if isinstance(start_time, str):
-                    start_time = datetime.fromisoformat(start_time)
-                hours_elapsed = (datetime.now() - start_time).total_seconds() / 3600
-                persistence_days = min(hours_elapsed / 24, 7)  # Cap at 7 days
-                base_priority += persistence_days * 5
+            # Recent peak, average and persistence from the region's sliding window
+            window = snapshot.windows.get(data["region"])
+            if window is not None and window["points"]:
+                recent_peak = window["max"]
+                average_risk = window["mean"]
+                persistence_hours = window["persistence_seconds"] / 3600
             else:
-                persistence_days = 0
+                recent_peak = average_risk = data["risk_score"]
+                persistence_hours = 0.0
+
+            # Add persistence factor: time the risk has stayed at or above 50
+            persistence_days = min(persistence_hours / 24, 7)  # Cap at 7 days
+            base_priority += persistence_days * 5
                 
             # Determine risk level
             if data["risk_score"] >= 70:
@@ -78,14 +282,20 @@ def get_live_ranking():
             ranking.append({
                 "region": data["region"],
                 "current_risk": data["risk_score"],
-                "recent_peak_risk": data["risk_score"] + random.uniform(0, 15),  # Simulate recent peak
+                "recent_peak_risk": round(recent_peak, 1),
+                "average_risk": round(average_risk, 1),
                 "risk_level": risk_level,
                 "persistence_days": int(persistence_days),
+                "persistence_hours": round(persistence_hours, 2),
                 "priority_score": round(base_priority, 2),
                 "risk_status": data["risk_status"],
                 "last_updated": data["timestamp"]
             })
         
+        if level != LEAF_LEVEL:
+            consumption = {data["region"]: data["consumption"] for data in live_data}
+            return hierarchy.rollup_ranking(level, ranking, consumption)
+
         # Sort by priority score (highest first)
         ranking.sort(key=lambda x: x["priority_score"], reverse=True)
         
@@ -100,22 +310,87 @@ def get_live_ranking():
 @router.get("/live/region/{region}")
 def get_live_region_risk(region: str):
     """Get current real-time risk monitoring for specific region"""
-    return simulator.get_current_consumption(region)
+    reading = simulator.latest().by_region.get(region)
+    if reading is None:
+        raise HTTPException(status_code=404, detail=f"No live data for region: {region}")
+    return reading
 
 @router.get("/live/elevated")
 def get_elevated_risk_regions():
-    """Get all regions with currently elevated risk"""
-    elevated_regions = []
-    for region in simulator.regions:
-        if region in simulator.elevated_risk_periods:
-            risk_info = simulator.elevated_risk_periods[region]
-            elevated_regions.append({
-                "region": region,
-                "type": risk_info["type"],
-                "start_time": risk_info["start_time"].isoformat(),
-                "estimated_end": (risk_info["start_time"] + 
-                                timedelta(hours=risk_info["duration_hours"])).isoformat(),
-                "severity": risk_info["severity"].title(),
-                "pattern": risk_info["pattern"]
-            })
-    return elevated_regions
+    """Get all regions with an open elevated-risk episode"""
+    return list(simulator.latest().episodes.values())
+
+@router.get("/live/balance")
+def get_live_balance():
+    """Inflow, downstream consumption and imbalance of every supply meter at the latest tick"""
+    return list(simulator.latest().inflow)
+
+@router.get("/live/history/{region}")
+def get_live_history(region: str, points: int | None = None, start: datetime | None = None,
+                     end: datetime | None = None, max_points: int = 0):
+    """Recent readings of a region from the shared ring buffer, columnar and oldest first"""
+    buffer = simulator.history.get(region)
+    if buffer is None:
+        raise HTTPException(status_code=404, detail=f"No live history for region: {region}")
+    window = buffer.window(
+        points,
+        start.timestamp() if start else None,
+        end.timestamp() if end else None,
+    )
+    window = downsample(window, max_points)
+    return {
+        "region": region,
+        "capacity": buffer.capacity,
+        "points": len(window["timestamps"]),
+        "timestamp": [datetime.fromtimestamp(t).isoformat() for t in window["timestamps"].tolist()],
+        "consumption": np.round(window["consumption"].astype(np.float64), 2).tolist(),
+        "risk_score": np.round(window["risk"].astype(np.float64), 1).tolist(),
+        "risk_status": [STATUS_NAMES[code] for code in window["status"].tolist()],
+    }
+
+@router.get("/live/backfill")
+def backfill_live_events(hours: float = 1.0, region: str | None = None,
+                         kind: str | None = None, limit: int = 10000):
+    """Logged readings and alert transitions of the last hours, oldest first"""
+    if simulator.event_log is None:
+        raise HTTPException(status_code=404, detail="Event log is disabled")
+    kinds = {kind} if kind else {"reading", "transition"}
+    return [
+        {"seq": r["seq"], "kind": r["kind"], **r["data"]}
+        for r in simulator.event_log.tail(hours, kinds, region, limit)
+    ]
+
+@router.get("/live/alerts")
+def get_recent_alerts():
+    """Most recent alert state transitions, oldest first"""
+    return simulator.latest().alerts
+
+@router.get("/live/alerts/stream")
+async def stream_alerts(request: Request):
+    """Server-sent events: one event per alert state transition"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=100)
+
+    def offer(event):
+        if queue.full():
+            queue.get_nowait()  # a slow client loses the oldest events, not new ones
+        queue.put_nowait(event)
+
+    def deliver(event):
+        # Transitions are observed on the simulator's tick thread; hand them to the loop
+        loop.call_soon_threadsafe(offer, event)
+
+    async def events():
+        simulator.alert_engine.subscribe(deliver)
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event['to']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            simulator.alert_engine.unsubscribe(deliver)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
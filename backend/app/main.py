@@ -1,9 +1,64 @@
+from app import startup_profile
+
+# Must run before the heavy imports below so their cost shows up in the profile
+startup_profile.install_import_timer()
+
+import asyncio
+import os
+import traceback
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from app.api.routes import router
+from app.services.aquaguard_service import aquaguard_service
+from app.services.data_simulator import simulator
+from app.services.event_log import EventLog
+from app.services.rendering import plot_renderer
+from app.metrics import MetricsMiddleware
+from app.profiling import ProfilingMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 
+
+def _startup():
+    try:
+        aquaguard_service.startup()
+    finally:
+        startup_profile.uninstall_import_timer()
+        if startup_profile.is_enabled():
+            startup_profile.print_report()
+
+
+def _startup_done(future):
+    """Keep a failed startup's exception for /ready instead of dropping it"""
+    if future.cancelled() or future.exception() is None:
+        return
+    error = future.exception()
+    aquaguard_service.startup_error = f"{type(error).__name__}: {error}"
+    print("AquaGuard startup failed:")
+    traceback.print_exception(error)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Load the model in the background so the process starts serving straight
+    # away; model-backed routes answer 503 until /ready reports ready.
+    initialization = asyncio.get_running_loop().run_in_executor(None, _startup)
+    initialization.add_done_callback(_startup_done)
+    if os.environ.get("AQUAGUARD_EVENT_LOG", "1") != "0":
+        simulator.attach_event_log(
+            EventLog(os.environ.get("AQUAGUARD_EVENT_LOG_DIR", "logs/events")).open()
+        )
+    simulator.start()
+    yield
+    simulator.stop()
+    simulator.detach_event_log()
+    plot_renderer.shutdown()
+    if initialization.done():
+        aquaguard_service.shutdown()
+
+
 # 1️⃣ Create FastAPI app first
-app = FastAPI(title="AquaGuard Backend")
+app = FastAPI(title="AquaGuard Backend", lifespan=lifespan)
 
 # 2️⃣ Add CORS middleware
 app.add_middleware(
@@ -16,5 +71,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Opt-in per-request profiling (AQUAGUARD_PROFILING=1), then per-route
+# latency histograms for /metrics around everything else
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(MetricsMiddleware)
+
 # 3️⃣ Include your routes
 app.include_router(router)
@@ -0,0 +1,211 @@
+"""In-process performance metrics exposed in Prometheus text format.
+
+Enabled by default; set AQUAGUARD_METRICS=0 to turn every timer and counter
+into a no-op (a single attribute check per call).
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+METRICS_ENV = "AQUAGUARD_METRICS"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_NOOP = nullcontext()
+
+
+def _label_text(label_names, label_values):
+    if not label_names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value)}"' for name, value in zip(label_names, label_values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0.0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_label_text(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time
+
+    With label_names, the callback returns {label_values: value} instead.
+    """
+
+    def __init__(self, name: str, help_text: str, callback, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self.label_names = tuple(label_names)
+
+    def render(self):
+        try:
+            if self.label_names:
+                values = {k: float(v) for k, v in self.callback().items()}
+            else:
+                values = {(): float(self.callback())}
+        except Exception:
+            return []
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{_label_text(self.label_names, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *label_values) -> int:
+        series = self._series.get(label_values)
+        return series[2] if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _label_text(self.label_names + ("le",), label_values + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _label_text(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._metrics = {}
+
+    def counter(self, name: str, help_text: str, label_names=()) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help_text, label_names, buckets))
+
+    def gauge(self, name: str, help_text: str, callback, label_names=()) -> Gauge:
+        self._metrics[name] = Gauge(name, help_text, callback, label_names)
+        return self._metrics[name]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry(enabled=os.environ.get(METRICS_ENV, "1") != "0")
+
+stage_duration = registry.histogram(
+    "aquaguard_stage_duration_seconds",
+    "Time spent in each scoring pipeline stage",
+    ("stage",),
+)
+request_duration = registry.histogram(
+    "aquaguard_http_request_duration_seconds",
+    "HTTP request latency by route",
+    ("method", "route", "status"),
+)
+cache_requests = registry.counter(
+    "aquaguard_result_cache_requests_total",
+    "Result cache lookups by outcome",
+    ("result",),
+)
+simulator_tick_duration = registry.histogram(
+    "aquaguard_simulator_tick_duration_seconds",
+    "Time to produce one live reading for every region",
+)
+
+
+@contextmanager
+def _timed(histogram, label_values):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, *label_values)
+
+
+def stage_timer(stage: str):
+    """Time a pipeline stage into aquaguard_stage_duration_seconds"""
+    if not registry.enabled:
+        return _NOOP
+    return _timed(stage_duration, (stage,))
+
+
+def timer(histogram, *label_values):
+    if not registry.enabled:
+        return _NOOP
+    return _timed(histogram, label_values)
+
+
+def count(counter, *label_values):
+    if registry.enabled:
+        counter.inc(*label_values)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route latency (route template, not raw path)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not registry.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            request_duration.observe(
+                time.perf_counter() - started, scope["method"], path, str(status["code"])
+            )
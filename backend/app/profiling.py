@@ -0,0 +1,259 @@
+"""Opt-in per-request stack-sampling profiler.
+
+With AQUAGUARD_PROFILING=1, a request is profiled when it carries the
+`X-AquaGuard-Profile: 1` header or `?profile=1` query flag, or when it is
+picked by 1-in-N sampling (AQUAGUARD_PROFILE_SAMPLE=N). A sampler thread
+snapshots the stacks of every thread that runs part of that request
+(routes are registered through ProfilingRoute, so endpoints offloaded to
+the threadpool are included) and the result is stored as a speedscope
+JSON file plus collapsed stacks, retrievable from /admin/profiles.
+"""
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+from fastapi.routing import APIRoute
+
+PROFILING_ENV = "AQUAGUARD_PROFILING"
+SAMPLE_ENV = "AQUAGUARD_PROFILE_SAMPLE"
+PROFILE_HEADER = b"x-aquaguard-profile"
+
+_current_session = contextvars.ContextVar("aquaguard_profile_session", default=None)
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class ProfileSession:
+    """Samples the stacks of the threads registered to one request"""
+
+    def __init__(self, profile_id: str, method: str, path: str, interval: float):
+        self.profile_id = profile_id
+        self.method = method
+        self.path = path
+        self.interval = interval
+        self.threads = {}
+        self.stacks = Counter()
+        self.started_at = datetime.now()
+        self.duration = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(
+            target=self._sample, name=f"aquaguard-profiler-{profile_id}", daemon=True
+        )
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        self.duration = time.perf_counter() - self._started
+
+    def enter_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self.threads[ident] = self.threads.get(ident, 0) + 1
+
+    def exit_thread(self):
+        ident = threading.get_ident()
+        with self._lock:
+            remaining = self.threads.get(ident, 1) - 1
+            if remaining:
+                self.threads[ident] = remaining
+            else:
+                self.threads.pop(ident, None)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                idents = list(self.threads)
+            if not idents:
+                continue
+            frames = sys._current_frames()
+            for ident in idents:
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[tuple(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        """Brendan Gregg collapsed-stack format (flamegraph.pl, speedscope)"""
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common())
+
+    def speedscope(self) -> dict:
+        frame_index = {}
+        samples, weights = [], []
+        for stack, count in self.stacks.most_common():
+            samples.append([frame_index.setdefault(label, len(frame_index)) for label in stack])
+            weights.append(count * self.interval)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": [{"name": label} for label in frame_index]},
+            "profiles": [{
+                "type": "sampled",
+                "name": f"{self.method} {self.path}",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+            "name": f"{self.method} {self.path} ({self.profile_id})",
+            "exporter": "aquaguard",
+        }
+
+
+class ProfileStore:
+    """Keeps the most recent profiles on disk"""
+
+    def __init__(self, directory: str = "profiles", max_profiles: int = 50):
+        self.directory = Path(directory)
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+
+    def save(self, session: ProfileSession):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        base = self.directory / session.profile_id
+        base.with_suffix(".speedscope.json").write_text(json.dumps(session.speedscope()))
+        base.with_suffix(".collapsed.txt").write_text(session.collapsed())
+        base.with_suffix(".meta.json").write_text(json.dumps({
+            "id": session.profile_id,
+            "method": session.method,
+            "path": session.path,
+            "started_at": session.started_at.isoformat(),
+            "duration_seconds": round(session.duration, 4),
+            "samples": sum(session.stacks.values()),
+        }))
+        self._prune()
+
+    def _prune(self):
+        with self._lock:
+            metas = sorted(self.directory.glob("*.meta.json"), key=lambda p: p.stat().st_mtime)
+            for meta in metas[:-self.max_profiles]:
+                profile_id = meta.name[:-len(".meta.json")]
+                for suffix in (".speedscope.json", ".collapsed.txt", ".meta.json"):
+                    (self.directory / f"{profile_id}{suffix}").unlink(missing_ok=True)
+
+    def list(self) -> list:
+        if not self.directory.exists():
+            return []
+        metas = sorted(self.directory.glob("*.meta.json"), key=lambda p: p.stat().st_mtime, reverse=True)
+        return [json.loads(p.read_text()) for p in metas]
+
+    def path_for(self, profile_id: str, fmt: str):
+        suffix = ".speedscope.json" if fmt == "speedscope" else ".collapsed.txt"
+        path = self.directory / f"{os.path.basename(profile_id)}{suffix}"
+        return path if path.exists() else None
+
+
+profile_store = ProfileStore()
+
+
+def _track_thread(endpoint):
+    """Wrap an endpoint so the thread running it is sampled for the active profile"""
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            session = _current_session.get()
+            if session is None:
+                return await endpoint(*args, **kwargs)
+            session.enter_thread()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                session.exit_thread()
+        return wrapper
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        # Context variables are copied into threadpool workers, so this sees
+        # the session started by the middleware on the event loop.
+        session = _current_session.get()
+        if session is None:
+            return endpoint(*args, **kwargs)
+        session.enter_thread()
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            session.exit_thread()
+    return wrapper
+
+
+def run_profiled(fn):
+    """Wrap a callable handed to another thread pool so it joins the caller's profile"""
+    session = _current_session.get()
+    if session is None:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        session.enter_thread()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            session.exit_thread()
+    return wrapper
+
+
+class ProfilingRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, _track_thread(endpoint), **kwargs)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that decides which requests get profiled"""
+
+    def __init__(self, app, interval: float = 0.005):
+        self.app = app
+        self.enabled = os.environ.get(PROFILING_ENV) == "1"
+        self.sample_every = int(os.environ.get(SAMPLE_ENV, "0") or 0)
+        self.interval = interval
+        self._counter = itertools.count(1)
+
+    def _should_profile(self, scope) -> bool:
+        if any(name == PROFILE_HEADER and value in (b"1", b"true") for name, value in scope["headers"]):
+            return True
+        query = scope.get("query_string", b"").decode("latin-1")
+        if "profile=1" in query.split("&"):
+            return True
+        return self.sample_every > 0 and next(self._counter) % self.sample_every == 0
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or not self.enabled
+                or scope["path"].startswith("/admin/") or not self._should_profile(scope)):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = datetime.now().strftime("%Y%m%d-%H%M%S-") + os.urandom(3).hex()
+        session = ProfileSession(profile_id, scope["method"], scope["path"], self.interval)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-aquaguard-profile-id", profile_id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = _current_session.set(session)
+        session.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_session.reset(token)
+            session.stop()
+            profile_store.save(session)
@@ -0,0 +1,40 @@
+"""Multi-worker serving entry point with shared history and results.
+
+The parent process loads the model store and history once, scores every
+region, and publishes the frames to shared memory. Uvicorn workers then
+attach to that block read-only instead of repeating the load themselves:
+
+    python -m app.serve --workers 4 --port 8000
+"""
+import argparse
+import os
+
+import uvicorn
+
+from app.services.shared_state import SHARED_STATE_ENV, SharedStatePublisher
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run AquaGuard with shared worker state")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--manifest", default="models/shared_state.json")
+    args = parser.parse_args()
+
+    # Imported here so the parent is the only process that pays the full load
+    from app.services.aquaguard_service import aquaguard_service
+
+    aquaguard_service.startup(start_background_jobs=False)
+    state = aquaguard_service.state
+
+    publisher = SharedStatePublisher(args.manifest)
+    try:
+        os.environ[SHARED_STATE_ENV] = publisher.publish(state)
+        uvicorn.run("app.main:app", host=args.host, port=args.port, workers=args.workers)
+    finally:
+        publisher.close()
+
+
+if __name__ == "__main__":
+    main()
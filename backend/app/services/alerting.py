@@ -0,0 +1,236 @@
+"""Elevated-risk episodes driven by the live risk stream.
+
+Every region runs a small state machine:
+
+    normal -> rising -> elevated -> resolving -> normal
+
+A region enters `rising` when its risk reaches enter_threshold and becomes
+`elevated` (opening an episode) only after confirm_readings consecutive
+readings at or above it. It starts `resolving` below the lower
+exit_threshold (hysteresis) and closes the episode after clear_readings
+consecutive readings below it; any reading back above exit_threshold
+returns it to `elevated`. Open episodes are indexed by region, so listing
+them is O(active), and every transition is pushed to subscribers.
+"""
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+NORMAL = "normal"
+RISING = "rising"
+ELEVATED = "elevated"
+RESOLVING = "resolving"
+
+
+def severity_for(risk: float) -> str:
+    if risk >= 70:
+        return "High"
+    if risk >= 50:
+        return "Medium"
+    return "Low"
+
+
+class RegionAlertState:
+    __slots__ = ("state", "streak", "since", "episode")
+
+    def __init__(self):
+        self.state = NORMAL
+        self.streak = 0
+        self.since = None
+        self.episode = None
+
+
+class AlertEngine:
+    def __init__(self, enter_threshold: float = 50.0, exit_threshold: float = 40.0,
+                 confirm_readings: int = 3, clear_readings: int = 3, history: int = 200):
+        self.enter_threshold = enter_threshold
+        self.exit_threshold = exit_threshold
+        self.confirm_readings = confirm_readings
+        self.clear_readings = clear_readings
+        self.regions = {}
+        self.active = {}
+        self.recent_events = deque(maxlen=history)
+        self._subscribers = []
+        self._next_episode_id = 1
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """Call callback(event) on every transition (from the thread that observed it)"""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def observe(self, region: str, risk: float, timestamp: datetime, context=None) -> str:
+        """Feed one risk reading; returns the region's state afterwards
+
+        context carries details about the cause (e.g. the simulator's
+        scenario) that are copied onto a newly opened episode.
+        """
+        with self._lock:
+            current = self.regions.get(region)
+            if current is None:
+                current = self.regions[region] = RegionAlertState()
+            previous, episode = current.state, current.episode
+            self._step(current, region, risk, timestamp, context)
+            episode = current.episode or episode
+            if current.state == previous:
+                return current.state
+            event = {
+                "region": region,
+                "from": previous,
+                "to": current.state,
+                "timestamp": timestamp.isoformat(),
+                "risk_score": round(risk, 1),
+                "episode": self._serialize(episode) if episode else None,
+            }
+            self.recent_events.append(event)
+            subscribers = list(self._subscribers)
+
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"Alert subscriber failed: {e}")
+        return event["to"]
+
+    def _step(self, current, region, risk, timestamp, context):
+        episode = current.episode
+        if episode is not None:
+            episode["last_risk"] = risk
+            episode["peak_risk"] = max(episode["peak_risk"], risk)
+            episode["readings"] += 1
+
+        if current.state == NORMAL:
+            if risk >= self.enter_threshold:
+                self._enter(current, RISING, timestamp)
+                if self.confirm_readings <= 1:
+                    self._open_episode(current, region, risk, timestamp, context)
+        elif current.state == RISING:
+            if risk < self.enter_threshold:
+                self._enter(current, NORMAL, timestamp)
+            else:
+                current.streak += 1
+                if current.streak >= self.confirm_readings:
+                    self._open_episode(current, region, risk, timestamp, context)
+        elif current.state == ELEVATED:
+            if risk < self.exit_threshold:
+                self._enter(current, RESOLVING, timestamp)
+                if self.clear_readings <= 1:
+                    self._close_episode(current, region, timestamp)
+        elif current.state == RESOLVING:
+            if risk >= self.exit_threshold:
+                self._enter(current, ELEVATED, timestamp)
+            else:
+                current.streak += 1
+                if current.streak >= self.clear_readings:
+                    self._close_episode(current, region, timestamp)
+
+    @staticmethod
+    def _enter(current, state, timestamp):
+        current.state = state
+        current.streak = 1
+        current.since = timestamp
+
+    def _open_episode(self, current, region, risk, timestamp, context):
+        context = context or {}
+        estimated_end = None
+        if "duration_hours" in context and "start_time" in context:
+            start = context["start_time"]
+            if isinstance(start, str):
+                start = datetime.fromisoformat(start)
+            estimated_end = start + timedelta(hours=context["duration_hours"])
+        current.episode = {
+            "episode_id": self._next_episode_id,
+            "region": region,
+            "started_at": current.since,
+            "elevated_at": timestamp,
+            "peak_risk": risk,
+            "last_risk": risk,
+            "readings": current.streak,
+            "type": context.get("type"),
+            "pattern": context.get("pattern"),
+            "estimated_end": estimated_end,
+        }
+        self._next_episode_id += 1
+        self.active[region] = current.episode
+        self._enter(current, ELEVATED, timestamp)
+
+    def _close_episode(self, current, region, timestamp):
+        current.episode["resolved_at"] = timestamp
+        current.episode = None
+        self.active.pop(region, None)
+        self._enter(current, NORMAL, timestamp)
+
+    def snapshot(self) -> dict:
+        """JSON-serializable state, for the event log"""
+        def encode(value):
+            return value.isoformat() if isinstance(value, datetime) else value
+
+        with self._lock:
+            return {
+                "next_episode_id": self._next_episode_id,
+                "regions": {
+                    region: {
+                        "state": current.state,
+                        "streak": current.streak,
+                        "since": encode(current.since),
+                        "episode": {k: encode(v) for k, v in current.episode.items()}
+                        if current.episode else None,
+                    }
+                    for region, current in self.regions.items()
+                },
+            }
+
+    def restore(self, snapshot: dict):
+        def decode(key, value):
+            if key in ("started_at", "elevated_at", "estimated_end", "resolved_at") and value:
+                return datetime.fromisoformat(value)
+            return value
+
+        with self._lock:
+            self._next_episode_id = snapshot["next_episode_id"]
+            self.regions, self.active = {}, {}
+            for region, saved in snapshot["regions"].items():
+                current = self.regions[region] = RegionAlertState()
+                current.state = saved["state"]
+                current.streak = saved["streak"]
+                current.since = datetime.fromisoformat(saved["since"]) if saved["since"] else None
+                if saved["episode"]:
+                    current.episode = {k: decode(k, v) for k, v in saved["episode"].items()}
+                    self.active[region] = current.episode
+
+    def state_of(self, region: str) -> str:
+        current = self.regions.get(region)
+        return current.state if current else NORMAL
+
+    def episode(self, region: str):
+        """The region's open episode (serialized), or None"""
+        with self._lock:
+            episode = self.active.get(region)
+            return self._serialize(episode) if episode else None
+
+    def active_episodes(self) -> list:
+        with self._lock:
+            return [self._serialize(e) for e in self.active.values()]
+
+    def _serialize(self, episode) -> dict:
+        state = self.regions[episode["region"]].state
+        return {
+            "region": episode["region"],
+            "episode_id": episode["episode_id"],
+            "state": state,
+            "type": episode["type"] or "detected",
+            "pattern": episode["pattern"] or "unknown",
+            "severity": severity_for(episode["peak_risk"]),
+            "start_time": episode["started_at"].isoformat(),
+            "elevated_at": episode["elevated_at"].isoformat(),
+            "estimated_end": episode["estimated_end"].isoformat() if episode["estimated_end"] else None,
+            "peak_risk": round(episode["peak_risk"], 1),
+            "last_risk": round(episode["last_risk"], 1),
+            "readings": episode["readings"],
+            "resolved_at": episode["resolved_at"].isoformat() if "resolved_at" in episode else None,
+        }
@@ -1,43 +1,361 @@
+import json
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
 import pandas as pd
-from app.services.improved_model import ImprovedAquaGuardModel
+from app.services.calendar_grid import CalendarGrid
+from app.services.improved_model import load_model_store
+from app.services.retraining_scheduler import DriftRetrainingScheduler
+from app.services.model_reloader import ModelReloader
+from app.services.hierarchy import LEAF_LEVEL, hierarchy_for
+from app.services.rendering import analysis_job, consumption_job, plot_renderer
+from app.services.history_store import HistoryStore, memory_report
+from app.services.ingest import report as ingest_report, validate_readings
+from app.services.shared_state import SHARED_STATE_ENV, attach_shared_state
+from app.services.water_balance import balance_for
+from app.startup_profile import end_startup, stage
+from app.metrics import cache_requests, count, registry, stage_timer
+
+# Past dates whose rankings are kept per state while scrubbing through time
+DATED_RANKINGS_CACHED = 64
+
+
+class ServiceState:
+    """Model, history and result cache for one deployed model version
+
+    A state is never mutated after it is installed (apart from filling its
+    result cache), so a request that grabs a reference keeps a consistent view
+    even if a reload or retrain installs a newer state meanwhile.
+    """
+
+    def __init__(self, model, df, version: str, results=None, model_loader=None,
+                 history_store=None, data_version: str = None):
+        self._model = model
+        self._model_loader = model_loader
+        self._model_lock = threading.Lock()
+        self.df = df
+        self.version = version
+        # Version of the store and history this state was loaded or ingested
+        # from; swapping in one region's retrained models keeps it
+        self.data_version = data_version or version
+        self.regions = sorted(df["region"].unique().tolist())
+        self.results = results if results is not None else {}
+        self.history_store = history_store
+        self.loaded_at = datetime.now()
+        self._region_slices = None
+        self._grid = None
+        self._balance = None
+        self._balance_loaded = False
+        self._region_weights = None
+        self._first_date = None
+        self._last_dates = None
+        self.leaf_ranking = None
+        # Rankings as of past dates, keyed by date (oldest evicted first)
+        self.dated_rankings = {}
+        self.dated_lock = threading.Lock()
+
+    @property
+    def model(self):
+        # States attached from shared memory defer unpickling until a request
+        # actually needs the model (a cache miss or a retrain).
+        if self._model is None and self._model_loader is not None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = self._model_loader()
+        return self._model
+
+    @property
+    def model_type(self):
+        """Store type of the model, or None while an attached state has not loaded it"""
+        return self._model.model_type if self._model is not None else None
+
+    def region_frame(self, region: str):
+        """Rows of one region as a positional slice, without scanning the whole frame"""
+        if self._region_slices is None:
+            slices = {}
+            for name, positions in self.df.groupby("region", observed=True).indices.items():
+                if positions[-1] - positions[0] + 1 == len(positions):
+                    slices[name] = slice(positions[0], positions[-1] + 1)
+                else:
+                    slices[name] = positions
+            self._region_slices = slices
+        positions = self._region_slices.get(region)
+        if positions is None:
+            return self.df.iloc[0:0]
+        return self.df.iloc[positions]
+
+    @property
+    def grid(self):
+        """Daily usage as a dense regions × days CalendarGrid, built on first use"""
+        if self._grid is None:
+            with stage_timer("calendar_grid"):
+                self._grid = CalendarGrid.from_frame(self.df, self.regions)
+        return self._grid
+
+    @property
+    def grid_built(self) -> bool:
+        return self._grid is not None
+
+    @property
+    def balance(self):
+        """WaterBalance of the history against the supply meters, or None if none are configured"""
+        if not self._balance_loaded:
+            with stage_timer("water_balance"):
+                self._balance = balance_for(self.grid)
+            self._balance_loaded = True
+        return self._balance
+
+    def region_balance(self, region: str):
+        return self.balance.region_signal(region) if self.balance is not None else None
+
+    def last_dates(self):
+        """Newest date of every region, as a Series indexed by region name"""
+        if self._last_dates is None:
+            self._last_dates = self.grid.last_dates()
+        return self._last_dates
+
+    @property
+    def first_date(self):
+        if self._first_date is None:
+            self._first_date = self.grid.start if self.grid.start is not None else pd.NaT
+        return self._first_date
+
+    def region_weights(self) -> dict:
+        """Mean daily usage per region, used to weight roll-ups"""
+        if self._region_weights is None:
+            means = self.grid.means()
+            self._region_weights = {region: float(v) for region, v in zip(self.grid.regions, means)}
+        return self._region_weights
 
 
 class AquaGuardService:
     def __init__(self):
-        self.model = None
-        self.df = None
+        self.model_path = "models/aquaguard_model.pkl"
+        self.data_path = "data/water_consumption_cleaned.csv"
+        self.forecast_config_path = "models/forecast_horizons.json"
         self.deployment_date = pd.to_datetime("2023-01-25")
+        self.retraining_scheduler = DriftRetrainingScheduler(self)
+        self._state = None
+        self._ingest_count = 0
+        self._swap_lock = threading.Lock()
+        self.ready = False
+        # Set (to "ExceptionType: message") if startup() raised
+        self.startup_error = None
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def model(self):
+        return self._state.model if self._state is not None else None
+
+    @property
+    def df(self):
+        return self._state.df if self._state is not None else None
+
+    @property
+    def version(self):
+        return self._state.version if self._state is not None else None
+
+    @property
+    def attached(self):
+        """Serving read-only state published by an app.serve parent process"""
+        return self._state is not None and self._state.history_store is None
 
     def initialize_model(self):
-        self.model = ImprovedAquaGuardModel()
-        self.model.load_models("models/aquaguard_model.pkl")
-        self.df = self.model.load_and_preprocess_data(
-            "data/water_consumption_cleaned.csv"
-        )
+        manifest_path = os.environ.get(SHARED_STATE_ENV)
+        if manifest_path:
+            with stage("attach_shared_state"):
+                self.install_state(self.attach_state(manifest_path))
+        else:
+            self.install_state(self.load_state())
 
-    def get_available_regions(self):
-        return sorted(self.df["region"].unique().tolist())
-
-    def get_timeseries_data(self, region: str):
-        results = self.model.predict_and_detect_anomalies(
-            self.df, region, self.deployment_date
-        )
-
-        return [
-            {
-                "date": row["date"].isoformat(),
-                "actual_usage": round(row["daily_usage"], 2),
-                "predicted_usage": round(row["predicted_usage"], 2),
-                "risk_score": round(row["combined_risk_score"], 2),
-                "is_anomaly": bool(row["is_anomaly_ml"]),
-            }
-            for _, row in results.iterrows()
+    def startup(self, start_background_jobs: bool = True):
+        """Load, prewarm and start background jobs; run once per process"""
+        self.initialize_model()
+        with stage("prewarm"):
+            self.prewarm(self._state)
+        end_startup()
+        # Attached workers serve the parent's state as published: retraining or
+        # reloading here would unpickle a private model and diverge from the others
+        if start_background_jobs and not self.attached:
+            self.retraining_scheduler.start()
+            if os.environ.get("AQUAGUARD_WATCH_MODEL") == "1":
+                model_reloader.start_watching()
+        self.ready = True
+
+    def shutdown(self):
+        self.ready = False
+        model_reloader.stop_watching()
+        self.retraining_scheduler.stop()
+
+    def load_state(self, model_path=None, data_path=None):
+        """Load a model store and history into a new, not yet installed, state"""
+        model_path = model_path or self.model_path
+        data_path = data_path or self.data_path
+
+        with stage("load_models"):
+            model = load_model_store(model_path)
+        history_store = HistoryStore(model)
+        with stage("load_and_preprocess_data"):
+            df = history_store.load(data_path)
+        with stage("build_forecasts"):
+            self.configure_forecasts(model, df)
+        version = f"{int(os.path.getmtime(model_path))}-{int(os.path.getmtime(data_path))}"
+        if history_store.segment_path.exists():
+            version += f"-{int(os.path.getmtime(history_store.segment_path))}"
+        return ServiceState(model, df, version, history_store=history_store)
+
+    def configure_forecasts(self, model, df):
+        """Apply horizon config and batch-compute forecasts that are missing or stale
+
+        The optional config file looks like {"default": 30, "regions": {"East": 14}}.
+        """
+        if os.path.exists(self.forecast_config_path):
+            with open(self.forecast_config_path) as f:
+                config = json.load(f)
+            model.default_forecast_horizon = int(config.get("default", model.default_forecast_horizon))
+            model.forecast_horizons = {r: int(d) for r, d in config.get("regions", {}).items()}
+
+        stale = [
+            region for region in model.models
+            if len(model.forecasts.get(region, {}).get("yhat", ())) != model.get_forecast_horizon(region)
         ]
+        if stale:
+            model.build_forecasts(df[df["region"].isin(stale)])
+
+    def attach_state(self, manifest_path: str):
+        """Build a state on top of history and results published by a parent process"""
+        df, results, version = attach_shared_state(manifest_path)
+        model_path = self.model_path
+
+        def load_model():
+            model = load_model_store(model_path)
+            self.configure_forecasts(model, df)
+            return model
+
+        return ServiceState(None, df, version, results, model_loader=load_model)
+
+    def prewarm(self, state):
+        """Fill a state's result cache for every region before it serves traffic"""
+        for region in state.regions:
+            self.compute_results(region, state)
 
-    def get_risk_analysis(self, region: str):
-        results = self.model.predict_and_detect_anomalies(
-            self.df, region, self.deployment_date
-        )
+    def install_state(self, state):
+        """Atomically make a state the one new requests are served from"""
+        with self._swap_lock:
+            self._state = state
+
+    def get_available_regions(self):
+        return list(self._state.regions)
+
+    def compute_results(self, region: str, state=None):
+        """Score a region (cached per model version) and feed the drift scheduler"""
+        state = state or self._state
+        results = state.results.get(region)
+        count(cache_requests, "hit" if results is not None else "miss")
+        if results is None:
+            results = state.model.predict_and_detect_anomalies(
+                state.region_frame(region), region, self.deployment_date,
+                balance=state.region_balance(region),
+            )
+            state.results[region] = results
+            self.retraining_scheduler.observe(region, results, self.deployment_date)
+        return results
+
+    def swap_region_models(self, region, prophet_model, anomaly_detector, scaler, threshold,
+                           forecast=None, data_version: str = None) -> bool:
+        """Replace one region's models without disturbing in-flight requests
+
+        With data_version, the swap is skipped (returns False) if a reload or
+        ingest has installed newer data than the models were fitted on.
+        """
+        with self._swap_lock:
+            current = self._state
+            if current.history_store is None:
+                raise RuntimeError("This process serves attached state and cannot swap models")
+            if data_version is not None and data_version != current.data_version:
+                return False
+            model = current.model.with_region_models(
+                region, prophet_model, anomaly_detector, scaler, threshold, forecast
+            )
+            results = {r: res for r, res in current.results.items() if r != region}
+            self._state = ServiceState(
+                model, current.df, f"{current.version}+{region}", results,
+                history_store=current.history_store, data_version=current.data_version
+            )
+        return True
+
+    def results_as_of(self, region: str, as_of=None, state=None):
+        """Results as scored on as_of (None: the full history), sharing the cached forecast"""
+        state = state or self._state
+        results = self.compute_results(region, state)
+        if as_of is None:
+            return results
+        return state.model.rescore(results, as_of)
+
+    def ingest(self, raw, skip_invalid: bool = False) -> dict:
+        """Validate readings, append them and re-score only the regions they touch
+
+        The new state is installed at once; its affected regions are
+        re-scored (and their forecasts rebuilt) in the background, and any
+        request that gets there first scores the region itself.
+        """
+        with self._swap_lock:
+            current = self._state
+            if current.history_store is None:
+                raise RuntimeError("This process serves attached state and cannot ingest")
+            rows, failures = validate_readings(raw, current.regions, current.last_dates())
+            outcome = ingest_report(failures)
+            if not len(rows) or (outcome["rows_rejected"] and not skip_invalid):
+                return {**outcome, "rows_ingested": 0, "regions": [], "model_version": current.version}
+
+            df = current.history_store.append(current.df, rows)
+            affected = sorted(rows["region"].unique().tolist())
+            results = {r: res for r, res in current.results.items() if r not in affected}
+            self._ingest_count += 1
+            version = f"{current.version.split('+ingest')[0]}+ingest{self._ingest_count}"
+            state = ServiceState(current.model, df, version, results,
+                                 history_store=current.history_store)
+            self._state = state
+
+        threading.Thread(
+            target=self._rescore_regions, args=(state, affected),
+            name="aquaguard-ingest-rescore", daemon=True,
+        ).start()
+        return {**outcome, "rows_ingested": len(rows), "regions": affected, "model_version": version}
+
+    def _rescore_regions(self, state, regions):
+        try:
+            with stage_timer("ingest_rescore"):
+                state.model.build_forecasts(state.df[state.df["region"].isin(regions)])
+                for region in regions:
+                    self.compute_results(region, state)
+        except Exception as e:
+            print(f"Re-scoring after ingest failed: {e}")
+
+    def get_timeseries_data(self, region: str, as_of=None):
+        results = self.results_as_of(region, as_of)
+
+        with stage_timer("serialization"):
+            return [
+                {
+                    "date": row["date"].isoformat(),
+                    "actual_usage": round(row["daily_usage"], 2),
+                    "predicted_usage": round(row["predicted_usage"], 2),
+                    "risk_score": round(row["combined_risk_score"], 2),
+                    "is_anomaly": bool(row["is_anomaly_ml"]),
+                }
+                for _, row in results.iterrows()
+            ]
+
+    def get_risk_analysis(self, region: str, as_of=None):
+        results = self.results_as_of(region, as_of)
+        if results.empty:
+            return None
 
         current_risk = results["combined_risk_score"].iloc[-1]
         recent_peak = results.tail(14)["combined_risk_score"].quantile(0.9)
@@ -54,16 +372,57 @@ class AquaGuardService:
             "average_risk_7d": round(average_risk_7d, 2),
             "recent_anomalies_30d": recent_anomalies,
             "risk_trend": "increasing" if last_7 > prev_7 else "decreasing",
-            "last_updated": results["date"].iloc[-1].isoformat()
+            "last_updated": results["date"].iloc[-1].isoformat(),
+            **self._balance_fields(results),
+        }
+
+    @staticmethod
+    def _balance_fields(results) -> dict:
+        if "imbalance_z" not in results:
+            return {}
+        reconciled = results.dropna(subset=["imbalance_z"])
+        if reconciled.empty:
+            return {"supply_imbalance_z": None, "non_revenue_water_ratio": None}
+        return {
+            "supply_imbalance_z": round(float(reconciled["imbalance_z"].iloc[-1]), 2),
+            "non_revenue_water_ratio": round(float(reconciled["nrw_ratio"].iloc[-1]), 4),
         }
 
-    def get_regional_ranking(self):
+    def get_water_balance(self, meter: str = None):
+        """Latest reconciled day of every supply meter, or one meter's daily series
+
+        Returns None when no supply topology and inflow data are configured;
+        raises KeyError for an unknown meter.
+        """
+        balance = self._state.balance
+        if balance is None:
+            return None
+        if meter is None:
+            return balance.summary()
+        frame = balance.meter_frame(meter)
+        with stage_timer("serialization"):
+            return {
+                "meter": meter,
+                "date": frame["date"].dt.strftime("%Y-%m-%d").tolist(),
+                **{
+                    column: [None if np.isnan(v) else round(v, 4) for v in frame[column].tolist()]
+                    for column in ("inflow", "consumption", "imbalance", "nrw_ratio", "imbalance_z")
+                },
+                "is_imbalance": frame["is_imbalance"].tolist(),
+            }
+
+    def leaf_ranking(self, state=None, as_of=None):
+        """Per-region ranking rows (unsorted), computed once per state and date"""
+        state = state or self._state
+        cached = state.leaf_ranking if as_of is None else state.dated_rankings.get(as_of)
+        if cached is not None:
+            return cached
         ranking = []
 
-        for region in self.df["region"].unique():
-            results = self.model.predict_and_detect_anomalies(
-                self.df, region, self.deployment_date
-            )
+        for region in state.regions:
+            results = self.results_as_of(region, as_of, state)
+            if results.empty:
+                continue
 
             current = results["combined_risk_score"].iloc[-1]
             peak = results.tail(14)["combined_risk_score"].quantile(0.9)
@@ -101,21 +460,95 @@ class AquaGuardService:
                 "priority_score": round(priority, 2),
             })
 
-        ranking.sort(key=lambda x: x["priority_score"], reverse=True)
+        if as_of is None:
+            state.leaf_ranking = ranking
+        else:
+            with state.dated_lock:
+                if len(state.dated_rankings) >= DATED_RANKINGS_CACHED:
+                    state.dated_rankings.pop(next(iter(state.dated_rankings)))
+                state.dated_rankings[as_of] = ranking
+        return ranking
 
-        for i, r in enumerate(ranking):
-            r["inspection_priority"] = i + 1
+    def get_regional_ranking(self, level: str = LEAF_LEVEL, as_of=None):
+        state = self._state
+        ranking = self.leaf_ranking(state, as_of)
+        if level != LEAF_LEVEL:
+            return hierarchy_for(state.regions).rollup_ranking(
+                level, ranking, state.region_weights()
+            )
 
+        ranking = sorted(ranking, key=lambda x: x["priority_score"], reverse=True)
+        ranking = [{**r, "inspection_priority": i + 1} for i, r in enumerate(ranking)]
         return ranking
 
+    def render_plot(self, region: str, kind: str = "analysis", fmt: str = "png"):
+        """Path of the region's plot, rendered on first request for this data and model version"""
+        state = self._state
+        if kind == "analysis":
+            results = self.compute_results(region, state)
+            job = analysis_job(region, results, state.model.thresholds[region])
+        else:
+            frame = state.region_frame(region)
+            job = consumption_job(region, frame["date"], frame["daily_usage"])
+        return plot_renderer.render(job, state.version, fmt)
+
+    def get_forecast(self, region: str, days=None):
+        """Serve the precomputed forecast for a region; nothing is predicted per request"""
+        forecast = self._state.model.forecasts.get(region)
+        if forecast is None:
+            return None
+
+        horizon = len(forecast["yhat"])
+        days = horizon if days is None else max(0, min(int(days), horizon))
+        dates = pd.date_range(forecast["start"], periods=days, freq="D")
+        with stage_timer("serialization"):
+            return {
+                "region": region,
+                "model_version": self._state.version,
+                "horizon_days": horizon,
+                "forecast": [
+                    {
+                        "date": date.isoformat(),
+                        "predicted_usage": round(float(yhat), 2),
+                        "lower_bound": round(float(lower), 2),
+                        "upper_bound": round(float(upper), 2),
+                    }
+                    for date, yhat, lower, upper in zip(
+                        dates,
+                        forecast["yhat"][:days],
+                        forecast["yhat_lower"][:days],
+                        forecast["yhat_upper"][:days],
+                    )
+                ],
+            }
+
     def get_model_status(self):
+        state = self._state
+        if state is None:
+            return {"status": "loading", "model_type": None}
         return {
             "status": "loaded",
-            "model_type": "ImprovedAquaGuardModel",
-            "regions_available": len(self.get_available_regions()),
+            "model_type": state.model_type,
+            "model_version": state.version,
+            "loaded_at": state.loaded_at.isoformat(),
+            "regions_available": len(state.regions),
+            "cached_regions": len(state.results),
+            "memory": memory_report(state, state.history_store, self.model_path),
+            "drift": self.retraining_scheduler.get_status(),
         }
 
 
-# SINGLETON INSTANCE
+# SINGLETON INSTANCE (loaded by the app lifespan, see app/main.py)
 aquaguard_service = AquaGuardService()
-aquaguard_service.initialize_model()
+model_reloader = ModelReloader(aquaguard_service)
+
+registry.gauge(
+    "aquaguard_cached_regions",
+    "Regions with cached results in the current model version",
+    lambda: len(aquaguard_service.state.results) if aquaguard_service.state else 0,
+)
+registry.gauge(
+    "aquaguard_retrain_pending",
+    "Regions queued or running a drift-triggered retrain",
+    lambda: len(aquaguard_service.retraining_scheduler.pending),
+)
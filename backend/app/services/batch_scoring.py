@@ -0,0 +1,355 @@
+"""Offline batch scoring of a long history with a saved model store.
+
+    python -m app.services.batch_scoring --data history.csv --out outputs/scores \\
+        [--model models/aquaguard_model.pkl] [--workers N] [--time-budget SECONDS]
+
+The input CSV (region, date, daily_usage; region, timestamp, usage for an
+hourly store) is never loaded whole:
+
+1. A first pass over the region column counts rows per region and packs
+   whole regions into partitions of about --partition-rows rows.
+2. A second pass streams the CSV in chunks and appends each chunk's rows to
+   its partition's spill file under <out>/_work/.
+3. Worker processes (spawned, each loading the model store once) score one
+   partition at a time with predict_and_detect_anomalies and write its
+   result columns atomically to <out>/part-NNNNN.npz (or .parquet with
+   --format parquet, which needs pyarrow or fastparquet).
+
+<out>/_manifest.json records the input and model fingerprints, the
+partition plan and every finished part, and is rewritten after each one.
+Re-running the same command resumes: finished parts are kept and only the
+rest are scored. With --time-budget no partition is started once the mean
+partition time would overrun the budget; the command then exits with
+status 3 and the next run carries on. Read the output with load_scores().
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+FORMATS = ("npz", "parquet")
+MANIFEST = "_manifest.json"
+WORK_DIR = "_work"
+# Exit status of a run that stopped at its time budget with partitions left
+INCOMPLETE = 3
+# Result columns written when the model produces them, after region, time and value
+SCORE_COLUMNS = [
+    "predicted_usage",
+    "residual",
+    "if_score",
+    "residual_z",
+    "night_flow_z",
+    "combined_risk_score",
+    "is_anomaly_ml",
+]
+HIGH_RISK = 70
+
+_model = None
+
+
+def fingerprint(path: str) -> dict:
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def check_format(fmt: str):
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown output format '{fmt}', expected one of {FORMATS}")
+    if fmt == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            try:
+                import fastparquet  # noqa: F401
+            except ImportError:
+                raise ValueError(
+                    "Parquet output requires pyarrow or fastparquet; use --format npz"
+                ) from None
+
+
+def plan_partitions(path: str, partition_rows: int, chunksize: int) -> list:
+    """Pack whole regions (sorted by name) into partitions of about partition_rows rows"""
+    counts = pd.Series(dtype=np.int64)
+    for chunk in pd.read_csv(path, usecols=["region"], dtype={"region": str}, chunksize=chunksize):
+        counts = counts.add(chunk["region"].value_counts(), fill_value=0)
+    partitions, regions, rows = [], [], 0
+    for region, n in counts.sort_index().items():
+        regions.append(region)
+        rows += int(n)
+        if rows >= partition_rows:
+            partitions.append({"id": len(partitions), "regions": regions, "rows": rows})
+            regions, rows = [], 0
+    if regions:
+        partitions.append({"id": len(partitions), "regions": regions, "rows": rows})
+    return partitions
+
+
+def spill_partitions(path: str, partitions: list, work_dir: Path, chunksize: int):
+    """Stream the CSV once, appending each row to its partition's spill file"""
+    if work_dir.exists():
+        shutil.rmtree(work_dir)
+    work_dir.mkdir(parents=True)
+    partition_of = {region: p["id"] for p in partitions for region in p["regions"]}
+    written = set()
+    for chunk in pd.read_csv(path, dtype={"region": str}, chunksize=chunksize):
+        ids = chunk["region"].map(partition_of)
+        for pid, rows in chunk.groupby(ids.to_numpy()):
+            pid = int(pid)
+            rows.to_csv(spill_path(work_dir, pid), mode="a", header=pid not in written, index=False)
+            written.add(pid)
+
+
+def spill_path(work_dir: Path, pid: int) -> Path:
+    return Path(work_dir) / f"partition-{pid:05d}.csv"
+
+
+def part_path(out_dir: Path, pid: int, fmt: str) -> Path:
+    return Path(out_dir) / f"part-{pid:05d}.{fmt}"
+
+
+def _init_worker(model_path: str):
+    global _model
+    from app.services.improved_model import load_model_store
+
+    _model = load_model_store(model_path)
+
+
+def score_partition(task: dict) -> dict:
+    """Score every region of one spill file and write its part; runs in a worker process"""
+    from app.services.hourly_model import HOURLY_TIME, HOURLY_VALUE
+
+    started = time.perf_counter()
+    hourly = _model.model_type == "hourly"
+    time_column, value_column = (HOURLY_TIME, HOURLY_VALUE) if hourly else ("date", "daily_usage")
+    df = pd.read_csv(task["spill"], dtype={"region": str})
+    frame = df if hourly else _model.preprocess(df)
+
+    results, skipped = [], []
+    for region, rows in frame.groupby("region", observed=True, sort=True):
+        if region not in _model.models:
+            skipped.append(region)
+            continue
+        results.append(_model.predict_and_detect_anomalies(rows, region))
+
+    columns = ["region", time_column, value_column]
+    if results:
+        scored = pd.concat(results, ignore_index=True)
+        columns += [c for c in SCORE_COLUMNS if c in scored]
+        scored = scored[columns]
+    else:
+        scored = pd.DataFrame({c: [] for c in columns + ["predicted_usage", "combined_risk_score"]})
+    scored["is_high_risk"] = scored["combined_risk_score"] >= HIGH_RISK
+    write_part(scored, task["part"], task["format"])
+    return {
+        "id": task["id"],
+        "rows": len(scored),
+        "regions": len(results),
+        "skipped_regions": skipped,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def write_part(scored: pd.DataFrame, path: str, fmt: str):
+    """Write result columns atomically (temporary file, then rename)"""
+    path = Path(path)
+    partial = path.with_name(f"{path.name}.{os.getpid()}.partial")
+    if fmt == "parquet":
+        scored.to_parquet(partial, index=False)
+    else:
+        arrays = {}
+        for name, column in scored.items():
+            values = column.to_numpy()
+            # Strings as fixed-width unicode, so the file loads without pickle
+            arrays[name] = values.astype(str) if values.dtype == object else values
+        with open(partial, "wb") as f:
+            np.savez(f, **arrays)
+    os.replace(partial, path)
+
+
+def load_scores(out_dir: str) -> pd.DataFrame:
+    """Concatenate the finished parts of a batch-scoring run, in partition order"""
+    out_dir = Path(out_dir)
+    with open(out_dir / MANIFEST) as f:
+        manifest = json.load(f)
+    frames = []
+    for pid in sorted(int(p) for p in manifest["done"]):
+        path = part_path(out_dir, pid, manifest["format"])
+        if manifest["format"] == "parquet":
+            frames.append(pd.read_parquet(path))
+        else:
+            with np.load(path) as part:
+                frames.append(pd.DataFrame({name: part[name] for name in part.files}))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+class BatchScoringRun:
+    def __init__(self, data_path: str, out_dir: str, model_path: str, fmt: str = "npz",
+                 partition_rows: int = 500_000, chunksize: int = 1_000_000, workers: int = None):
+        self.data_path = data_path
+        self.out_dir = Path(out_dir)
+        self.model_path = model_path
+        self.format = fmt
+        self.partition_rows = partition_rows
+        self.chunksize = chunksize
+        self.workers = workers or os.cpu_count() or 1
+        self.manifest_path = self.out_dir / MANIFEST
+        self.manifest = None
+
+    def _identity(self) -> dict:
+        return {
+            "input": fingerprint(self.data_path),
+            "model": fingerprint(self.model_path),
+            "format": self.format,
+            "partition_rows": self.partition_rows,
+        }
+
+    def prepare(self, restart: bool = False):
+        """Load the checkpoint of an interrupted run of the same job, or plan a new one"""
+        check_format(self.format)
+        identity = self._identity()
+        if restart and self.out_dir.exists():
+            shutil.rmtree(self.out_dir)
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if {k: manifest.get(k) for k in identity} != identity:
+                raise ValueError(
+                    f"{self.out_dir} holds a run of a different input, model or format; "
+                    "pass --restart to discard it"
+                )
+            self.manifest = manifest
+            # Parts written after the last checkpoint are simply scored again
+            self.manifest["done"] = {
+                pid: stats for pid, stats in manifest["done"].items()
+                if part_path(self.out_dir, int(pid), self.format).exists()
+            }
+        else:
+            self.out_dir.mkdir(parents=True, exist_ok=True)
+            self.manifest = {**identity, "partitions": None, "spilled": False, "done": {},
+                             "completed_at": None}
+        if self.manifest["partitions"] is None:
+            self.manifest["partitions"] = plan_partitions(
+                self.data_path, self.partition_rows, self.chunksize
+            )
+            self.save()
+        pending = self.pending()
+        spilled = self.manifest["spilled"] and all(
+            spill_path(self.out_dir / WORK_DIR, p["id"]).exists() for p in pending
+        )
+        if pending and not spilled:
+            spill_partitions(self.data_path, self.manifest["partitions"],
+                             self.out_dir / WORK_DIR, self.chunksize)
+            self.manifest["spilled"] = True
+            self.save()
+
+    def save(self):
+        partial = self.manifest_path.with_name(f"{MANIFEST}.partial")
+        with open(partial, "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(partial, self.manifest_path)
+
+    def pending(self) -> list:
+        return [p for p in self.manifest["partitions"] if str(p["id"]) not in self.manifest["done"]]
+
+    def run(self, time_budget: float = None) -> bool:
+        """Score pending partitions; True once every partition is done"""
+        started = time.monotonic()
+        pending = self.pending()
+        durations = []
+        tasks = {
+            p["id"]: {
+                "id": p["id"],
+                "spill": str(spill_path(self.out_dir / WORK_DIR, p["id"])),
+                "part": str(part_path(self.out_dir, p["id"], self.format)),
+                "format": self.format,
+            }
+            for p in pending
+        }
+
+        def within_budget():
+            if time_budget is None:
+                return True
+            expected = np.mean(durations) if durations else 0.0
+            return time.monotonic() - started + expected <= time_budget
+
+        pool = ProcessPoolExecutor(
+            min(self.workers, max(len(pending), 1)), mp_context=get_context("spawn"),
+            initializer=_init_worker, initargs=(self.model_path,),
+        )
+        running = {}
+        try:
+            while pending or running:
+                while pending and len(running) < self.workers and within_budget():
+                    partition = pending.pop(0)
+                    running[pool.submit(score_partition, tasks[partition["id"]])] = time.monotonic()
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    submitted = running.pop(future)
+                    stats = future.result()
+                    durations.append(time.monotonic() - submitted)
+                    self.manifest["done"][str(stats["id"])] = stats
+                    self.save()
+                    print(f"Partition {stats['id']}: {stats['rows']} rows, {stats['regions']} regions "
+                          f"in {stats['seconds']:.1f}s ({len(self.manifest['done'])}/"
+                          f"{len(self.manifest['partitions'])})")
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+        complete = not self.pending()
+        if complete:
+            self.manifest["completed_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            self.save()
+            shutil.rmtree(self.out_dir / WORK_DIR, ignore_errors=True)
+        return complete
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a history CSV with a saved model store")
+    parser.add_argument("--data", default="data/water_consumption_cleaned.csv")
+    parser.add_argument("--model", default="models/aquaguard_model.pkl")
+    parser.add_argument("--out", default="outputs/scores")
+    parser.add_argument("--format", choices=FORMATS, default="npz")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--partition-rows", type=int, default=500_000)
+    parser.add_argument("--chunksize", type=int, default=1_000_000, help="CSV rows read at a time")
+    parser.add_argument("--time-budget", type=float, default=None,
+                        help="Seconds; stop starting partitions that would overrun it")
+    parser.add_argument("--restart", action="store_true", help="Discard a previous run in --out")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    run = BatchScoringRun(args.data, args.out, args.model, args.format, args.partition_rows,
+                          args.chunksize, args.workers)
+    try:
+        run.prepare(args.restart)
+    except ValueError as e:
+        parser.error(str(e))
+    done = len(run.manifest["done"])
+    print(f"{len(run.manifest['partitions'])} partitions, {done} already done; "
+          f"prepared in {time.perf_counter() - started:.1f}s")
+
+    complete = run.run(args.time_budget)
+    stats = run.manifest["done"].values()
+    rows = sum(s["rows"] for s in stats)
+    skipped = sorted(r for s in stats for r in s["skipped_regions"])
+    if skipped:
+        print(f"Skipped {len(skipped)} regions without a trained model, e.g. {skipped[:5]}")
+    seconds = time.perf_counter() - started
+    print(f"{rows} rows scored to {args.out} in {seconds:.1f}s")
+    if not complete:
+        print(f"Time budget reached with {len(run.pending())} partitions left; rerun to resume")
+        sys.exit(INCOMPLETE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""Dense regions × calendar days (or hours) layout of the history.
+
+Row i of `usage` is region i and column j is the period start + j (a day,
+or an hour for freq="h"). Periods without a reading are NaN and False in
+`observed`, so a lag is a shift along the time axis and always lines up
+by date, whatever gaps the source has (a row-wise shift(7) silently
+reaches back further after a gap). Rolling windows are differences of
+cumulative sums, and region rows and date ranges are views, not copies.
+Hourly grids start at midnight and cover whole days, so by_day() is a
+(regions, days, 24) view.
+
+Gap-fill policies only change the values lags and rolling windows see;
+filled days are never reported as readings.
+"""
+import numpy as np
+import pandas as pd
+
+GAP_FILL_POLICIES = ("none", "ffill", "interpolate", "seasonal", "zero")
+# Supported column frequencies and the number of columns per day
+PERIODS_PER_DAY = {"D": 1, "h": 24}
+
+
+def _ffill(values, observed):
+    """Carry the last observed value forward along the last axis"""
+    columns = np.where(observed, np.arange(values.shape[-1]), 0)
+    np.maximum.accumulate(columns, axis=-1, out=columns)
+    return np.take_along_axis(values, columns, axis=-1)
+
+
+def _interpolate(values, observed):
+    """Linear interpolation between the observed days around each interior gap"""
+    n = values.shape[-1]
+    columns = np.arange(n)
+    before = np.maximum.accumulate(np.where(observed, columns, -1), axis=-1)
+    after = np.minimum.accumulate(np.where(observed, columns, n)[:, ::-1], axis=-1)[:, ::-1]
+    inner = ~observed & (before >= 0) & (after < n)
+    low = np.take_along_axis(values, np.clip(before, 0, n - 1), axis=-1)
+    high = np.take_along_axis(values, np.clip(after, 0, n - 1), axis=-1)
+    weight = (columns - before) / np.where(inner, after - before, 1)
+    return np.where(inner, low + (high - low) * weight, values)
+
+
+class CalendarGrid:
+    def __init__(self, regions, start, usage: np.ndarray, observed: np.ndarray = None,
+                 freq: str = "D"):
+        if freq not in PERIODS_PER_DAY:
+            raise ValueError(f"Unsupported grid frequency: {freq}")
+        self.regions = pd.Index(regions)
+        # Nanosecond dates, like the rest of the history and shared state
+        self.start = pd.Timestamp(start).as_unit("ns") if start is not None else None
+        self.usage = usage
+        self.observed = ~np.isnan(usage) if observed is None else observed
+        self.freq = freq
+        self._rows = {region: i for i, region in enumerate(self.regions)}
+
+    @classmethod
+    def allocate(cls, regions, start, end, freq: str = "D", dtype=np.float64) -> "CalendarGrid":
+        """Empty (all-gap) grid covering [start, end]; hourly grids are widened to whole days"""
+        start = pd.Timestamp(start).floor(freq)
+        end = pd.Timestamp(end).floor(freq)
+        if freq != "D":
+            start = start.normalize()
+            end = end.normalize() + pd.Timedelta(days=1) - pd.Timedelta(1, unit=freq)
+        periods = int((end - start) / pd.Timedelta(1, unit=freq)) + 1
+        usage = np.full((len(regions), periods), np.nan, dtype=dtype)
+        return cls(regions, start, usage, np.zeros(usage.shape, dtype=bool), freq)
+
+    @classmethod
+    def from_frame(cls, df, regions=None, time: str = "date", value: str = "daily_usage",
+                   freq: str = "D", dtype=np.float64):
+        """Scatter (region, time, value) rows into a grid spanning their first to last period
+
+        Rows of regions not in `regions` are dropped; for a repeated
+        (region, period) the last row wins.
+        """
+        if regions is None:
+            regions = sorted(pd.unique(df["region"].astype(str)))
+        times = pd.to_datetime(df[time])
+        if not len(times):
+            return cls(regions, None, np.empty((len(regions), 0), dtype=dtype), freq=freq)
+        grid = cls.allocate(regions, times.min(), times.max(), freq, dtype)
+        grid.scatter(df, time, value)
+        return grid
+
+    @classmethod
+    def from_csv(cls, path: str, time: str = "date", value: str = "daily_usage", freq: str = "D",
+                 dtype=np.float64, chunksize: int = 1_000_000) -> "CalendarGrid":
+        """Read a long CSV into a grid in chunks; memory is the grid plus one chunk
+
+        A first pass over the region and time columns sizes the grid and
+        a second one scatters the values.
+        """
+        regions, first, last = set(), None, None
+        for chunk in pd.read_csv(path, usecols=["region", time], chunksize=chunksize):
+            times = pd.to_datetime(chunk[time])
+            regions.update(chunk["region"].astype(str).unique())
+            first = times.min() if first is None else min(first, times.min())
+            last = times.max() if last is None else max(last, times.max())
+        if first is None:
+            return cls([], None, np.empty((0, 0), dtype=dtype), freq=freq)
+        grid = cls.allocate(sorted(regions), first, last, freq, dtype)
+        for chunk in pd.read_csv(path, usecols=["region", time, value], chunksize=chunksize):
+            grid.scatter(chunk, time, value)
+        return grid
+
+    def scatter(self, df, time: str = "date", value: str = "daily_usage"):
+        """Write rows into the grid in place; rows outside it (or of unknown regions) are dropped"""
+        codes = pd.Categorical(df["region"].astype(str), categories=self.regions).codes
+        step = np.timedelta64(1, self.freq)
+        times = pd.to_datetime(df[time]).to_numpy(dtype="datetime64[ns]")
+        columns = (times - self.start.to_datetime64()) // step
+        keep = (codes >= 0) & ~np.isnat(times) & (columns >= 0) & (columns < self.periods)
+        codes, columns = codes[keep], columns[keep]
+        self.usage[codes, columns] = df[value].to_numpy(dtype=np.float64)[keep]
+        self.observed[codes, columns] = ~np.isnan(self.usage[codes, columns])
+
+    @property
+    def periods(self) -> int:
+        return self.usage.shape[1]
+
+    @property
+    def per_day(self) -> int:
+        return PERIODS_PER_DAY[self.freq]
+
+    @property
+    def dates(self) -> pd.DatetimeIndex:
+        """Timestamps of the columns"""
+        if self.start is None:
+            return pd.DatetimeIndex([], dtype="datetime64[ns]")
+        return pd.date_range(self.start, periods=self.periods, freq=self.freq)
+
+    @property
+    def nbytes(self) -> int:
+        return self.usage.nbytes + self.observed.nbytes
+
+    def column(self, date) -> int:
+        return int((pd.Timestamp(date) - self.start) // pd.Timedelta(1, unit=self.freq))
+
+    def row(self, region) -> int:
+        return self._rows[region]
+
+    def region(self, region) -> np.ndarray:
+        """A region's usage per period (NaN on gaps), as a view"""
+        return self.usage[self._rows[region]]
+
+    def _view(self, rows, columns=slice(None), start=None) -> "CalendarGrid":
+        return CalendarGrid(self.regions[rows], self.start if start is None else start,
+                            self.usage[rows, columns], self.observed[rows, columns], self.freq)
+
+    def take(self, regions) -> "CalendarGrid":
+        """Grid of some regions; a view when they are one contiguous run of rows"""
+        rows = [self._rows[r] for r in regions]
+        if rows and rows == list(range(rows[0], rows[0] + len(rows))):
+            rows = slice(rows[0], rows[0] + len(rows))
+        return self._view(rows)
+
+    def blocks(self, size: int):
+        """Views of consecutive runs of at most `size` regions"""
+        for lo in range(0, len(self.regions), size):
+            yield self._view(slice(lo, lo + size))
+
+    def between(self, start=None, end=None) -> "CalendarGrid":
+        """Grid of the periods in [start, end], as a view"""
+        lo = 0 if start is None else min(max(self.column(start), 0), self.periods)
+        hi = self.periods if end is None else min(max(self.column(end) + 1, lo), self.periods)
+        first = self.start + pd.Timedelta(lo, unit=self.freq) if self.start is not None else None
+        return self._view(slice(None), slice(lo, hi), first)
+
+    def by_day(self, values: np.ndarray = None) -> np.ndarray:
+        """Usage (or another array of the grid's shape) as a (regions, days, periods per day) view"""
+        values = self.usage if values is None else values
+        return values.reshape(values.shape[0], -1, self.per_day)
+
+    def filled(self, policy: str = "none") -> "CalendarGrid":
+        """Grid whose gaps are filled by a policy (observed periods and the mask are unchanged)
+
+        none leaves gaps as NaN, ffill carries the last reading forward,
+        interpolate fills interior gaps linearly, seasonal repeats the same
+        period of the previous week and zero fills with 0.
+        """
+        if policy not in GAP_FILL_POLICIES:
+            raise ValueError(f"Unknown gap-fill policy: {policy}")
+        if policy == "none" or self.observed.all():
+            return self
+        if policy == "ffill":
+            usage = _ffill(self.usage, self.observed)
+        elif policy == "interpolate":
+            usage = _interpolate(self.usage, self.observed)
+        elif policy == "seasonal":
+            usage = self.usage.copy()
+            week = 7 * self.per_day
+            for phase in range(week):
+                # Every week-th column is the same period of the week; the strided views fill in place
+                usage[:, phase::week] = _ffill(usage[:, phase::week], self.observed[:, phase::week])
+        else:
+            usage = np.where(self.observed, self.usage, 0.0)
+        return CalendarGrid(self.regions, self.start, usage, self.observed, self.freq)
+
+    def lag(self, periods: int) -> np.ndarray:
+        """Usage `periods` columns earlier (NaN before the first one)"""
+        lagged = np.full_like(self.usage, np.nan)
+        if periods < self.periods:
+            lagged[:, periods:] = self.usage[:, :self.periods - periods]
+        return lagged
+
+    def _window_sums(self, window: int):
+        """Count, sum and sum of squares over the trailing window, ignoring NaN"""
+        present = ~np.isnan(self.usage)
+        values = np.where(present, self.usage, 0.0)
+        # Centered per region so the running sums of squares keep their precision
+        center = values.sum(axis=1, keepdims=True) / np.maximum(present.sum(axis=1, keepdims=True), 1)
+        values = np.where(present, values - center, 0.0)
+        lo = np.maximum(np.arange(1, self.periods + 1) - window, 0)
+        sums = []
+        for series in (present.astype(np.float64), values, values * values):
+            cumulative = np.zeros((series.shape[0], series.shape[1] + 1))
+            np.cumsum(series, axis=1, out=cumulative[:, 1:])
+            sums.append(cumulative[:, 1:] - cumulative[:, lo])
+        return sums[0], sums[1], sums[2], center
+
+    def rolling_mean(self, window: int, min_periods: int = 1) -> np.ndarray:
+        count, total, _, center = self._window_sums(window)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(count >= min_periods, total / count + center, np.nan)
+
+    def rolling_std(self, window: int, min_periods: int = 2) -> np.ndarray:
+        """Sample standard deviation (ddof=1) over the trailing window"""
+        count, total, squares, _ = self._window_sums(window)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = (squares - total * total / count) / (count - 1)
+            return np.where(count >= max(min_periods, 2), np.sqrt(np.maximum(variance, 0.0)), np.nan)
+
+    def last_dates(self) -> pd.Series:
+        """Newest observed period per region (NaT for regions without readings)"""
+        last = self.periods - 1 - np.argmax(self.observed[:, ::-1], axis=1)
+        dates = np.full(len(self.regions), np.datetime64("NaT"), dtype="datetime64[ns]")
+        has_any = self.observed.any(axis=1)
+        if has_any.any():
+            dates[has_any] = self.start.to_datetime64() + last[has_any].astype(f"timedelta64[{self.freq}]")
+        return pd.Series(dates, index=self.regions)
+
+    def means(self) -> np.ndarray:
+        """Mean observed usage per region (NaN for regions without readings)"""
+        total = np.where(self.observed, self.usage, 0.0).sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return total / self.observed.sum(axis=1)
+
+    def feature_frame(self, gap_fill: str = "none") -> pd.DataFrame:
+        """Long frame of the observed days with the calendar, lag and rolling features
+
+        Rows are ordered by region, then date; dtypes follow
+        ImprovedAquaGuardModel.preprocess (float32 usage, int8 calendar
+        fields, categorical region). Needs a daily grid.
+        """
+        if self.freq != "D":
+            raise ValueError("Daily features need a daily grid")
+        source = self.filled(gap_fill)
+        rows, columns = np.nonzero(self.observed)
+        dates = self.dates
+        day_of_week = dates.dayofweek.to_numpy().astype(np.int8)
+
+        def gather(grid_values):
+            return grid_values[rows, columns].astype(np.float32)
+
+        return pd.DataFrame({
+            "region": pd.Categorical.from_codes(rows, categories=self.regions),
+            "date": dates[columns],
+            "daily_usage": gather(self.usage),
+            "day_of_week": day_of_week[columns],
+            "month": dates.month.to_numpy().astype(np.int8)[columns],
+            "day_of_month": dates.day.to_numpy().astype(np.int8)[columns],
+            "is_weekend": (day_of_week >= 5).astype(np.int8)[columns],
+            "prev_day_usage": gather(source.lag(1)),
+            "prev_week_usage": gather(source.lag(7)),
+            "rolling_mean_7d": gather(source.rolling_mean(7)),
+            "rolling_std_7d": gather(source.rolling_std(7)),
+        })
+
+    def region_frame(self, region, gap_fill: str = "none") -> pd.DataFrame:
+        """Feature frame of one region, as predict_and_detect_anomalies expects it"""
+        frame = self.take([region]).feature_frame(gap_fill)
+        frame["region"] = pd.Categorical.from_codes(
+            np.full(len(frame), self._rows[region]), categories=self.regions
+        )
+        return frame
@@ -1,10 +1,94 @@
 import pandas as pd
 from datetime import datetime, timedelta
+import argparse
+import json
+import os
 import random
 import math
+import numpy as np
+import threading
+from app.metrics import simulator_tick_duration, timer
+from app.services.alerting import ELEVATED, RESOLVING, AlertEngine
+from app.services.live_buffer import LiveHistory
+from app.services.online_detector import OnlineAnomalyDetector
+from app.services.water_balance import DEFAULT_INFLOW_PATH, DEFAULT_TOPOLOGY_PATH, load_topology
+from app.services.window_stats import WindowAggregator, WindowStats
+
+def hour_factor(hour):
+    """Time-of-day usage multiplier, lowest at night; hour may be a NumPy array"""
+    hour_angle = (np.asarray(hour) - 6) * np.pi / 12
+    return 0.7 + 0.3 * (np.sin(hour_angle) + 1) / 2  # Smoother curve
+
+
+def default_topology(regions) -> dict:
+    """Supply topology config with one district meter per region below a single main meter"""
+    districts = {f"DMA {region}": {"regions": [region]} for region in regions}
+    return {"meters": {"Main": {"meters": list(districts)}, **districts}}
+
+
+def meter_losses(topology, loss_rate: float, seed: int) -> np.ndarray:
+    """Background loss fraction of every meter's own area, varied around loss_rate"""
+    rng = np.random.default_rng(seed)
+    return loss_rate * rng.lognormal(0.0, 0.25, len(topology.meters))
+
+
+def simulate_inflow(topology, consumption, loss_rate: float = 0.12, noise: float = 0.01,
+                    leaks=(), seed: int = 42) -> pd.DataFrame:
+    """Daily meter inflow consistent with a consumption CalendarGrid, as (meter, date, inflow)
+
+    Each meter's own area (the regions it feeds directly) draws its
+    consumption plus a background loss, and a meter measures its own area
+    and everything nested below it: inflow = S @ (own * (1 + loss) + leak),
+    with `noise` relative meter error. leaks are (meter, first date, flow
+    as a fraction of the meter's own mean consumption); a leak adds to its
+    meter and every meter upstream of it.
+    """
+    rng = np.random.default_rng(seed + 1)
+    usage = np.nan_to_num(consumption.filled("ffill").usage)
+    own = np.asarray(topology.feeds_for(consumption.regions) @ usage)
+    own *= 1.0 + meter_losses(topology, loss_rate, seed)[:, None]
+    for meter, start, fraction in leaks:
+        row = topology.meter_index[meter]
+        first = max(consumption.column(start), 0)
+        own[row, first:] += fraction * own[row].mean()
+    inflow = np.asarray(topology.rollup(own))
+    inflow *= 1.0 + rng.normal(0.0, noise, inflow.shape)
+    return pd.DataFrame({
+        "meter": np.repeat(topology.meters, consumption.periods),
+        "date": np.tile(consumption.dates.strftime("%Y-%m-%d").to_numpy(), len(topology.meters)),
+        "inflow": np.round(inflow.ravel(), 2),
+    })
+
+
+class LiveSnapshot:
+    """Everything the /live endpoints serve for one tick; never mutated once published"""
+
+    __slots__ = ("tick", "taken_at", "regions", "readings", "by_region", "episodes", "alerts",
+                 "windows", "inflow")
+
+    def __init__(self, tick: int, taken_at: datetime, readings: tuple, episodes: dict,
+                 alerts: tuple, windows: WindowStats = None, inflow: tuple = ()):
+        self.tick = tick
+        self.taken_at = taken_at
+        self.readings = readings
+        self.regions = tuple(r["region"] for r in readings)
+        self.by_region = {r["region"]: r for r in readings}
+        self.episodes = episodes
+        self.alerts = alerts
+        self.windows = windows if windows is not None else WindowStats((), {})
+        self.inflow = inflow
+
 
 class WaterDataSimulator:
-    """Simulates real-time water consumption data with risk scenarios"""
+    """Simulates real-time water consumption data with risk scenarios
+
+    A single writer thread (start()) advances every region once per tick
+    and publishes the result as a new LiveSnapshot. Readers only fetch the
+    latest snapshot reference (latest()), which needs no lock, so requests
+    never race the writer and all of them see one consistent tick. The one
+    exception is /live/history, which copies from the per-region ring
+    buffers under their locks.
+    """
     
     def __init__(self):
         self.regions = ["North", "South", "East", "West", "Central"]
@@ -23,6 +107,24 @@ class WaterDataSimulator:
         # Store previous values for smoother transitions
         self.previous_risk_scores = {}
         self.previous_consumption = {}
+        # Per-reading anomaly flags, updated in constant time as readings arrive
+        self.anomaly_detector = OnlineAnomalyDetector()
+        # Elevated-risk episodes, driven by the risk score of every reading
+        self.alert_engine = AlertEngine()
+        # Shared server-side history of recent readings for /live/history
+        self.history = LiveHistory()
+        # Sliding-window risk statistics (peak, mean, persistence) for /live/ranking
+        self.risk_windows = WindowAggregator()
+        # Supply meters upstream of the regions (see water_balance), if configured
+        self.supply = load_topology()
+        self.meter_loss = meter_losses(self.supply, 0.12, 42) if self.supply is not None else None
+        # Active leaks upstream of the regions' meters: meter -> {"flow", "start_time", "duration_hours"}
+        self.meter_leaks = {}
+        # Durable log of readings and transitions (see attach_event_log)
+        self.event_log = None
+        self._snapshot = LiveSnapshot(0, datetime.now(), (), {}, ())
+        self._stop = threading.Event()
+        self._thread = None
         # Initialize some regions with elevated risk for demo
         self._initialize_demo_risks()
         
@@ -50,6 +152,13 @@ class WaterDataSimulator:
             "type": "gradual"
         }
         
+        # Open their episodes in the alert engine straight away, starting the
+        # smoothed risk at the scenario's level
+        for region, risk in (("East", 75.0), ("West", 60.0)):
+            self.previous_risk_scores[region] = risk
+            for _ in range(self.alert_engine.confirm_readings):
+                self.alert_engine.observe(region, risk, now, self.elevated_risk_periods[region])
+
         # Initialize last check times
         for region in self.regions:
             self.last_risk_check[region] = now - timedelta(hours=random.randint(1, 6))
@@ -59,8 +168,7 @@ class WaterDataSimulator:
         base = self.base_consumption[region]
         
         # Daily pattern (higher during day, lower at night) - more gradual
-        hour_angle = (timestamp.hour - 6) * math.pi / 12
-        hour_factor = 0.7 + 0.3 * (math.sin(hour_angle) + 1) / 2  # Smoother curve
+        time_of_day = float(hour_factor(timestamp.hour))
         
         # Weekly pattern (higher on weekdays)
         weekday_factor = 1.05 if timestamp.weekday() < 5 else 0.95
@@ -72,7 +180,7 @@ class WaterDataSimulator:
         # Random noise (smaller for more realistic data)
         noise = random.uniform(0.98, 1.02)  # Only 2% variation
         
-        result = base * hour_factor * weekday_factor * minute_variation * second_variation * noise
+        result = base * time_of_day * weekday_factor * minute_variation * second_variation * noise
         return max(result, base * 0.4)  # Ensure reasonable minimum
     
     def simulate_elevated_risk(self, region: str, risk_type: str = "gradual") -> dict:
@@ -102,9 +210,8 @@ class WaterDataSimulator:
                 "severity": "high"
             }
     
-    def get_current_consumption(self, region: str) -> dict:
-        """Get current consumption for a region (simulates real sensor reading)"""
-        now = datetime.now()
+    def _advance_region(self, region: str, now: datetime) -> dict:
+        """Produce the region's next reading (simulates real sensor reading); writer thread only"""
         normal_consumption = self.generate_normal_consumption(region, now)
         consumption = normal_consumption  # Default value
         
@@ -121,7 +228,6 @@ class WaterDataSimulator:
                 # Risk period ended
                 del self.elevated_risk_periods[region]
                 consumption = normal_consumption
-                risk_status = "normal"
                 risk_score = random.uniform(15, 35)  # Low risk
             else:
                 # Apply risk effect
@@ -157,11 +263,8 @@ class WaterDataSimulator:
                 # Ensure risk score doesn't drop too low during elevated periods
                 risk_score = max(risk_score, 45 if risk_period["severity"] == "high" else 
                                35 if risk_period["severity"] == "medium" else 25)
-                
-                risk_status = "elevated"
         else:
             consumption = normal_consumption
-            risk_status = "normal"
             # Add realistic variation to normal risk scores
             base_normal_risk = random.uniform(15, 35)
             time_variation = 5 * math.sin(now.minute * math.pi / 30)  # Gradual changes
@@ -184,7 +287,6 @@ class WaterDataSimulator:
                         "start_time": now,
                         "type": risk_type
                     }
-                    risk_status = "new_elevation"
         
         # Smooth transitions using previous values
         if region in self.previous_risk_scores:
@@ -199,6 +301,30 @@ class WaterDataSimulator:
         self.previous_risk_scores[region] = risk_score
         self.previous_consumption[region] = consumption
         
+        anomaly_score, is_anomaly = self.anomaly_detector.update(region, consumption)
+        previous_state = self.alert_engine.state_of(region)
+        alert_state = self.alert_engine.observe(
+            region, risk_score, now, self.elevated_risk_periods.get(region)
+        )
+        # The reading's status follows the alert engine, so it agrees with /live/elevated
+        if alert_state == ELEVATED and previous_state not in (ELEVATED, RESOLVING):
+            risk_status = "new_elevation"
+        elif alert_state in (ELEVATED, RESOLVING):
+            risk_status = "elevated"
+        else:
+            risk_status = "normal"
+
+        self.history.append(region, now.timestamp(), consumption, risk_score, risk_status)
+        self.risk_windows.add(region, now.timestamp(), risk_score)
+        if self.event_log is not None:
+            self.event_log.append("reading", {
+                "region": region,
+                "timestamp": now.isoformat(),
+                "consumption": consumption,
+                "risk_score": risk_score,
+                "risk_status": risk_status,
+            }, now.timestamp())
+
         # Prepare risk_info with serializable data
         risk_info = self.elevated_risk_periods.get(region, {})
         if risk_info and "start_time" in risk_info:
@@ -213,12 +339,213 @@ class WaterDataSimulator:
             "consumption": round(consumption, 2),
             "risk_status": risk_status,
             "risk_score": round(risk_score, 1),
+            "anomaly_score": round(anomaly_score, 2),
+            "is_anomaly": bool(is_anomaly),
+            "alert_state": alert_state,
             "risk_info": risk_info_serializable
         }
     
+    def snapshot_state(self) -> dict:
+        """Detector, alert and smoothing state, for event log snapshots"""
+        return {
+            "previous_risk_scores": dict(self.previous_risk_scores),
+            "previous_consumption": dict(self.previous_consumption),
+            "anomaly_detector": self.anomaly_detector.snapshot(),
+            "alert_engine": self.alert_engine.snapshot(),
+        }
+
+    def attach_event_log(self, event_log):
+        """Recover state from the log (snapshot + replay), then log new events to it"""
+        snapshot, records = event_log.recover()
+        if snapshot is not None:
+            self.previous_risk_scores.update(snapshot["previous_risk_scores"])
+            self.previous_consumption.update(snapshot["previous_consumption"])
+            self.anomaly_detector.restore(snapshot["anomaly_detector"])
+            self.alert_engine.restore(snapshot["alert_engine"])
+
+        replayed = 0
+        for record in records:
+            if record["kind"] != "reading":
+                continue
+            reading = record["data"]
+            region = reading["region"]
+            self.anomaly_detector.update(region, reading["consumption"])
+            self.alert_engine.observe(
+                region, reading["risk_score"], datetime.fromisoformat(reading["timestamp"])
+            )
+            self.previous_risk_scores[region] = reading["risk_score"]
+            self.previous_consumption[region] = reading["consumption"]
+            replayed += 1
+        print(f"Event log recovered: snapshot={'yes' if snapshot else 'no'}, replayed {replayed} readings")
+
+        # Refill the live history buffers and risk windows from the logged readings
+        for record in event_log.tail(hours=24, kinds={"reading"}):
+            reading = record["data"]
+            buffer = self.history.get(reading["region"])
+            if buffer is not None and record["ts"] <= buffer.last_timestamp:
+                continue
+            self.history.append(
+                reading["region"], record["ts"], reading["consumption"],
+                reading["risk_score"], reading["risk_status"]
+            )
+            self.risk_windows.add(reading["region"], record["ts"], reading["risk_score"])
+
+        self.event_log = event_log
+        self.alert_engine.subscribe(self._log_transition)
+        event_log.start()
+
+    def detach_event_log(self):
+        """Write a final snapshot and close the log; call after stop()"""
+        if self.event_log is None:
+            return
+        self.alert_engine.unsubscribe(self._log_transition)
+        self.event_log.snapshot(self.snapshot_state)
+        self.event_log.close()
+        self.event_log = None
+
+    def _log_transition(self, event):
+        self.event_log.append("transition", event)
+
+    def _advance_meters(self, readings: tuple, now: datetime) -> tuple:
+        """Inflow of every supply meter, consistent with this tick's readings; writer thread only
+
+        Each meter's own area draws its regions' consumption plus a
+        background loss; occasionally a leak adds 5-20% of that for a few
+        hours to a day, visible on the meter and every meter upstream.
+        """
+        topology = self.supply
+        if topology is None:
+            return ()
+        consumption = np.zeros(len(topology.regions))
+        for reading in readings:
+            column = topology.region_index.get(reading["region"])
+            if column is not None:
+                consumption[column] = reading["consumption"]
+        own = topology.feeds @ consumption
+        downstream = topology.rollup(own)
+        own = own * (1.0 + self.meter_loss)
+
+        for meter, leak in list(self.meter_leaks.items()):
+            if (now - leak["start_time"]).total_seconds() / 3600 > leak["duration_hours"]:
+                del self.meter_leaks[meter]
+        if random.random() < 0.001:
+            meter = random.choice(topology.meters)
+            self.meter_leaks.setdefault(meter, {
+                "flow": random.uniform(0.05, 0.2),
+                "start_time": now,
+                "duration_hours": random.randint(4, 24),
+            })
+        for meter, leak in self.meter_leaks.items():
+            row = topology.meter_index[meter]
+            own[row] += leak["flow"] * own[row]
+
+        inflow = topology.rollup(own) * (1.0 + np.random.normal(0.0, 0.005, len(own)))
+        imbalance = inflow - downstream
+        return tuple(
+            {
+                "meter": meter,
+                "timestamp": now.isoformat(),
+                "inflow": round(float(inflow[i]), 2),
+                "consumption": round(float(downstream[i]), 2),
+                "imbalance": round(float(imbalance[i]), 2),
+                "nrw_ratio": round(float(imbalance[i] / inflow[i]), 4) if inflow[i] > 0 else None,
+                "leak": meter in self.meter_leaks,
+            }
+            for i, meter in enumerate(topology.meters)
+        )
+
+    # -- single writer ---------------------------------------------------------
+
+    def tick(self) -> LiveSnapshot:
+        """Advance every region by one reading and publish the new snapshot"""
+        with timer(simulator_tick_duration):
+            now = datetime.now()
+            readings = tuple(self._advance_region(region, now) for region in self.regions)
+            # Snapshots are taken here, between ticks, so they never split one
+            if self.event_log is not None and self.event_log.snapshot_due():
+                self.event_log.snapshot(self.snapshot_state)
+            snapshot = LiveSnapshot(
+                self._snapshot.tick + 1,
+                now,
+                readings,
+                {e["region"]: e for e in self.alert_engine.active_episodes()},
+                tuple(self.alert_engine.recent_events),
+                self.risk_windows.summarize(now.timestamp()),
+                self._advance_meters(readings, now),
+            )
+            self._snapshot = snapshot
+        return snapshot
+
+    def start(self, interval: float = None):
+        """Publish a first snapshot, then tick every interval seconds on a background thread"""
+        if interval is None:
+            interval = float(os.environ.get("AQUAGUARD_SIMULATOR_TICK_SECONDS", "2"))
+        self.tick()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(interval,), name="aquaguard-simulator", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Simulator tick failed: {e}")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # -- readers ----------------------------------------------------------------
+
+    def latest(self) -> LiveSnapshot:
+        """The most recently published snapshot"""
+        return self._snapshot
+
     def get_all_regions_data(self) -> list:
-        """Get current data for all regions"""
-        return [self.get_current_consumption(region) for region in self.regions]
+        """Latest reading of every region"""
+        return list(self._snapshot.readings)
 
 # Global simulator instance
-simulator = WaterDataSimulator()
\ No newline at end of file
+simulator = WaterDataSimulator()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write daily supply-meter inflow consistent with a consumption history"
+    )
+    parser.add_argument("--data", default="data/water_consumption_cleaned.csv")
+    parser.add_argument("--topology", default=DEFAULT_TOPOLOGY_PATH,
+                        help="Supply topology JSON (written with one meter per region if missing)")
+    parser.add_argument("--out", default=DEFAULT_INFLOW_PATH)
+    parser.add_argument("--loss-rate", type=float, default=0.12)
+    parser.add_argument("--noise", type=float, default=0.01)
+    parser.add_argument("--leak", action="append", default=[],
+                        help="METER:YYYY-MM-DD:FRACTION, e.g. 'DMA East:2023-01-20:0.2' (repeatable)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    from app.services.calendar_grid import CalendarGrid
+    from app.services.water_balance import SupplyTopology
+
+    df = pd.read_csv(args.data)
+    grid = CalendarGrid.from_frame(df[["region", "date", "daily_usage"]])
+    if not os.path.exists(args.topology):
+        with open(args.topology, "w") as f:
+            json.dump(default_topology(grid.regions), f, indent=2)
+        print(f"Wrote default topology to {args.topology}")
+    topology = SupplyTopology.from_json(args.topology)
+    leaks = []
+    for spec in args.leak:
+        meter, start, fraction = spec.rsplit(":", 2)
+        leaks.append((meter, start, float(fraction)))
+    inflow = simulate_inflow(topology, grid, args.loss_rate, args.noise, leaks, args.seed)
+    inflow.to_csv(args.out, index=False)
+    print(f"Wrote {len(inflow)} readings of {len(topology.meters)} meters to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
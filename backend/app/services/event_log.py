@@ -0,0 +1,300 @@
+"""Append-only, segmented event log for live readings, alert transitions and state snapshots.
+
+Records are JSON lines prefixed with their CRC32 and written to segment
+files named after the sequence number of their first record. Appends are
+buffered and fsynced in batches (every fsync_batch records, or every
+fsync_interval seconds by a background thread), so a crash loses at most
+the last batch; a torn last record is detected by its checksum and cut off
+when the log is reopened.
+
+Every snapshot_interval seconds a snapshot of the consumer's state is
+written, either by the background thread (start(snapshot_provider)) or by
+the consumer itself when snapshot_due(), and the log is compacted: segments
+that lie entirely before the retention window *and* before the newest
+snapshot are deleted.
+recover() returns that snapshot and the records after it, so state is
+rebuilt without replaying raw history.
+"""
+import json
+import os
+import threading
+import time
+import zlib
+from pathlib import Path
+
+
+def _encode(record: dict) -> bytes:
+    payload = json.dumps(record, separators=(",", ":")).encode()
+    return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+
+def _decode(line: bytes):
+    """Parse one framed line; None if it is torn or corrupt"""
+    if len(line) < 10 or not line.endswith(b"\n") or line[8:9] != b" ":
+        return None
+    payload = line[9:-1]
+    try:
+        if int(line[:8], 16) != zlib.crc32(payload):
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+class Segment:
+    __slots__ = ("path", "first_seq", "first_ts", "last_ts")
+
+    def __init__(self, path: Path, first_seq: int, first_ts=None, last_ts=None):
+        self.path = path
+        self.first_seq = first_seq
+        self.first_ts = first_ts
+        self.last_ts = last_ts
+
+
+class EventLog:
+    def __init__(self, directory: str = "logs/events", segment_bytes: int = 8 * 1024 * 1024,
+                 fsync_interval: float = 1.0, fsync_batch: int = 256,
+                 retention_hours: float = 72.0, snapshot_interval: float = 300.0):
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.retention_hours = retention_hours
+        self.snapshot_interval = snapshot_interval
+        self.segments = []
+        self.next_seq = 0
+        self.pending = 0
+        self.last_snapshot_seq = None
+        self._compacted_through = None
+        self._file = None
+        self._snapshot_provider = None
+        self._last_snapshot_at = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # -- opening and recovery ------------------------------------------------
+
+    def open(self):
+        """Index existing segments, repair a torn tail and reopen for appends"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        paths = sorted(self.directory.glob("*.log"))
+        self.segments = []
+        for path in paths:
+            segment = Segment(path, int(path.stem))
+            self._index_segment(segment, repair=path == paths[-1])
+            self.segments.append(segment)
+
+        if self.segments:
+            last = self.segments[-1]
+            with open(last.path, "rb") as f:
+                count = sum(1 for _ in f)
+            self.next_seq = last.first_seq + count
+        else:
+            self._new_segment()
+        self._file = open(self.segments[-1].path, "ab")
+        return self
+
+    def _index_segment(self, segment: Segment, repair: bool):
+        with open(segment.path, "rb") as f:
+            first = f.readline()
+            record = _decode(first)
+            segment.first_ts = record["ts"] if record else None
+            if not repair:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(0, size - 65536))
+                lines = f.read().splitlines(keepends=True)
+                for line in reversed(lines):
+                    record = _decode(line)
+                    if record is not None:
+                        segment.last_ts = record["ts"]
+                        break
+                return
+
+            f.seek(0)
+            valid_bytes = 0
+            for line in f:
+                record = _decode(line)
+                if record is None:
+                    break
+                valid_bytes += len(line)
+                segment.last_ts = record["ts"]
+                if record["kind"] == "snapshot":
+                    self.last_snapshot_seq = record["seq"]
+        if valid_bytes < os.path.getsize(segment.path):
+            print(f"Event log: truncating torn tail of {segment.path.name}")
+            os.truncate(segment.path, valid_bytes)
+
+    def _new_segment(self):
+        segment = Segment(self.directory / f"{self.next_seq:020d}.log", self.next_seq)
+        segment.path.touch()
+        self.segments.append(segment)
+        return segment
+
+    def recover(self):
+        """Latest snapshot data (or None) and the records appended after it"""
+        snapshot = None
+        start_index = 0
+        for index in range(len(self.segments) - 1, -1, -1):
+            for record in self._read_segment(self.segments[index]):
+                if record["kind"] == "snapshot":
+                    snapshot = record
+            if snapshot is not None:
+                start_index = index
+                break
+
+        if snapshot is not None:
+            self.last_snapshot_seq = max(self.last_snapshot_seq or -1, snapshot["seq"])
+        after = snapshot["seq"] if snapshot else -1
+        records = [
+            record
+            for segment in self.segments[start_index:]
+            for record in self._read_segment(segment)
+            if record["seq"] > after and record["kind"] != "snapshot"
+        ]
+        return (snapshot["data"] if snapshot else None), records
+
+    # -- writing ----------------------------------------------------------------
+
+    def append(self, kind: str, data: dict, ts: float = None) -> int:
+        with self._lock:
+            return self._append(kind, data, ts)
+
+    def _append(self, kind, data, ts=None):
+        ts = time.time() if ts is None else ts
+        record = {"seq": self.next_seq, "ts": ts, "kind": kind, "data": data}
+        self._file.write(_encode(record))
+        segment = self.segments[-1]
+        if segment.first_ts is None:
+            segment.first_ts = ts
+        segment.last_ts = ts
+        self.next_seq += 1
+        self.pending += 1
+        if self.pending >= self.fsync_batch:
+            self._sync()
+        if self._file.tell() >= self.segment_bytes:
+            self._sync()
+            self._file.close()
+            self._new_segment()
+            self._file = open(self.segments[-1].path, "ab")
+        return record["seq"]
+
+    def _sync(self):
+        if self.pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.pending = 0
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def snapshot_due(self) -> bool:
+        return time.time() - self._last_snapshot_at >= self.snapshot_interval
+
+    def snapshot(self, provider=None):
+        """Write the state returned by provider (default: the one given to start()) as a snapshot record"""
+        provider = provider or self._snapshot_provider
+        if provider is None:
+            return None
+        with self._lock:
+            seq = self._append("snapshot", provider())
+            self._sync()
+            self.last_snapshot_seq = seq
+        self._last_snapshot_at = time.time()
+        return seq
+
+    def compact(self) -> int:
+        """Delete segments older than the retention window and the latest snapshot"""
+        cutoff = time.time() - self.retention_hours * 3600
+        removed = 0
+        with self._lock:
+            while len(self.segments) > 1:
+                segment, following = self.segments[0], self.segments[1]
+                if segment.last_ts is not None and segment.last_ts >= cutoff:
+                    break
+                if self.last_snapshot_seq is None or following.first_seq > self.last_snapshot_seq:
+                    break
+                segment.path.unlink(missing_ok=True)
+                self.segments.pop(0)
+                removed += 1
+        return removed
+
+    # -- background maintenance ---------------------------------------------
+
+    def start(self, snapshot_provider=None):
+        """Start batched fsync, compaction and, given a provider, periodic snapshots"""
+        self._snapshot_provider = snapshot_provider
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="aquaguard-event-log", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.fsync_interval):
+            try:
+                self.sync()
+                if self._snapshot_provider is not None and self.snapshot_due():
+                    self.snapshot()
+                if self.last_snapshot_seq != self._compacted_through:
+                    self._compacted_through = self.last_snapshot_seq
+                    self.compact()
+            except Exception as e:
+                print(f"Event log maintenance failed: {e}")
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.snapshot()
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    # -- reading ------------------------------------------------------------------
+
+    def _read_segment(self, segment: Segment):
+        if segment is self.segments[-1] and self._file is not None:
+            with self._lock:
+                self._file.flush()
+        try:
+            f = open(segment.path, "rb")
+        except FileNotFoundError:
+            return  # compacted away while being read
+        with f:
+            for line in f:
+                record = _decode(line)
+                if record is None:
+                    return
+                yield record
+
+    def read(self, since: float = None, kinds=None, region: str = None):
+        """Records at or after `since` (epoch seconds), oldest first"""
+        for segment in list(self.segments):
+            if since is not None and segment.last_ts is not None and segment.last_ts < since:
+                continue
+            for record in self._read_segment(segment):
+                if since is not None and record["ts"] < since:
+                    continue
+                if kinds is not None and record["kind"] not in kinds:
+                    continue
+                if region is not None and record["data"].get("region") != region:
+                    continue
+                yield record
+
+    def tail(self, hours: float, kinds=None, region: str = None, limit: int = None) -> list:
+        """Records of the last `hours`, oldest first, keeping at most the newest `limit`"""
+        records = list(self.read(time.time() - hours * 3600, kinds, region))
+        return records[-limit:] if limit else records
+
+    def status(self) -> dict:
+        return {
+            "directory": str(self.directory),
+            "segments": len(self.segments),
+            "bytes": sum(s.path.stat().st_size for s in self.segments if s.path.exists()),
+            "next_seq": self.next_seq,
+            "last_snapshot_seq": self.last_snapshot_seq,
+            "unsynced_records": self.pending,
+        }
@@ -0,0 +1,278 @@
+"""Cross-region global model: one shared seasonal fit instead of one Prophet per region.
+
+Every region's usage is divided by its own level (mean usage), and a single
+ridge regression on calendar terms (trend, yearly and weekly Fourier terms)
+is fitted to all regions at once. The design only depends on the date, so
+the fit reduces to per-date sums (np.bincount) and one small linear solve,
+however many regions there are. A single StandardScaler and IsolationForest
+are fitted on region-normalized features.
+
+Per-region components keep the interface of ImprovedAquaGuardModel:
+RegionForecaster.predict() answers like Prophet.predict() and RegionScaler
+normalizes a region's features before the shared scaler, so
+predict_and_detect_anomalies, forecasts, hot swaps and save/load work
+unchanged. Train with `python -m app.services.global_model`.
+"""
+import numpy as np
+import pandas as pd
+
+from app.services.improved_model import ImprovedAquaGuardModel
+
+# Width of the forecast band, matching Prophet's default 80% interval
+INTERVAL_Z = 1.2816
+
+ANOMALY_FEATURES = [
+    "daily_usage",
+    "day_of_week",
+    "month",
+    "is_weekend",
+    "prev_day_usage",
+    "rolling_mean_7d",
+    "rolling_std_7d",
+]
+# Positions of the features expressed in liters, divided by the region level
+USAGE_FEATURES = [0, 4, 5, 6]
+
+
+class SeasonalBasis:
+    """Shared calendar design (trend + yearly/weekly Fourier terms) and its ridge fit"""
+
+    def __init__(self, origin, yearly_order: int = 4, weekly_order: int = 3, ridge: float = 1.0):
+        self.origin = pd.Timestamp(origin)
+        self.yearly_order = yearly_order
+        self.weekly_order = weekly_order
+        self.ridge = ridge
+        self.coef = None
+
+    def design(self, dates) -> np.ndarray:
+        dates = pd.DatetimeIndex(dates)
+        t = (dates - self.origin).days.to_numpy() / 365.25
+        columns = [np.ones(len(dates)), t]
+        day_of_year = dates.dayofyear.to_numpy()
+        for k in range(1, self.yearly_order + 1):
+            angle = 2 * np.pi * k * day_of_year / 365.25
+            columns += [np.sin(angle), np.cos(angle)]
+        day_of_week = dates.dayofweek.to_numpy()
+        for k in range(1, self.weekly_order + 1):
+            angle = 2 * np.pi * k * day_of_week / 7
+            columns += [np.sin(angle), np.cos(angle)]
+        return np.column_stack(columns)
+
+    def fit(self, dates, sums, counts):
+        """Least squares over all rows, given the per-date sum and count of the target"""
+        X = self.design(dates)
+        penalty = self.ridge * np.eye(X.shape[1])
+        penalty[0, 0] = 0.0
+        self.coef = np.linalg.solve((X * counts[:, None]).T @ X + penalty, X.T @ sums)
+        return self
+
+    def predict(self, dates) -> np.ndarray:
+        return self.design(dates) @ self.coef
+
+
+class RegionForecaster:
+    """A region's view of the shared fit; predict() mirrors Prophet's output columns"""
+
+    def __init__(self, basis: SeasonalBasis, level: float, sigma: float):
+        self.basis = basis
+        self.level = level
+        self.sigma = sigma
+
+    def predict(self, frame):
+        yhat = self.level * self.basis.predict(frame["ds"])
+        band = INTERVAL_Z * self.sigma * self.level
+        return pd.DataFrame({
+            "ds": frame["ds"].to_numpy(),
+            "yhat": yhat,
+            "yhat_lower": yhat - band,
+            "yhat_upper": yhat + band,
+        })
+
+
+class RegionScaler:
+    """Divides a region's usage features by its level, then applies the shared scaler"""
+
+    def __init__(self, scaler, level: float):
+        self.scaler = scaler
+        self.level = level
+
+    def transform(self, features):
+        values = np.asarray(features, dtype=np.float64).copy()
+        values[:, USAGE_FEATURES] /= self.level
+        return self.scaler.transform(values)
+
+
+class GlobalAquaGuardModel(ImprovedAquaGuardModel):
+    model_type = "global"
+
+    def __init__(self, max_detector_rows: int = 200_000):
+        super().__init__()
+        self.basis = None
+        self.scaler = None
+        self.detector = None
+        self.max_detector_rows = max_detector_rows
+
+    def _fit_forecasters(self, df):
+        """Fit the shared basis; return it with per-region names, levels, sigmas and thresholds"""
+        codes, regions = pd.factorize(df["region"], sort=True)
+        usage = df["daily_usage"].to_numpy(dtype=np.float64)
+        counts = np.bincount(codes).astype(np.float64)
+        levels = np.bincount(codes, usage) / counts
+        target = usage / levels[codes]
+
+        date_codes, dates = pd.factorize(df["date"], sort=True)
+        span_days = (dates.max() - dates.min()).days
+        # A yearly cycle cannot be separated from the trend in under a year
+        basis = SeasonalBasis(dates.min(), yearly_order=4 if span_days >= 365 else 0)
+        basis.fit(dates, np.bincount(date_codes, target), np.bincount(date_codes).astype(np.float64))
+
+        residual = target - basis.predict(dates)[date_codes]
+        mean = np.bincount(codes, residual) / counts
+        sigmas = np.sqrt(np.maximum(np.bincount(codes, residual ** 2) / counts - mean ** 2, 0.0))
+
+        quartiles = (
+            pd.Series(np.abs(residual) * levels[codes])
+            .groupby(codes)
+            .quantile([0.25, 0.75])
+            .unstack()
+        )
+        iqr = quartiles[0.75] - quartiles[0.25]
+        thresholds = (quartiles[0.75] + 1.5 * iqr).fillna(1000.0).to_numpy()
+        return basis, [str(r) for r in regions], levels, sigmas, thresholds, codes
+
+    def _fit_detector(self, df, row_levels):
+        from sklearn.ensemble import IsolationForest
+        from sklearn.preprocessing import StandardScaler
+
+        values = df[ANOMALY_FEATURES].to_numpy(dtype=np.float64)
+        values[:, USAGE_FEATURES] /= row_levels[:, None]
+        values = values[~np.isnan(values).any(axis=1)]
+        if len(values) > self.max_detector_rows:
+            # IsolationForest only looks at 256 rows per tree; a uniform sample
+            # keeps the scaler statistics and the trees representative
+            rng = np.random.default_rng(42)
+            values = values[rng.choice(len(values), self.max_detector_rows, replace=False)]
+
+        scaler = StandardScaler()
+        scaled = scaler.fit_transform(values)
+        detector = IsolationForest(contamination=0.1, random_state=42, n_estimators=100)
+        detector.fit(scaled)
+        return scaler, detector
+
+    def train_all_regions(self, df):
+        print("Training global model for all regions")
+
+        basis, regions, levels, sigmas, thresholds, codes = self._fit_forecasters(df)
+        self.scaler, self.detector = self._fit_detector(df, levels[codes])
+        self.basis = basis
+
+        for i, region in enumerate(regions):
+            self.models[region] = RegionForecaster(basis, float(levels[i]), float(sigmas[i]))
+            self.scalers[region] = RegionScaler(self.scaler, float(levels[i]))
+            self.anomaly_detectors[region] = self.detector
+            self.thresholds[region] = float(thresholds[i])
+        self.build_forecasts(df)
+
+        print(f"Trained {len(regions)} regions with one shared fit")
+
+    def train_region(self, df, region):
+        """Refit one region's level and spread against the shared seasonal fit"""
+        region_data = df[df["region"] == region]
+        usage = region_data["daily_usage"].to_numpy(dtype=np.float64)
+        level = float(usage.mean())
+        residual = usage / level - self.basis.predict(region_data["date"])
+        forecaster = RegionForecaster(self.basis, level, float(residual.std()))
+        threshold = self.calculate_adaptive_threshold(np.abs(residual) * level)
+        forecast = self.forecast_region(forecaster, region_data, region)
+        return forecaster, self.detector, RegionScaler(self.scaler, level), threshold, forecast
+
+    def build_forecasts(self, df):
+        """Forecast every trained region; the shared curve is computed once per start date and horizon"""
+        last_dates = df.groupby("region", observed=True)["date"].max()
+        groups = {}
+        for region, last_date in last_dates.items():
+            if region in self.models:
+                key = (last_date, self.get_forecast_horizon(region))
+                groups.setdefault(key, []).append(region)
+
+        for (last_date, horizon), regions in groups.items():
+            dates = pd.date_range(last_date + pd.Timedelta(days=1), periods=horizon, freq="D")
+            shape = self.basis.predict(dates)
+            start = dates[0].strftime("%Y-%m-%d")
+            for region in regions:
+                forecaster = self.models[region]
+                yhat = forecaster.level * shape
+                band = INTERVAL_Z * forecaster.sigma * forecaster.level
+                self.forecasts[region] = {
+                    "start": start,
+                    "yhat": yhat.astype(np.float32),
+                    "yhat_lower": (yhat - band).astype(np.float32),
+                    "yhat_upper": (yhat + band).astype(np.float32),
+                }
+
+    def evaluate_model_performance(self, df, test_size=0.2):
+        """Hold out the last test_size of each region and score a model fitted on the rest"""
+        print("\nModel Performance (global)")
+
+        position = df.groupby("region", observed=True).cumcount().to_numpy()
+        sizes = df.groupby("region", observed=True)["date"].transform("size").to_numpy()
+        train_mask = position < (sizes * (1 - test_size)).astype(int)
+        basis, regions, levels, _, _, _ = self._fit_forecasters(df[train_mask])
+
+        test = df[~train_mask]
+        codes = pd.Categorical(test["region"].astype(str), categories=regions).codes
+        actual = test["daily_usage"].to_numpy(dtype=np.float64)
+        predicted = levels[codes] * basis.predict(test["date"])
+        error = actual - predicted
+        counts = np.bincount(codes, minlength=len(regions)).astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mae = np.bincount(codes, np.abs(error), len(regions)) / counts
+            rmse = np.sqrt(np.bincount(codes, error ** 2, len(regions)) / counts)
+            mape = np.bincount(codes, np.abs(error / actual), len(regions)) / counts * 100
+        train_counts = np.bincount(
+            pd.Categorical(df.loc[train_mask, "region"].astype(str), categories=regions).codes,
+            minlength=len(regions),
+        )
+
+        performance_results = {
+            region: {
+                "mae": float(mae[i]),
+                "rmse": float(rmse[i]),
+                "mape": float(mape[i]),
+                "train_size": int(train_counts[i]),
+                "test_size": int(counts[i]),
+            }
+            for i, region in enumerate(regions)
+        }
+        print(f"Regions: {len(regions)}")
+        print(f"Mean MAE: {np.nanmean(mae):.2f}")
+        print(f"Mean RMSE: {np.nanmean(rmse):.2f}")
+        print(f"Mean MAPE: {np.nanmean(mape):.2f}%")
+        return performance_results
+
+    def store_data(self):
+        return {
+            **super().store_data(),
+            "global": {"basis": self.basis, "scaler": self.scaler, "detector": self.detector},
+        }
+
+    def restore(self, model_data):
+        super().restore(model_data)
+        shared = model_data["global"]
+        self.basis = shared["basis"]
+        self.scaler = shared["scaler"]
+        self.detector = shared["detector"]
+
+
+def main():
+    model = GlobalAquaGuardModel()
+
+    print("Loading and preprocessing data")
+    df = model.load_and_preprocess_data("data/water_consumption_cleaned.csv")
+    model.train_all_regions(df)
+    model.evaluate_model_performance(df)
+    model.save_models("models")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""Region hierarchy (network -> configured levels -> region) with vectorized roll-ups.
+
+Leaves are the regions of the data and the simulator. Their ancestors come
+from data/region_hierarchy.json (or AQUAGUARD_REGION_HIERARCHY), e.g.
+
+    {"levels": ["zone", "district"],
+     "regions": {"North": ["Zone 1", "District 1A"], "East": ["Zone 2", "District 2A"]}}
+
+Leaves are kept sorted by their full path, so every group at every level is
+a contiguous segment and a roll-up is one np.<ufunc>.reduceat over leaf
+values: scores are computed once per leaf and any level is answered from
+them in O(leaves). Regions missing from the file are placed under
+"Unassigned"; without a file there is only the network total.
+"""
+import json
+import os
+
+import numpy as np
+
+HIERARCHY_ENV = "AQUAGUARD_REGION_HIERARCHY"
+DEFAULT_HIERARCHY_PATH = "data/region_hierarchy.json"
+NETWORK = "All regions"
+UNASSIGNED = "Unassigned"
+LEAF_LEVEL = "region"
+
+
+class RegionHierarchy:
+    def __init__(self, leaves, levels=(), paths=None):
+        paths = paths or {}
+        levels = list(levels)
+        self.levels = ["network", *levels, LEAF_LEVEL]
+
+        rows = []
+        for leaf in leaves:
+            path = [str(p) for p in paths.get(leaf, [])][:len(levels)]
+            path += [UNASSIGNED] * (len(levels) - len(path))
+            rows.append((NETWORK, *path, leaf))
+        rows.sort()
+        self.paths = rows
+        self.leaves = [row[-1] for row in rows]
+        self.leaf_position = {leaf: i for i, leaf in enumerate(self.leaves)}
+
+        self._segments = {}
+        for depth, level in enumerate(self.levels[:-1]):
+            starts, prefixes, previous = [], [], None
+            for i, row in enumerate(rows):
+                prefix = row[:depth + 1]
+                if prefix != previous:
+                    starts.append(i)
+                    prefixes.append(prefix)
+                    previous = prefix
+            self._segments[level] = (np.array(starts, dtype=np.intp), prefixes)
+
+    def segments(self, level: str):
+        """Start offsets and paths of the groups at a non-leaf level"""
+        if level not in self._segments:
+            raise ValueError(f"Unknown level '{level}', expected one of {self.levels}")
+        return self._segments[level]
+
+    def describe(self) -> dict:
+        return {
+            "levels": self.levels,
+            "groups": {
+                level: [
+                    {"name": prefix[-1], "path": list(prefix[1:]), "regions": int(size)}
+                    for prefix, size in zip(prefixes, np.diff(np.append(starts, len(self.leaves))))
+                ]
+                for level, (starts, prefixes) in self._segments.items()
+            },
+        }
+
+    def _columns(self, rows, keys):
+        """Scatter per-leaf row values into hierarchy order; absent leaves are masked"""
+        positions = np.fromiter(
+            (self.leaf_position[r["region"]] for r in rows), dtype=np.intp, count=len(rows)
+        )
+        present = np.zeros(len(self.leaves))
+        present[positions] = 1.0
+        columns = {}
+        for key in keys:
+            column = np.zeros(len(self.leaves))
+            column[positions] = [r[key] for r in rows]
+            columns[key] = column
+        return positions, present, columns
+
+    @staticmethod
+    def _segment_argmax(values, starts):
+        maxes = np.maximum.reduceat(values, starts)
+        sizes = np.diff(np.append(starts, len(values)))
+        candidates = np.where(values == np.repeat(maxes, sizes), np.arange(len(values)), len(values))
+        return np.minimum.reduceat(candidates, starts)
+
+    def _weighted_mean(self, values, weights, present, starts):
+        weights = weights * present
+        totals = np.add.reduceat(weights, starts)
+        counts = np.add.reduceat(present, starts)
+        weighted = np.add.reduceat(values * weights, starts)
+        plain = np.add.reduceat(values * present, starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(totals > 0, weighted / totals, plain / counts)
+
+    def rollup_ranking(self, level: str, rows, weights=None):
+        """Aggregate leaf ranking rows to one row per group, ranked by priority
+
+        A group inherits the priority, persistence and risk level of its
+        worst region; current and average risk are (usage-weighted) means
+        over its regions.
+        """
+        starts, prefixes = self.segments(level)
+        if not rows:
+            return []
+        keys = ["current_risk", "recent_peak_risk", "average_risk", "persistence_days",
+                "priority_score"]
+        positions, present, col = self._columns(rows, keys)
+        weight = np.ones(len(self.leaves))
+        if weights is not None:
+            weight[positions] = [weights.get(r["region"], 1.0) for r in rows]
+        high = np.zeros(len(self.leaves))
+        high[positions] = [r["risk_level"] == "High" for r in rows]
+        risk_level = np.empty(len(self.leaves), dtype=object)
+        risk_level[positions] = [r["risk_level"] for r in rows]
+
+        masked = lambda values: np.where(present > 0, values, -np.inf)
+        counts = np.add.reduceat(present, starts)
+        current = self._weighted_mean(col["current_risk"], weight, present, starts)
+        average = self._weighted_mean(col["average_risk"], weight, present, starts)
+        peak = np.maximum.reduceat(masked(col["recent_peak_risk"]), starts)
+        persistence = np.maximum.reduceat(masked(col["persistence_days"]), starts)
+        priority = masked(col["priority_score"])
+        top = self._segment_argmax(priority, starts)
+        high_counts = np.add.reduceat(high, starts)
+
+        groups = []
+        for g in np.argsort(-priority[top], kind="stable"):
+            if counts[g] == 0:
+                continue
+            groups.append({
+                "level": level,
+                "region": prefixes[g][-1],
+                "path": list(prefixes[g][1:]),
+                "regions": int(counts[g]),
+                "current_risk": round(float(current[g]), 2),
+                "recent_peak_risk": round(float(peak[g]), 2),
+                "average_risk": round(float(average[g]), 2),
+                "risk_level": risk_level[top[g]],
+                "persistence_days": int(persistence[g]),
+                "priority_score": round(float(priority[top[g]]), 2),
+                "top_region": self.leaves[top[g]],
+                "high_risk_regions": int(high_counts[g]),
+            })
+        for i, group in enumerate(groups):
+            group["inspection_priority"] = i + 1
+        return groups
+
+    def rollup_readings(self, level: str, readings):
+        """Aggregate live readings: total consumption, consumption-weighted risk"""
+        starts, prefixes = self.segments(level)
+        if not readings:
+            return []
+        positions, present, col = self._columns(readings, ["consumption", "risk_score"])
+        elevated = np.zeros(len(self.leaves))
+        elevated[positions] = [r["risk_status"] != "normal" for r in readings]
+        timestamps = np.empty(len(self.leaves), dtype=object)
+        timestamps[positions] = [r["timestamp"] for r in readings]
+
+        counts = np.add.reduceat(present, starts)
+        consumption = np.add.reduceat(col["consumption"], starts)
+        risk = self._weighted_mean(col["risk_score"], col["consumption"], present, starts)
+        max_risk = np.maximum.reduceat(np.where(present > 0, col["risk_score"], -np.inf), starts)
+        elevated_counts = np.add.reduceat(elevated, starts)
+        sizes = np.diff(np.append(starts, len(self.leaves)))
+
+        groups = []
+        for g, start in enumerate(starts):
+            if counts[g] == 0:
+                continue
+            stamps = [t for t in timestamps[start:start + sizes[g]] if t is not None]
+            groups.append({
+                "level": level,
+                "region": prefixes[g][-1],
+                "path": list(prefixes[g][1:]),
+                "regions": int(counts[g]),
+                "timestamp": max(stamps),
+                "consumption": round(float(consumption[g]), 2),
+                "risk_status": "elevated" if elevated_counts[g] else "normal",
+                "risk_score": round(float(risk[g]), 1),
+                "max_risk_score": round(float(max_risk[g]), 1),
+                "elevated_regions": int(elevated_counts[g]),
+            })
+        return groups
+
+
+_hierarchies = {}
+
+
+def hierarchy_for(leaves) -> RegionHierarchy:
+    """Hierarchy over the given leaves, rebuilt only when they or the config file change"""
+    path = os.environ.get(HIERARCHY_ENV, DEFAULT_HIERARCHY_PATH)
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    key = (tuple(leaves), path, mtime)
+    hierarchy = _hierarchies.get(key)
+    if hierarchy is None:
+        levels, paths = [], {}
+        if mtime is not None:
+            with open(path) as f:
+                config = json.load(f)
+            levels, paths = config.get("levels", []), config.get("regions", {})
+        hierarchy = RegionHierarchy(leaves, levels, paths)
+        if len(_hierarchies) >= 8:
+            _hierarchies.clear()
+        _hierarchies[key] = hierarchy
+    return hierarchy
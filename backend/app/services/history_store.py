@@ -0,0 +1,226 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from app.metrics import stage_timer
+
+# Lag and rolling features look back at most a week
+FEATURE_LOOKBACK_DAYS = 7
+# Ingested rows go to a segment next to the source file, which is never modified
+INGEST_SEGMENT_SUFFIX = ".ingested.csv"
+
+
+def ingest_segment_path(data_path: str) -> Path:
+    return Path(data_path).with_suffix(INGEST_SEGMENT_SUFFIX)
+
+
+class HistoryStore:
+    """Keeps a bounded hot window of the history in memory and spills the rest to disk
+
+    The window starts at the first day of the month that lies
+    hot_window_days before the newest reading, so every spilled month is
+    complete and never rewritten. Spilled rows are kept raw (region, date,
+    daily_usage) in one CSV per month under archive_dir.
+
+    The archive is a derived cache for offline reads of old months: the
+    source file is never rewritten, so archived rows are still in it and
+    read_archived() must not be combined with a read of the source.
+    """
+
+    def __init__(self, model, hot_window_days: int = None, archive_dir: str = "data/archive",
+                 chunksize: int = 500_000):
+        if hot_window_days is None:
+            hot_window_days = int(os.environ.get("AQUAGUARD_HOT_WINDOW_DAYS", "365"))
+        self.model = model
+        self.hot_window_days = hot_window_days
+        self.archive_dir = Path(archive_dir)
+        self.chunksize = chunksize
+        self.window_start = None
+        self.spilled_rows = 0
+        self.segment_path = None
+
+    def window_cutoff(self, newest_date):
+        start = pd.Timestamp(newest_date) - pd.Timedelta(days=self.hot_window_days)
+        return start.to_period("M").start_time
+
+    def archived_months(self) -> set:
+        if not self.archive_dir.exists():
+            return set()
+        return {p.stem for p in self.archive_dir.glob("*.csv")}
+
+    def _read_chunks(self, data_path: str):
+        """The source file, then the rows ingested since it was written, in chunks"""
+        yield from pd.read_csv(data_path, chunksize=self.chunksize)
+        if self.segment_path is not None and self.segment_path.exists():
+            yield from pd.read_csv(self.segment_path, chunksize=self.chunksize)
+
+    def load(self, data_path: str):
+        """Stream the source file (and ingest segment) once, keep the hot window and archive older months
+
+        The cutoff follows the newest date seen so far, so rows kept while it
+        was earlier are archived (or dropped) when it moves.
+        """
+        self.segment_path = ingest_segment_path(data_path)
+        with stage_timer("read_csv"):
+            already_archived = self.archived_months()
+            if self.archive_dir.exists():
+                # Leftovers of an interrupted load are rewritten from scratch
+                for stale in self.archive_dir.glob("*.csv.partial"):
+                    stale.unlink()
+            cutoff = keep_from = None
+            hot_chunks = []
+            partial_files = set()
+            for chunk in self._read_chunks(data_path):
+                chunk["date"] = pd.to_datetime(chunk["date"])
+                chunk_cutoff = self.window_cutoff(chunk["date"].max())
+                if cutoff is None or chunk_cutoff > cutoff:
+                    if cutoff is not None:
+                        for hot in hot_chunks:
+                            moved = hot[(hot["date"] >= cutoff) & (hot["date"] < chunk_cutoff)]
+                            if len(moved):
+                                partial_files |= self._spill(moved, already_archived)
+                    cutoff = chunk_cutoff
+                    keep_from = cutoff - pd.Timedelta(days=FEATURE_LOOKBACK_DAYS)
+                    hot_chunks = [hot[hot["date"] >= keep_from] for hot in hot_chunks]
+                hot_chunks.append(chunk[chunk["date"] >= keep_from])
+                cold = chunk[chunk["date"] < cutoff]
+                if len(cold):
+                    partial_files |= self._spill(cold, already_archived)
+
+        for partial in partial_files:
+            partial.rename(partial.with_suffix(""))
+
+        df = self.model.preprocess(pd.concat(hot_chunks, ignore_index=True))
+        df = df[df["date"] >= cutoff].reset_index(drop=True)
+        self.window_start = cutoff
+        return df
+
+    def _spill(self, cold, already_archived):
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        written = set()
+        months = cold["date"].dt.strftime("%Y-%m")
+        for month, rows in cold.groupby(months):
+            if month in already_archived:
+                continue
+            partial = self.archive_dir / f"{month}.csv.partial"
+            rows = rows[["region", "date", "daily_usage"]].assign(
+                date=rows["date"].dt.strftime("%Y-%m-%d")
+            )
+            rows.to_csv(partial, mode="a", header=not partial.exists(), index=False)
+            self.spilled_rows += len(rows)
+            written.add(partial)
+        return written
+
+    def append(self, df, rows):
+        """History with validated raw rows (region, date, daily_usage) appended
+
+        Lag and rolling features of the new rows are computed from the last
+        few weeks of each affected region only (by date, so gap fills still
+        find their source). The rows are also appended to the ingest segment
+        next to the source file, so they survive a reload or restart.
+        """
+        context = df.loc[df["region"].isin(rows["region"].unique()), ["region", "date", "daily_usage"]]
+        newest = context.groupby("region", observed=True)["date"].transform("max")
+        context = context[context["date"] > newest - pd.Timedelta(days=4 * FEATURE_LOOKBACK_DAYS)]
+        last_dates = context.groupby("region", observed=True)["date"].max()
+
+        with stage_timer("ingest_features"):
+            features = self.model.preprocess(pd.concat(
+                [context.assign(region=context["region"].astype(str)), rows], ignore_index=True
+            ))
+            previous = features["region"].astype(str).map(last_dates.rename(index=str))
+            new = features[(features["date"] > previous) | previous.isna()].copy()
+            new["region"] = pd.Categorical(
+                new["region"].astype(str), categories=df["region"].cat.categories
+            )
+
+        with stage_timer("ingest_persist"):
+            if self.segment_path is not None:
+                # Formatted directly: several times faster than DataFrame.to_csv
+                days = np.datetime_as_string(rows["date"].to_numpy(), unit="D").tolist()
+                new_segment = not self.segment_path.exists()
+                with open(self.segment_path, "a") as f:
+                    if new_segment:
+                        f.write("region,date,daily_usage\n")
+                    f.writelines(
+                        f"{region},{day},{usage!r}\n"
+                        for region, day, usage in zip(
+                            rows["region"].astype(str).tolist(), days, rows["daily_usage"].tolist()
+                        )
+                    )
+
+        combined = pd.concat([df, new], ignore_index=True)
+        combined = combined.sort_values(["region", "date"], kind="stable").reset_index(drop=True)
+        return self.enforce_retention(combined)
+
+    def enforce_retention(self, df):
+        """Drop rows that fell out of the window (after appends) and archive them"""
+        cutoff = self.window_cutoff(df["date"].max())
+        if self.window_start is not None and cutoff <= self.window_start:
+            return df
+        cold = df[df["date"] < cutoff]
+        if len(cold):
+            for partial in self._spill(cold, self.archived_months()):
+                partial.rename(partial.with_suffix(""))
+        self.window_start = cutoff
+        return df[df["date"] >= cutoff].reset_index(drop=True)
+
+    def read_archived(self, start=None, end=None):
+        """Read spilled rows back (raw columns) for offline analysis
+
+        These are copies of rows outside the hot window, not rows missing
+        from the source file.
+        """
+        frames = []
+        for path in sorted(self.archive_dir.glob("*.csv")):
+            month_start = pd.Period(path.stem, freq="M").start_time
+            month_end = pd.Period(path.stem, freq="M").end_time
+            if (start is not None and month_end < pd.Timestamp(start)) or \
+                    (end is not None and month_start > pd.Timestamp(end)):
+                continue
+            frames.append(pd.read_csv(path, parse_dates=["date"]))
+        if not frames:
+            return pd.DataFrame(columns=["region", "date", "daily_usage"])
+        archived = pd.concat(frames, ignore_index=True)
+        if start is not None:
+            archived = archived[archived["date"] >= pd.Timestamp(start)]
+        if end is not None:
+            archived = archived[archived["date"] <= pd.Timestamp(end)]
+        return archived
+
+    def archive_summary(self) -> dict:
+        files = list(self.archive_dir.glob("*.csv")) if self.archive_dir.exists() else []
+        return {
+            "archive_dir": str(self.archive_dir),
+            "archived_months": len(files),
+            "archive_bytes": sum(p.stat().st_size for p in files),
+        }
+
+
+def frame_bytes(frame) -> int:
+    return int(frame.memory_usage(deep=True, index=True).sum())
+
+
+def memory_report(state, store=None, model_path=None) -> dict:
+    """In-memory footprint of a ServiceState's history and result cache"""
+    df = state.df
+    report = {
+        "history_rows": len(df),
+        "history_bytes": frame_bytes(df),
+        "history_bytes_by_column": {
+            column: int(size) for column, size in df.memory_usage(deep=True, index=False).items()
+        },
+        "window_start": df["date"].min().isoformat() if len(df) else None,
+        "window_end": df["date"].max().isoformat() if len(df) else None,
+        "result_cache_bytes": sum(frame_bytes(r) for r in list(state.results.values())),
+    }
+    if state.grid_built:
+        report["grid_bytes"] = state.grid.nbytes
+    if store is not None:
+        report["hot_window_days"] = store.hot_window_days
+        report.update(store.archive_summary())
+    if model_path and os.path.exists(model_path):
+        report["model_store_bytes"] = os.path.getsize(model_path)
+    return report
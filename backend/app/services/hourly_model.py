@@ -0,0 +1,382 @@
+"""Sub-daily (hourly) modelling mode, for leak signatures such as rising night flow.
+
+Hourly data is 24 times the volume of the daily history, so this mode
+never builds per-row feature frames. The history is read into an hourly
+float32 CalendarGrid in chunks (memory is the grid plus one chunk), and
+training and scoring run over blocks of regions with array operations
+across all hours at once.
+
+The forecast is the global model's shared seasonal fit with daily
+(hour-of-day) Fourier terms added, scaled by each region's level. Every
+hour gets two signals:
+
+- the residual z-score, residual / (sigma * level), and
+- the night-flow z-score of its day: the mean residual over the night
+  hours (2-4 am) against the median of the region's previous four weeks
+  of nights. A leak adds a constant flow, which is lost in daytime demand
+  but lifts the minimum night flow; a sustained step is flagged until it
+  becomes the new baseline, about two weeks later.
+
+Train and score with `python -m app.services.hourly_model --data <csv>`,
+where the CSV has region, timestamp and usage (liters per hour) columns.
+"""
+import argparse
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from app.metrics import stage_timer
+from app.services.calendar_grid import CalendarGrid
+from app.services.global_model import INTERVAL_Z, GlobalAquaGuardModel, RegionForecaster, SeasonalBasis
+from app.services.improved_model import BALANCE_RISK_WEIGHT
+
+HOURLY_TIME = "timestamp"
+HOURLY_VALUE = "usage"
+NIGHT_HOURS = [2, 3, 4]
+# Nights the baseline looks back over, and the fewest it needs
+NIGHT_BASELINE_DAYS = 28
+NIGHT_BASELINE_MIN = 7
+# An hour is an anomaly past this residual z-score, a night past this night-flow z-score
+RESIDUAL_Z = 3.5
+NIGHT_Z = 3.0
+# MAD to standard deviation for normally distributed values
+MAD_SCALE = 1.4826
+
+
+class HourlyBasis(SeasonalBasis):
+    """Shared calendar design with hour-of-day terms, separately shaped on weekends"""
+
+    def __init__(self, origin, yearly_order: int = 4, weekly_order: int = 3, daily_order: int = 4,
+                 ridge: float = 1.0):
+        super().__init__(origin, yearly_order, weekly_order, ridge)
+        self.daily_order = daily_order
+
+    def design(self, times) -> np.ndarray:
+        times = pd.DatetimeIndex(times)
+        hour = np.asarray(times.hour + times.minute / 60, dtype=np.float64)
+        weekend = np.asarray(times.dayofweek >= 5)
+        columns = []
+        for k in range(1, self.daily_order + 1):
+            angle = 2 * np.pi * k * hour / 24
+            columns += [np.sin(angle), np.cos(angle), weekend * np.sin(angle), weekend * np.cos(angle)]
+        return np.hstack([super().design(times), np.column_stack(columns)])
+
+
+class HourlyRegionForecaster(RegionForecaster):
+    """A region's view of the shared hourly fit, with the spread of its night flow"""
+
+    def __init__(self, basis: HourlyBasis, level: float, sigma: float, night_spread: float):
+        super().__init__(basis, level, sigma)
+        self.night_spread = night_spread
+
+
+def trailing_median(values: np.ndarray, window: int, min_periods: int) -> np.ndarray:
+    """Median of the previous `window` values along each row (excluding the current one), ignoring NaN"""
+    padded = np.concatenate([np.full((values.shape[0], window), np.nan), values], axis=1)
+    windows = sliding_window_view(padded[:, :-1], window, axis=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN windows give NaN
+        medians = np.nanmedian(windows, axis=2)
+    medians[(~np.isnan(windows)).sum(axis=2) < min_periods] = np.nan
+    return medians
+
+
+def percent_rank(values: np.ndarray) -> np.ndarray:
+    """Rank of each value within its row as a fraction of the row's non-NaN values (NaN ranks 0)"""
+    present = ~np.isnan(values)
+    order = np.argsort(values, axis=1)  # NaN sorts last
+    ranks = np.empty(values.shape, dtype=np.float64)
+    np.put_along_axis(ranks, order, np.arange(1, values.shape[1] + 1, dtype=np.float64)[None, :], axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ranks /= present.sum(axis=1, keepdims=True)
+    ranks[~present] = 0.0
+    return ranks
+
+
+def trailing_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """Mean over the trailing window along each row, ignoring NaN"""
+    present = ~np.isnan(values)
+    cumulative = np.zeros((values.shape[0], values.shape[1] + 1))
+    counts = np.zeros_like(cumulative)
+    np.cumsum(np.where(present, values, 0.0), axis=1, out=cumulative[:, 1:])
+    np.cumsum(present, axis=1, out=counts[:, 1:])
+    lo = np.maximum(np.arange(1, values.shape[1] + 1) - window, 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (cumulative[:, 1:] - cumulative[:, lo]) / (counts[:, 1:] - counts[:, lo])
+
+
+class HourlyAquaGuardModel(GlobalAquaGuardModel):
+    model_type = "hourly"
+
+    def __init__(self, block_regions: int = 256):
+        super().__init__()
+        self.block_regions = block_regions
+
+    @staticmethod
+    def load_grid(path: str, chunksize: int = 1_000_000) -> CalendarGrid:
+        """Read an hourly CSV (region, timestamp, usage) in chunks into a float32 grid"""
+        with stage_timer("hourly_read_csv"):
+            return CalendarGrid.from_csv(path, HOURLY_TIME, HOURLY_VALUE, "h", np.float32, chunksize)
+
+    @staticmethod
+    def as_grid(data) -> CalendarGrid:
+        if isinstance(data, CalendarGrid):
+            return data
+        return CalendarGrid.from_frame(data, time=HOURLY_TIME, value=HOURLY_VALUE, freq="h",
+                                       dtype=np.float32)
+
+    @staticmethod
+    def night_mask(grid) -> np.ndarray:
+        return np.isin(grid.dates.hour, NIGHT_HOURS)
+
+    def night_deviations(self, grid, ratio_residual) -> np.ndarray:
+        """Each day's mean night residual ratio less its trailing baseline, (regions, days)"""
+        nights = grid.by_day(ratio_residual)[:, :, NIGHT_HOURS]
+        present = ~np.isnan(nights)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            nights = np.where(present, nights, 0.0).sum(axis=2) / present.sum(axis=2)
+        return nights - trailing_median(nights, NIGHT_BASELINE_DAYS, NIGHT_BASELINE_MIN)
+
+    def _blocks(self, grid, levels):
+        """(block, levels of its regions) for consecutive blocks of regions"""
+        for lo, block in zip(range(0, len(grid.regions), self.block_regions),
+                             grid.blocks(self.block_regions)):
+            yield block, levels[lo:lo + len(block.regions)]
+
+    def _fit_basis(self, grid, levels):
+        """Fit the shared hourly shape from per-hour sums of level-normalized usage"""
+        sums = np.zeros(grid.periods)
+        counts = np.zeros(grid.periods)
+        for block, block_levels in self._blocks(grid, levels):
+            ratio = block.usage / block_levels[:, None]
+            sums += np.nansum(ratio, axis=0)
+            counts += block.observed.sum(axis=0)
+        span_days = grid.periods // grid.per_day
+        # A yearly cycle cannot be separated from the trend in under a year
+        basis = HourlyBasis(grid.start, yearly_order=4 if span_days >= 365 else 0)
+        seen = counts > 0
+        return basis.fit(grid.dates[seen], sums[seen], counts[seen])
+
+    def _region_statistics(self, block, levels, shape):
+        """Residual spread and robust night-flow spread (scaled MAD) of a block of regions"""
+        ratio_residual = block.usage / levels[:, None] - shape[None, :]
+        sigmas = np.nanstd(ratio_residual, axis=1)
+        deviations = self.night_deviations(block, ratio_residual)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            center = np.nanmedian(deviations, axis=1)
+            spreads = MAD_SCALE * np.nanmedian(np.abs(deviations - center[:, None]), axis=1)
+        return sigmas, np.maximum(np.nan_to_num(spreads, nan=1.0), 1e-6)
+
+    def train_all_regions(self, data):
+        grid = self.as_grid(data)
+        print(f"Training hourly model for {len(grid.regions)} regions x {grid.periods} hours")
+
+        with stage_timer("hourly_levels"):
+            levels = np.concatenate([block.means() for block in grid.blocks(self.block_regions)])
+        with stage_timer("hourly_basis"):
+            self.basis = self._fit_basis(grid, levels)
+            shape = self.basis.predict(grid.dates)
+
+        with stage_timer("hourly_statistics"):
+            for block, block_levels in self._blocks(grid, levels):
+                statistics = zip(block.regions, block_levels, *self._region_statistics(block, block_levels, shape))
+                for region, level, sigma, spread in statistics:
+                    if not np.isfinite(level) or level <= 0:
+                        continue
+                    self.models[region] = HourlyRegionForecaster(
+                        self.basis, float(level), float(sigma), float(spread)
+                    )
+                    self.thresholds[region] = float(RESIDUAL_Z * sigma * level)
+        self.scaler = self.detector = None
+        self.build_forecasts(grid)
+
+        print(f"Trained {len(self.models)} regions with one shared hourly fit")
+
+    def train_region(self, data, region):
+        """Refit one region's level, spread and night baseline against the shared fit"""
+        grid = self.as_grid(data).take([region])
+        level = grid.means()
+        sigmas, spreads = self._region_statistics(grid, level, self.basis.predict(grid.dates))
+        forecaster = HourlyRegionForecaster(self.basis, float(level[0]), float(sigmas[0]), float(spreads[0]))
+        threshold = float(RESIDUAL_Z * sigmas[0] * level[0])
+        return forecaster, None, None, threshold, self.forecast_region(forecaster, grid, region)
+
+    def forecast_region(self, forecaster, grid, region):
+        last = grid.last_dates()[region]
+        return self._forecast(forecaster, last, self.get_forecast_horizon(region))
+
+    def _forecast(self, forecaster, last, horizon_days, shape=None):
+        times = pd.date_range(last + pd.Timedelta(hours=1), periods=horizon_days * 24, freq="h")
+        yhat = forecaster.level * (self.basis.predict(times) if shape is None else shape)
+        band = INTERVAL_Z * forecaster.sigma * forecaster.level
+        return {
+            "start": times[0].strftime("%Y-%m-%dT%H:%M"),
+            "yhat": yhat.astype(np.float32),
+            "yhat_lower": (yhat - band).astype(np.float32),
+            "yhat_upper": (yhat + band).astype(np.float32),
+        }
+
+    def build_forecasts(self, data):
+        """Hourly forecasts for the configured horizon (in days); the shared curve is computed once per start"""
+        grid = self.as_grid(data)
+        groups = {}
+        for region, last in grid.last_dates().items():
+            if region in self.models and not pd.isna(last):
+                groups.setdefault((last, self.get_forecast_horizon(region)), []).append(region)
+        for (last, horizon), regions in groups.items():
+            times = pd.date_range(last + pd.Timedelta(hours=1), periods=horizon * 24, freq="h")
+            shape = self.basis.predict(times)
+            for region in regions:
+                self.forecasts[region] = self._forecast(self.models[region], last, horizon, shape)
+
+    def iter_scores(self, data):
+        """Score every trained region, one block of regions at a time
+
+        Yields (block, scores), where scores holds (regions, hours) arrays
+        predicted, residual, residual_z, night_flow_z (each hour carries
+        its night's score), combined_risk_score (0-100) and is_anomaly.
+        Memory is bounded by the block size, whatever the region count.
+        """
+        grid = self.as_grid(data)
+        shape = self.basis.predict(grid.dates)
+        night_hours = self.night_mask(grid)
+        known = [r for r in grid.regions if r in self.models]
+        for block in grid.take(known).blocks(self.block_regions):
+            with stage_timer("hourly_scoring"):
+                yield block, self._score_block(block, shape, night_hours)
+
+    def _score_block(self, block, shape, night_hours):
+        forecasters = [self.models[r] for r in block.regions]
+        levels = np.array([f.level for f in forecasters])[:, None]
+        sigmas = np.array([f.sigma for f in forecasters])[:, None]
+        night_spreads = np.array([f.night_spread for f in forecasters])[:, None]
+
+        predicted = levels * shape[None, :]
+        residual = block.usage - predicted
+        with np.errstate(invalid="ignore", divide="ignore"):
+            residual_z = residual / (sigmas * levels)
+            night_z = self.night_deviations(block, residual / levels) / night_spreads
+        hourly_night_z = np.repeat(night_z, block.per_day, axis=1)
+
+        severity = 0.6 * percent_rank(np.abs(residual_z)) + 0.4 * np.repeat(
+            percent_rank(night_z), block.per_day, axis=1
+        )
+        raw_risk = np.where(block.observed, severity * 100, np.nan)
+        flagged = (np.abs(residual_z) > RESIDUAL_Z) | ((hourly_night_z > NIGHT_Z) & night_hours[None, :])
+        return {
+            "predicted": predicted.astype(np.float32),
+            "residual": residual.astype(np.float32),
+            "residual_z": residual_z.astype(np.float32),
+            "night_flow_z": hourly_night_z.astype(np.float32),
+            "combined_risk_score": trailing_mean(raw_risk, 3).astype(np.float32),
+            "is_anomaly": flagged & block.observed,
+        }
+
+    def predict_and_detect_anomalies(self, df, region, deployment_date=None, balance=None):
+        """Hourly results of one region (observed hours only), from a grid or a long frame
+
+        A daily water-balance signal (balance) raises the risk of every hour of its day.
+        """
+        if region not in self.models:
+            raise ValueError(f"No trained model found for region: {region}")
+        if isinstance(df, CalendarGrid):
+            grid = df.take([region])
+        else:
+            grid = self.as_grid(df[df["region"] == region])
+        block, scores = next(self.iter_scores(grid))
+        hours = np.flatnonzero(block.observed[0])
+        residual = scores["residual"][0, hours]
+        results = pd.DataFrame({
+            "region": region,
+            HOURLY_TIME: block.dates[hours],
+            HOURLY_VALUE: block.usage[0, hours],
+            "predicted_usage": scores["predicted"][0, hours],
+            "residual": residual,
+            "abs_residual": np.abs(residual),
+            "residual_z": scores["residual_z"][0, hours],
+            "night_flow_z": scores["night_flow_z"][0, hours],
+            "combined_risk_score": scores["combined_risk_score"][0, hours],
+            "is_anomaly_ml": scores["is_anomaly"][0, hours].astype(int),
+        })
+        if balance is not None:
+            self.attach_balance(results, balance, HOURLY_TIME)
+            results["combined_risk_score"] = np.minimum(
+                results["combined_risk_score"] + BALANCE_RISK_WEIGHT * results["balance_severity"].fillna(0),
+                100,
+            ).astype(np.float32)
+        return results
+
+    def evaluate_model_performance(self, data, test_size=0.2):
+        """Fit on all but the last test_size of the hours and report the holdout errors"""
+        print("\nModel Performance (hourly)")
+        grid = self.as_grid(data)
+        # Split on a day boundary so both parts keep whole days
+        cut = grid.start + pd.Timedelta(days=int(grid.periods // grid.per_day * (1 - test_size)))
+        holdout = HourlyAquaGuardModel(self.block_regions)
+        holdout.default_forecast_horizon = 1
+        holdout.train_all_regions(grid.between(None, cut - pd.Timedelta(hours=1)))
+
+        test = grid.between(cut, None)
+        shape = holdout.basis.predict(test.dates)
+        performance_results = {}
+        for region in test.regions:
+            if region not in holdout.models:
+                continue
+            actual = test.region(region).astype(np.float64)
+            error = np.abs(actual - holdout.models[region].level * shape)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                performance_results[region] = {
+                    "mae": float(np.nanmean(error)),
+                    "mape": float(np.nanmean(error / actual) * 100),
+                    "test_size": int(np.isfinite(actual).sum()),
+                }
+        print(f"Regions: {len(performance_results)}")
+        print(f"Mean MAE: {np.mean([r['mae'] for r in performance_results.values()]):.2f}")
+        print(f"Mean MAPE: {np.mean([r['mape'] for r in performance_results.values()]):.2f}%")
+        return performance_results
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and score the hourly AquaGuard model")
+    parser.add_argument("--data", default="data/hourly_consumption.csv",
+                        help="CSV with region, timestamp and usage columns")
+    parser.add_argument("--models-dir", default="models/hourly")
+    parser.add_argument("--chunksize", type=int, default=1_000_000)
+    parser.add_argument("--block-regions", type=int, default=256)
+    parser.add_argument("--evaluate", action="store_true", help="Also report holdout errors")
+    parser.add_argument("--top", type=int, default=10, help="Regions to list by recent night flow")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    model = HourlyAquaGuardModel(args.block_regions)
+    grid = model.load_grid(args.data, args.chunksize)
+    print(f"Loaded {len(grid.regions)} regions x {grid.periods} hours "
+          f"({grid.nbytes / 1e6:.0f} MB) in {time.perf_counter() - started:.1f}s")
+
+    model.train_all_regions(grid)
+    if args.evaluate:
+        model.evaluate_model_performance(grid)
+
+    print("\nAnomaly Detection")
+    flagged_hours, recent = 0, {}
+    for block, scores in model.iter_scores(grid):
+        flagged_hours += int(scores["is_anomaly"].sum())
+        # Highest night-flow z-score of each region's last seven nights
+        week = scores["night_flow_z"][:, -7 * 24::24]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            recent.update(zip(block.regions, np.nanmax(week, axis=1)))
+    print(f"Flagged hours: {flagged_hours} of {int(grid.observed.sum())}")
+    print("Highest night flow in the last week (z-score):")
+    for region, z in sorted(recent.items(), key=lambda item: -np.nan_to_num(item[1], nan=-np.inf))[:args.top]:
+        print(f"  {region}: {z:.1f}")
+
+    model.save_models(args.models_dir)
+    print(f"Done in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
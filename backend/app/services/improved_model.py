@@ -1,40 +1,78 @@
 import pandas as pd
 import numpy as np
 import pickle
+import copy
+import os
 from pathlib import Path
-from prophet import Prophet
-from sklearn.ensemble import IsolationForest
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import mean_absolute_error, mean_squared_error
-import matplotlib.pyplot as plt
 import warnings
+from app.metrics import stage_timer
+from app.services.calendar_grid import GAP_FILL_POLICIES, CalendarGrid
+from app.services.online_detector import score_stream
 warnings.filterwarnings('ignore')
 
+ANOMALY_BACKENDS = ("isolation_forest", "online")
+ISOLATION_FEATURES = [
+    "daily_usage",
+    "day_of_week",
+    "month",
+    "is_weekend",
+    "prev_day_usage",
+    "rolling_mean_7d",
+    "rolling_std_7d",
+]
+# Risk points a full-severity supply imbalance adds to a day (see water_balance)
+BALANCE_RISK_WEIGHT = 40.0
+
 class ImprovedAquaGuardModel:
+    # Stored in the pickle so load_model_store() can pick the right class
+    model_type = "per_region"
+
     def __init__(self):
         self.BASE_DIR = Path(__file__).resolve().parent.parent
         self.models = {}  
         self.scalers = {} 
         self.anomaly_detectors = {}  
         self.thresholds = {}  
+        self.forecasts = {}
+        self.forecast_horizons = {}
+        self.default_forecast_horizon = 30
+        # "isolation_forest" scores with the trained per-region forests;
+        # "online" runs an EWMA robust z-score over the forecast residuals
+        self.anomaly_backend = os.environ.get("AQUAGUARD_ANOMALY_BACKEND", "isolation_forest")
+        if self.anomaly_backend not in ANOMALY_BACKENDS:
+            raise ValueError(f"Unknown anomaly backend: {self.anomaly_backend}")
+        # How gaps are filled before computing lag and rolling features
+        self.gap_fill = os.environ.get("AQUAGUARD_GAP_FILL", "none")
+        if self.gap_fill not in GAP_FILL_POLICIES:
+            raise ValueError(f"Unknown gap-fill policy: {self.gap_fill}")
         
     def load_and_preprocess_data(self, data_path):
 
-        df = pd.read_csv(data_path)
-        df['date'] = pd.to_datetime(df['date'])
-        df = df.sort_values(['region', 'date'])
-        df['day_of_week'] = df['date'].dt.dayofweek
-        df['month'] = df['date'].dt.month
-        df['day_of_month'] = df['date'].dt.day
-        df['is_weekend'] = (df['day_of_week'] >= 5).astype(int)
-        df['prev_day_usage'] = df.groupby('region')['daily_usage'].shift(1)
-        df['prev_week_usage'] = df.groupby('region')['daily_usage'].shift(7) 
-        df['rolling_mean_7d'] = df.groupby('region')['daily_usage'].rolling(window=7, min_periods=1).mean().reset_index(0, drop=True)
-        df['rolling_std_7d'] = df.groupby('region')['daily_usage'].rolling(window=7, min_periods=1).std().reset_index(0, drop=True)
-        
+        with stage_timer("read_csv"):
+            df = pd.read_csv(data_path)
+        return self.preprocess(df)
+
+    def preprocess(self, df):
+        """Add calendar, lag and rolling features using compact dtypes
+
+        Features are computed on a CalendarGrid, so lags and rolling
+        windows are by calendar day: after a missing day prev_day_usage is
+        NaN (or gap-filled, see AQUAGUARD_GAP_FILL) rather than the reading
+        before the gap. Usage features are float32 (computed in float64
+        first), calendar fields int8 and region a categorical, which keeps
+        the in-memory history at well under half its default footprint.
+        """
+        with stage_timer("feature_engineering"):
+            grid = CalendarGrid.from_frame(df[['region', 'date', 'daily_usage']])
+            df = grid.feature_frame(self.gap_fill)
+
         return df
-    
+
     def train_region_model(self, region_data, region_name):
+        # Heavy imports are deferred so serving processes that only load a
+        # trained model store (or attach to shared results) never pay for them
+        from prophet import Prophet
+
         prophet_data = region_data[['date', 'daily_usage']].copy()
         prophet_data = prophet_data.rename(columns={'date': 'ds', 'daily_usage': 'y'})
         model = Prophet(
@@ -56,6 +94,8 @@ class ImprovedAquaGuardModel:
         return model
     
     def train_anomaly_detector(self, region_data, region_name):
+        from sklearn.ensemble import IsolationForest
+        from sklearn.preprocessing import StandardScaler
 
         features = ['daily_usage', 'day_of_week', 'month', 'is_weekend']
         if 'prev_day_usage' in region_data.columns:
@@ -84,98 +124,209 @@ class ImprovedAquaGuardModel:
         
         return threshold if not np.isnan(threshold) else 1000.0
     
+    def get_forecast_horizon(self, region):
+        return int(self.forecast_horizons.get(region, self.default_forecast_horizon))
+
+    def future_frame(self, region_data, horizon):
+        last_date = region_data['date'].max()
+        future = pd.DataFrame({
+            'ds': pd.date_range(last_date + pd.Timedelta(days=1), periods=horizon, freq='D')
+        })
+        future['is_weekend'] = (future['ds'].dt.dayofweek >= 5).astype(int)
+        return future
+
+    def compact_forecast(self, future_forecast):
+        """Keep only what /forecast serves, as float32 arrays"""
+        return {
+            'start': future_forecast['ds'].iloc[0].strftime('%Y-%m-%d'),
+            'yhat': future_forecast['yhat'].to_numpy(dtype=np.float32),
+            'yhat_lower': future_forecast['yhat_lower'].to_numpy(dtype=np.float32),
+            'yhat_upper': future_forecast['yhat_upper'].to_numpy(dtype=np.float32),
+        }
+
+    def forecast_region(self, prophet_model, region_data, region):
+        """Predict the region's configured horizon past its last observed day"""
+        future = self.future_frame(region_data, self.get_forecast_horizon(region))
+        return self.compact_forecast(prophet_model.predict(future))
+
+    def build_forecasts(self, df):
+        """Batch-compute future forecasts for every trained region (uncertainty sampled once)"""
+        for region in df['region'].unique():
+            if region in self.models:
+                region_data = df[df['region'] == region]
+                self.forecasts[region] = self.forecast_region(self.models[region], region_data, region)
+
+    def train_region(self, df, region):
+        region_data = df[df['region'] == region].copy()
+        prophet_model = self.train_region_model(region_data, region)
+        anomaly_detector, scaler = self.train_anomaly_detector(region_data, region)
+        prophet_data = region_data[['date', 'daily_usage', 'is_weekend']].copy()
+        prophet_data = prophet_data.rename(columns={'date': 'ds', 'daily_usage': 'y'})
+
+        # One predict call covers the history (for the threshold) and the
+        # forecast horizon, so uncertainty sampling runs once per training.
+        future = self.future_frame(region_data, self.get_forecast_horizon(region))
+        forecast = prophet_model.predict(
+            pd.concat([prophet_data[['ds', 'is_weekend']], future], ignore_index=True)
+        )
+        history_forecast = forecast.iloc[:len(prophet_data)]
+        residuals = np.abs(region_data['daily_usage'].values - history_forecast['yhat'].values)
+        threshold = self.calculate_adaptive_threshold(residuals)
+        future_forecast = self.compact_forecast(forecast.iloc[len(prophet_data):])
+
+        return prophet_model, anomaly_detector, scaler, threshold, future_forecast
+
     def train_all_regions(self, df):
         print("Training models for all regions")
         
         for region in df['region'].unique():
             print(f"Training model for {region} region")
-            region_data = df[df['region'] == region].copy()
-            prophet_model = self.train_region_model(region_data, region)
-            anomaly_detector, scaler = self.train_anomaly_detector(region_data, region)
-            prophet_data = region_data[['date', 'daily_usage', 'is_weekend']].copy()
-            prophet_data = prophet_data.rename(columns={'date': 'ds', 'daily_usage': 'y'})
-            
-            forecast = prophet_model.predict(prophet_data)
-            residuals = np.abs(region_data['daily_usage'] - forecast['yhat'])
-            threshold = self.calculate_adaptive_threshold(residuals)
+            prophet_model, anomaly_detector, scaler, threshold, forecast = self.train_region(df, region)
             self.models[region] = prophet_model
             self.anomaly_detectors[region] = anomaly_detector
             self.scalers[region] = scaler
             self.thresholds[region] = threshold
+            self.forecasts[region] = forecast
 
             print(f"Adaptive threshold: {threshold:.2f}")
     
-    def predict_and_detect_anomalies(self, df, region, deployment_date=None):
+    def with_region_models(self, region, prophet_model, anomaly_detector, scaler, threshold,
+                           forecast=None):
+        """Return a shallow copy of this model with one region's components replaced.
+
+        The per-region dicts are copied rather than mutated, so callers that
+        already hold a reference to this instance keep a consistent view.
+        """
+        updated = copy.copy(self)
+        updated.models = {**self.models, region: prophet_model}
+        updated.anomaly_detectors = {**self.anomaly_detectors, region: anomaly_detector}
+        updated.scalers = {**self.scalers, region: scaler}
+        updated.thresholds = {**self.thresholds, region: threshold}
+        if forecast is not None:
+            updated.forecasts = {**self.forecasts, region: forecast}
+        return updated
+
+    def predict_and_detect_anomalies(self, df, region, deployment_date=None, balance=None):
+        """Score a region's full history, given as a feature frame or a CalendarGrid
+
+        deployment_date is accepted for compatibility only: the forecast
+        for a date never depends on observed values, so nothing is masked.
+        Use rescore() for results as of a past date. balance is the
+        region's daily water-balance signal (WaterBalance.region_signal),
+        whose severity raises the risk of days with a supply imbalance.
+        """
         if region not in self.models:
             raise ValueError(f"No trained model found for region: {region}")
 
-        region_data = df[df["region"] == region].copy()
-        region_data = region_data.sort_values("date").reset_index(drop=True)
-        prophet_df = region_data[
-            ["date", "daily_usage", "is_weekend"]
-        ].copy()
+        with stage_timer("region_slice"):
+            if isinstance(df, CalendarGrid):
+                region_data = df.region_frame(region, self.gap_fill)
+            else:
+                region_data = df[df["region"] == region].copy()
+                region_data = region_data.sort_values("date").reset_index(drop=True)
 
-        if deployment_date is not None:
-            prophet_df.loc[
-                prophet_df["date"] > deployment_date,
-                "daily_usage"
-            ] = np.nan
+        with stage_timer("forecast"):
+            prophet_df = region_data[
+                ["date", "daily_usage", "is_weekend"]
+            ].rename(columns={"date": "ds", "daily_usage": "y"})
 
-        prophet_df = prophet_df.rename(
-            columns={"date": "ds", "daily_usage": "y"}
-        )
+            forecast = self.models[region].predict(prophet_df)
+            region_data["predicted_usage"] = forecast["yhat"]
+            region_data["residual"] = (
+                region_data["daily_usage"] - region_data["predicted_usage"]
+            )
+            region_data["abs_residual"] = region_data["residual"].abs()
 
-        forecast = self.models[region].predict(prophet_df)
-        region_data["predicted_usage"] = forecast["yhat"]
-        region_data["residual"] = (
-            region_data["daily_usage"] - region_data["predicted_usage"]
-        )
-        region_data["abs_residual"] = region_data["residual"].abs()
-        features = [
-            "daily_usage",
-            "day_of_week",
-            "month",
-            "is_weekend",
-            "prev_day_usage",
-            "rolling_mean_7d",
-            "rolling_std_7d"
-        ]
-
-        valid_idx = region_data[features].dropna().index
-        scaled = self.scalers[region].transform(
-            region_data.loc[valid_idx, features]
-        )
-        if_scores = -self.anomaly_detectors[region].decision_function(scaled)
-        region_data["if_score"] = 0.0
-        region_data.loc[valid_idx, "if_score"] = if_scores
-        if_threshold = np.percentile(if_scores, 95)
-        region_data["is_anomaly_ml"] = 0
-        region_data.loc[
-            valid_idx,
-            "is_anomaly_ml"
-        ] = (if_scores >= if_threshold).astype(int)
-        region_data["residual_severity"] = (
-            region_data["abs_residual"].rank(pct=True).fillna(0)
-        )
-        region_data["if_severity"] = (
-            region_data["if_score"].rank(pct=True).fillna(0)
-        )
+        if self.anomaly_backend == "online":
+            with stage_timer("online_scoring"):
+                # Prequential: each day is scored before it updates the
+                # baseline, so no threshold over all past scores is needed
+                scores, flags = score_stream(region_data["residual"].to_numpy())
+                region_data["if_score"] = scores
+                region_data["is_anomaly_ml"] = flags
+        else:
+            self.score_isolation_forest(region_data, region)
+
+        if balance is not None:
+            self.attach_balance(region_data, balance)
+        self.aggregate_risk(region_data)
+        return region_data
 
-        region_data["raw_risk"] = (
-            0.6 * region_data["residual_severity"]
-            + 0.4 * region_data["if_severity"]
-        ) * 100
+    @staticmethod
+    def attach_balance(results, balance, time: str = "date"):
+        """Join a daily water-balance signal onto results by day (in place)"""
+        days = pd.to_datetime(results[time]).dt.normalize()
+        aligned = balance.set_index("date").reindex(days)
+        for column in ("nrw_ratio", "imbalance_z", "balance_severity"):
+            results[column] = aligned[column].to_numpy()
 
-        region_data["combined_risk_score"] = (
-            region_data["raw_risk"]
-            .rolling(window=3, min_periods=1)
-            .mean()
-        )
+    def rescore(self, results, as_of):
+        """Results as they would have been scored on as_of
 
+        Reuses the forecast, residuals and raw anomaly scores of a full
+        result frame (none of which depend on later days) and recomputes
+        only what does: the anomaly threshold, severity ranks and rolling risk.
+        """
+        with stage_timer("rescore"):
+            region_data = results[results["date"] <= as_of].copy()
+            if self.anomaly_backend != "online":
+                valid = region_data[ISOLATION_FEATURES].notna().all(axis=1).to_numpy()
+                self.flag_isolation_forest(region_data, valid)
+            self.aggregate_risk(region_data)
         return region_data
 
-    
+    def aggregate_risk(self, region_data):
+        with stage_timer("risk_aggregation"):
+            region_data["residual_severity"] = (
+                region_data["abs_residual"].rank(pct=True).fillna(0)
+            )
+            region_data["if_severity"] = (
+                region_data["if_score"].rank(pct=True).fillna(0)
+            )
+
+            region_data["raw_risk"] = (
+                0.6 * region_data["residual_severity"]
+                + 0.4 * region_data["if_severity"]
+            ) * 100
+            if "balance_severity" in region_data:
+                region_data["raw_risk"] = (
+                    region_data["raw_risk"]
+                    + BALANCE_RISK_WEIGHT * region_data["balance_severity"].fillna(0)
+                ).clip(upper=100)
+
+            region_data["combined_risk_score"] = (
+                region_data["raw_risk"]
+                .rolling(window=3, min_periods=1)
+                .mean()
+            )
+
+    def score_isolation_forest(self, region_data, region):
+        with stage_timer("scaling"):
+            valid_idx = region_data[ISOLATION_FEATURES].dropna().index
+            scaled = self.scalers[region].transform(
+                region_data.loc[valid_idx, ISOLATION_FEATURES]
+            )
+
+        with stage_timer("if_scoring"):
+            if_scores = -self.anomaly_detectors[region].decision_function(scaled)
+            region_data["if_score"] = 0.0
+            region_data.loc[valid_idx, "if_score"] = if_scores
+            valid = np.zeros(len(region_data), dtype=bool)
+            valid[region_data.index.get_indexer(valid_idx)] = True
+            self.flag_isolation_forest(region_data, valid)
+
+    @staticmethod
+    def flag_isolation_forest(region_data, valid):
+        """Flag the top 5% of scored rows as anomalies"""
+        scores = region_data["if_score"].to_numpy()
+        flags = np.zeros(len(region_data), dtype=int)
+        if valid.any():
+            flags[valid] = scores[valid] >= np.percentile(scores[valid], 95)
+        region_data["is_anomaly_ml"] = flags
+
     def evaluate_model_performance(self, df, test_size=0.2):
+        from sklearn.metrics import mean_absolute_error, mean_squared_error
+
         print("\nModel Performance")
         
         performance_results = {}
@@ -215,75 +366,80 @@ class ImprovedAquaGuardModel:
         
         return performance_results
     
-    def save_models(self, save_path):
-        save_dir = Path(save_path)
-        save_dir.mkdir(parents=True, exist_ok=True)
-        model_data = {
+    def store_data(self):
+        return {
+            'model_type': self.model_type,
             'models': self.models,
             'anomaly_detectors': self.anomaly_detectors,
             'scalers': self.scalers,
-            'thresholds': self.thresholds
+            'thresholds': self.thresholds,
+            'forecasts': self.forecasts,
+            'forecast_horizons': self.forecast_horizons,
+            'default_forecast_horizon': self.default_forecast_horizon
         }
+
+    def save_models(self, save_path):
+        save_dir = Path(save_path)
+        save_dir.mkdir(parents=True, exist_ok=True)
         
         with open(save_dir / 'aquaguard_model.pkl', 'wb') as f:
-            pickle.dump(model_data, f)
+            pickle.dump(self.store_data(), f)
         
         print(f"Models saved to: {save_dir / 'aquaguard_model.pkl'}")
+
+    def restore(self, model_data):
+        self.models = model_data['models']
+        self.anomaly_detectors = model_data['anomaly_detectors']
+        self.scalers = model_data['scalers']
+        self.thresholds = model_data['thresholds']
+        # Stores written before forecasts existed load with none; the service
+        # batch-computes them once at load time
+        self.forecasts = model_data.get('forecasts', {})
+        self.forecast_horizons = model_data.get('forecast_horizons', {})
+        self.default_forecast_horizon = model_data.get('default_forecast_horizon', 30)
     
     def load_models(self, load_path):
         with open(load_path, 'rb') as f:
             model_data = pickle.load(f)
         
-        self.models = model_data['models']
-        self.anomaly_detectors = model_data['anomaly_detectors']
-        self.scalers = model_data['scalers']
-        self.thresholds = model_data['thresholds']
+        self.restore(model_data)
         
         print(f"Models loaded from: {load_path}")
     
-    def generate_model_comparison_plots(self, df):
-        output_dir = self.BASE_DIR / "outputs" / "improved_model"
-        output_dir.mkdir(parents=True, exist_ok=True)
-        for region in df['region'].unique():
-            results = self.predict_and_detect_anomalies(df, region)
-            plt.figure(figsize=(15, 10))
-            
-            plt.subplot(3, 1, 1)
-            plt.plot(results['date'], results['daily_usage'], label='Actual', alpha=0.7)
-            plt.plot(results['date'], results['predicted_usage'], label='Predicted (Improved)', linewidth=2)
-            plt.title(f'{region} Region - Actual vs Predicted Usage')
-            plt.ylabel('Usage (liters)')
-            plt.legend()
-            plt.grid(True, alpha=0.3)
-            plt.subplot(3, 1, 2)
-            plt.plot(results['date'], results['residual'], label='Residuals', alpha=0.7)
-            plt.axhline(self.thresholds[region], color='red', linestyle='--', label='Threshold')
-            plt.axhline(-self.thresholds[region], color='red', linestyle='--')
-            
-            anomaly_dates = results.loc[results['is_anomaly_ml'] == 1, 'date']
+    def generate_model_comparison_plots(self, df, output_dir=None, fmt="png", dpi=None):
+        """Render every region's three-panel analysis plot in a process pool; returns {region: path}"""
+        from app.services.rendering import PlotRenderer, analysis_job
 
-            anomaly_residuals = results.loc[
-                results['is_anomaly_ml'] == 1,
-                'residual'
-            ]
-            plt.scatter(anomaly_dates, anomaly_residuals, color='red', s=50, label='ML Anomalies', zorder=5)
-            
-            plt.title(f'{region} Region - Residuals and Anomaly Detection')
-            plt.ylabel('Residual')
-            plt.legend()
-            plt.grid(True, alpha=0.3)
-            
-            plt.subplot(3, 1, 3)
-            plt.plot(results['date'], results['combined_risk_score'], color='orange', linewidth=2)
-            plt.title(f'{region} Region - Combined Risk Score')
-            plt.xlabel('Date')
-            plt.ylabel('Risk Score (0-100)')
-            plt.grid(True, alpha=0.3)
-            plt.tight_layout()
-            plt.savefig(output_dir / f'{region}_improved_model_analysis.png', dpi=300, bbox_inches='tight')
-            plt.close()
+        renderer = PlotRenderer(output_dir or self.BASE_DIR / "outputs" / "improved_model")
+        # Regions are scored here while earlier ones render in the workers
+        jobs = (
+            analysis_job(region, self.predict_and_detect_anomalies(frame, region), self.thresholds[region])
+            for region, frame in df.groupby('region', observed=True, sort=False)
+        )
+        try:
+            return renderer.render_many(jobs, self.model_type, fmt, dpi)
+        finally:
+            renderer.shutdown()
         
 
+def load_model_store(load_path):
+    """Load a model store into the model class it was trained with"""
+    from app.services.global_model import GlobalAquaGuardModel
+    from app.services.hourly_model import HourlyAquaGuardModel
+
+    with open(load_path, 'rb') as f:
+        model_data = pickle.load(f)
+    model_classes = {
+        ImprovedAquaGuardModel.model_type: ImprovedAquaGuardModel,
+        GlobalAquaGuardModel.model_type: GlobalAquaGuardModel,
+        HourlyAquaGuardModel.model_type: HourlyAquaGuardModel,
+    }
+    model = model_classes[model_data.get('model_type', ImprovedAquaGuardModel.model_type)]()
+    model.restore(model_data)
+    print(f"Models loaded from: {load_path} ({model.model_type})")
+    return model
+
+
 def main():
     model = ImprovedAquaGuardModel()
     
@@ -0,0 +1,196 @@
+"""Bulk readings ingestion: incremental parsing and vectorized validation.
+
+Bodies are fed to an IngestParser chunk by chunk as they arrive. CSV and
+NDJSON are cut at line boundaries and parsed a block at a time (several
+MB per block), so memory is bounded by the block size plus the parsed
+columns. Arrow IPC streams are spooled and read as record batches
+(pyarrow is optional).
+
+validate_readings checks a whole batch with array operations only:
+known region, parseable day, finite non-negative usage, no duplicate
+(region, date), dates strictly increasing per region in arrival order,
+and every date after the region's last one in the history.
+"""
+import io
+import json
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+COLUMNS = ["region", "date", "daily_usage"]
+FORMATS = {
+    "text/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "application/vnd.apache.arrow.stream": "arrow",
+}
+# Larger than any span of days between two readings, so region * span + day orders by region first
+DAY_KEY_SPAN = 1 << 32
+RULES = (
+    "missing_field",
+    "unknown_region",
+    "invalid_date",
+    "invalid_usage",
+    "negative_usage",
+    "duplicate",
+    "out_of_order",
+    "not_after_history",
+)
+
+
+class IngestError(ValueError):
+    """The body cannot be parsed at all"""
+
+
+class UnsupportedFormat(IngestError):
+    """The format needs an optional dependency that is not installed"""
+
+
+class IngestParser:
+    def __init__(self, fmt: str, block_bytes: int = 8 * 1024 * 1024):
+        if fmt == "arrow":
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise UnsupportedFormat("Arrow ingestion requires pyarrow") from None
+        self.fmt = fmt
+        self.block_bytes = block_bytes
+        self.bytes_received = 0
+        self._pending = []
+        self._pending_bytes = 0
+        self._tail = b""
+        self._header = None
+        self._frames = []
+        self._spool = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) if fmt == "arrow" else None
+
+    def feed(self, chunk: bytes) -> bool:
+        """Buffer a chunk; True once a block is ready for parse_pending()"""
+        self.bytes_received += len(chunk)
+        if self._spool is not None:
+            self._spool.write(chunk)
+            return False
+        self._pending.append(chunk)
+        self._pending_bytes += len(chunk)
+        return self._pending_bytes >= self.block_bytes
+
+    def parse_pending(self, final: bool = False):
+        data = self._tail + b"".join(self._pending)
+        self._pending, self._pending_bytes = [], 0
+        cut = len(data) if final else data.rfind(b"\n") + 1
+        block, self._tail = data[:cut], data[cut:]
+        if block.strip():
+            self._frames.append(self._parse_block(block))
+
+    def _parse_block(self, block: bytes) -> pd.DataFrame:
+        if self.fmt == "ndjson":
+            lines = [line for line in block.split(b"\n") if line.strip()]
+            try:
+                records = json.loads(b"[" + b",".join(lines) + b"]")
+            except ValueError as e:
+                raise IngestError(f"Invalid NDJSON: {e}") from None
+            return pd.DataFrame({
+                column: [r.get(column) if isinstance(r, dict) else None for r in records]
+                for column in COLUMNS
+            })
+
+        if self._header is None:
+            end = block.index(b"\n") + 1 if b"\n" in block else len(block)
+            self._header = pd.read_csv(io.BytesIO(block[:end]), nrows=0).columns.tolist()
+            missing = set(COLUMNS) - set(self._header)
+            if missing:
+                raise IngestError(f"CSV header lacks columns: {sorted(missing)}")
+            block = block[end:]
+        try:
+            frame = pd.read_csv(io.BytesIO(block), header=None, names=self._header,
+                                usecols=COLUMNS, dtype={"region": str, "date": str})
+        except (ValueError, pd.errors.ParserError) as e:
+            raise IngestError(f"Invalid CSV: {e}") from None
+        return frame[COLUMNS]
+
+    def finish(self) -> pd.DataFrame:
+        """All rows received, with raw (unvalidated) region, date and daily_usage"""
+        if self._spool is not None:
+            import pyarrow as pa
+
+            self._spool.seek(0)
+            try:
+                table = pa.ipc.open_stream(self._spool).read_all()
+            except pa.ArrowInvalid as e:
+                raise IngestError(f"Invalid Arrow stream: {e}") from None
+            missing = set(COLUMNS) - set(table.column_names)
+            if missing:
+                raise IngestError(f"Arrow stream lacks columns: {sorted(missing)}")
+            self._spool.close()
+            return table.select(COLUMNS).to_pandas()
+
+        self.parse_pending(final=True)
+        if not self._frames:
+            return pd.DataFrame({column: pd.Series(dtype=object) for column in COLUMNS})
+        return pd.concat(self._frames, ignore_index=True)
+
+
+def validate_readings(raw: pd.DataFrame, regions, last_dates: pd.Series):
+    """Clean rows (region, date, daily_usage) and a row mask per rule, True where it failed
+
+    regions are the known region names; last_dates maps each region to the
+    newest date already in the history.
+    """
+    n = len(raw)
+    failures = {rule: np.zeros(n, dtype=bool) for rule in RULES}
+
+    failures["missing_field"] = raw[COLUMNS].isna().any(axis=1).to_numpy()
+    categories = pd.Index(list(regions))
+    codes = pd.Categorical(raw["region"], categories=categories).codes
+    failures["unknown_region"] = (codes < 0) & raw["region"].notna().to_numpy()
+
+    dates = pd.to_datetime(raw["date"], errors="coerce", format="ISO8601")
+    # Dates outside the nanosecond range the history uses count as invalid
+    dates = dates.where((dates >= pd.Timestamp.min) & (dates <= pd.Timestamp.max))
+    failures["invalid_date"] = (
+        dates.isna() | (dates != dates.dt.normalize())
+    ).to_numpy() & raw["date"].notna().to_numpy()
+    date_values = dates.to_numpy(dtype="datetime64[ns]")
+
+    usage = pd.to_numeric(raw["daily_usage"], errors="coerce").to_numpy(dtype=np.float64)
+    failures["invalid_usage"] = ~np.isfinite(usage) & raw["daily_usage"].notna().to_numpy()
+    failures["negative_usage"] = usage < 0
+
+    usable = (codes >= 0) & ~failures["invalid_date"] & ~np.isnat(date_values)
+    # Each row must be later than every earlier row of its region. Rows are
+    # grouped by region (stable, so arrival order is kept) and keyed so that
+    # one running maximum over the whole array restarts at every region.
+    order = np.flatnonzero(usable)
+    order = order[np.argsort(codes[order], kind="stable")]
+    days = date_values[order].astype("datetime64[D]").astype(np.int64)
+    key = codes[order].astype(np.int64) * DAY_KEY_SPAN + (days - days.min() if len(days) else days)
+    previous = np.maximum.accumulate(key)[:-1]
+    failures["duplicate"][order[1:][key[1:] == previous]] = True
+    failures["out_of_order"][order[1:][key[1:] < previous]] = True
+
+    last = last_dates.reindex(categories).to_numpy(dtype="datetime64[ns]")
+    known = np.flatnonzero(usable)
+    stale = date_values[known] <= last[codes[known]]
+    failures["not_after_history"][known[stale]] = True
+
+    invalid = np.logical_or.reduce(list(failures.values()))
+    valid = ~invalid
+    rows = pd.DataFrame({
+        "region": categories[codes[valid]],
+        "date": date_values[valid],
+        "daily_usage": usage[valid],
+    })
+    return rows, failures
+
+
+def report(failures: dict, sample: int = 20) -> dict:
+    """Per-rule counts and the first failing (0-based) row numbers"""
+    counts = {rule: int(mask.sum()) for rule, mask in failures.items() if mask.any()}
+    invalid = np.logical_or.reduce(list(failures.values())) if failures else np.zeros(0, bool)
+    samples = []
+    for row in np.flatnonzero(invalid)[:sample].tolist():
+        samples.append({
+            "row": row,
+            "rules": [rule for rule, mask in failures.items() if mask[row]],
+        })
+    return {"rows_rejected": int(invalid.sum()), "errors": counts, "sample_errors": samples}
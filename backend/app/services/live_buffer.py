@@ -0,0 +1,105 @@
+"""Per-region live history in fixed-capacity ring buffers over preallocated NumPy arrays.
+
+Every point is written twice, at i and i + capacity, so the last n points
+(n <= capacity) always occupy one contiguous range of the doubled arrays
+and can be read with one slice per column, without re-ordering. Windows are
+copied under the buffer's lock, since the tick thread keeps appending.
+"""
+import os
+import threading
+
+import numpy as np
+
+STATUS_CODES = {"normal": 0, "elevated": 1, "new_elevation": 2}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+
+
+class RingBuffer:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = np.zeros(2 * capacity, dtype=np.float64)
+        self.consumption = np.zeros(2 * capacity, dtype=np.float32)
+        self.risk = np.zeros(2 * capacity, dtype=np.float32)
+        self.status = np.zeros(2 * capacity, dtype=np.int8)
+        self.head = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    @property
+    def last_timestamp(self):
+        return self.timestamps[self.head + self.capacity - 1] if self.count else None
+
+    def append(self, timestamp: float, consumption: float, risk: float, status: int):
+        with self._lock:
+            for i in (self.head, self.head + self.capacity):
+                self.timestamps[i] = timestamp
+                self.consumption[i] = consumption
+                self.risk[i] = risk
+                self.status[i] = status
+            self.head = (self.head + 1) % self.capacity
+            self.count += 1
+
+    def window(self, points: int = None, start: float = None, end: float = None) -> dict:
+        """Copies of the last `points` readings, optionally limited to [start, end] (epoch seconds)"""
+        with self._lock:
+            stop = self.head + self.capacity
+            base = lo = stop - len(self)
+            timestamps = self.timestamps[base:stop]
+            if start is not None:
+                lo = base + int(np.searchsorted(timestamps, start, side="left"))
+            if end is not None:
+                stop = base + int(np.searchsorted(timestamps, end, side="right"))
+            if points is not None:
+                lo = max(lo, stop - points)
+            lo = min(lo, stop)
+            return {
+                "timestamps": self.timestamps[lo:stop].copy(),
+                "consumption": self.consumption[lo:stop].copy(),
+                "risk": self.risk[lo:stop].copy(),
+                "status": self.status[lo:stop].copy(),
+            }
+
+
+def downsample(window: dict, max_points: int) -> dict:
+    """Average consumption and risk over equal buckets; keep each bucket's last timestamp and worst status"""
+    n = len(window["timestamps"])
+    if max_points <= 0 or n <= max_points:
+        return window
+    starts = np.linspace(0, n, max_points, endpoint=False).astype(np.intp)
+    sizes = np.diff(np.append(starts, n))
+    return {
+        "timestamps": window["timestamps"][starts + sizes - 1],
+        "consumption": np.add.reduceat(window["consumption"], starts, dtype=np.float64) / sizes,
+        "risk": np.add.reduceat(window["risk"], starts, dtype=np.float64) / sizes,
+        "status": np.maximum.reduceat(window["status"], starts),
+    }
+
+
+class LiveHistory:
+    """One RingBuffer per region, allocated on the region's first reading"""
+
+    def __init__(self, capacity: int = None):
+        if capacity is None:
+            capacity = int(os.environ.get("AQUAGUARD_LIVE_HISTORY_POINTS", "4096"))
+        self.capacity = capacity
+        self.buffers = {}
+        self._lock = threading.Lock()
+
+    def append(self, region: str, timestamp: float, consumption: float, risk: float, status: str):
+        buffer = self.buffers.get(region)
+        if buffer is None:
+            with self._lock:
+                buffer = self.buffers.setdefault(region, RingBuffer(self.capacity))
+        buffer.append(timestamp, consumption, risk, STATUS_CODES.get(status, 0))
+
+    def get(self, region: str):
+        return self.buffers.get(region)
+
+    def memory_bytes(self) -> int:
+        return sum(
+            b.timestamps.nbytes + b.consumption.nbytes + b.risk.nbytes + b.status.nbytes
+            for b in list(self.buffers.values())
+        )
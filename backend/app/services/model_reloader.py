@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+from datetime import datetime
+
+
+class ModelReloader:
+    """Loads a new model store and history in the background and swaps it in
+
+    The new state is fully loaded and its result cache prewarmed before it is
+    installed, so rollouts never pay the pickle load or the first-request
+    scoring cost on the serving path. Requests already running keep using the
+    state they started with.
+    """
+
+    def __init__(self, service, poll_interval_seconds: int = 10):
+        self.service = service
+        self.poll_interval_seconds = poll_interval_seconds
+        self.status = {"state": "idle"}
+        self._lock = threading.Lock()
+        self._reload_thread = None
+        self._watch_thread = None
+        self._stop = threading.Event()
+
+    def start_reload(self, model_path=None, data_path=None) -> dict:
+        """Kick off a background reload unless one is already running"""
+        if self.service.attached:
+            raise RuntimeError("This process serves attached state; restart app.serve to reload")
+        with self._lock:
+            if self._reload_thread is not None and self._reload_thread.is_alive():
+                return dict(self.status)
+            self.status = {
+                "state": "loading",
+                "started_at": datetime.now().isoformat(),
+                "previous_version": self.service.version,
+            }
+            self._reload_thread = threading.Thread(
+                target=self._reload, args=(model_path, data_path),
+                name="aquaguard-model-reload", daemon=True
+            )
+            self._reload_thread.start()
+            return dict(self.status)
+
+    def _reload(self, model_path, data_path):
+        started = time.perf_counter()
+        try:
+            state = self.service.load_state(model_path, data_path)
+            self.status = {**self.status, "state": "prewarming", "version": state.version}
+            self.service.prewarm(state)
+            self.service.install_state(state)
+            self.status = {
+                **self.status,
+                "state": "completed",
+                "finished_at": datetime.now().isoformat(),
+                "duration_seconds": round(time.perf_counter() - started, 2),
+            }
+        except Exception as e:
+            print(f"Model reload failed: {e}")
+            self.status = {
+                **self.status,
+                "state": "failed",
+                "error": str(e),
+                "finished_at": datetime.now().isoformat(),
+            }
+
+    def get_status(self) -> dict:
+        return {
+            **self.status,
+            "current_version": self.service.version,
+            "watching": self._watch_thread is not None,
+        }
+
+    def _watched_mtimes(self):
+        paths = (self.service.model_path, self.service.data_path)
+        return tuple(os.path.getmtime(p) if os.path.exists(p) else None for p in paths)
+
+    def start_watching(self):
+        """Poll the model store and data file and reload when either changes"""
+        if self._watch_thread is not None:
+            return
+        self._stop.clear()
+        self._watch_thread = threading.Thread(
+            target=self._watch, name="aquaguard-model-watcher", daemon=True
+        )
+        self._watch_thread.start()
+
+    def stop_watching(self):
+        self._stop.set()
+        if self._watch_thread is not None:
+            self._watch_thread.join(timeout=5)
+            self._watch_thread = None
+
+    def _watch(self):
+        last_seen = self._watched_mtimes()
+        while not self._stop.wait(self.poll_interval_seconds):
+            current = self._watched_mtimes()
+            # Skip half-written files; the next poll will pick them up
+            if current != last_seen and None not in current:
+                last_seen = current
+                print("Model store or data changed on disk, reloading")
+                self.start_reload()
@@ -0,0 +1,89 @@
+"""Online anomaly detection: EWMA robust z-score, O(1) time and memory per reading.
+
+Each stream keeps an exponentially weighted center and mean absolute
+deviation. A reading is scored against the state *before* it is folded in,
+and is winsorized to center +/- clip * scale when folded in, so a burst of
+anomalies only nudges the baseline instead of becoming the new normal.
+"""
+import math
+
+import numpy as np
+
+# Mean absolute deviation of a normal distribution is sigma * sqrt(2 / pi)
+MAD_TO_SIGMA = math.sqrt(math.pi / 2)
+
+
+class EWMARobustZScore:
+    def __init__(self, alpha: float = 0.05, threshold: float = 3.5, warmup: int = 10,
+                 clip: float = 4.0):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.warmup = warmup
+        self.clip = clip
+        self.center = None
+        self.deviation = 0.0
+        self.count = 0
+
+    @property
+    def scale(self) -> float:
+        return MAD_TO_SIGMA * self.deviation
+
+    def score(self, value: float) -> float:
+        scale = self.scale
+        if self.center is None or scale <= 0:
+            return 0.0
+        return abs(value - self.center) / scale
+
+    def update(self, value: float):
+        """Score a reading, then fold it into the baseline; returns (z, is_anomaly)"""
+        if value is None or math.isnan(value):
+            return 0.0, False
+        z = self.score(value)
+        is_anomaly = self.count >= self.warmup and z >= self.threshold
+
+        if self.center is None:
+            self.center = value
+        else:
+            if self.count >= self.warmup:
+                limit = self.clip * self.scale
+                value = min(max(value, self.center - limit), self.center + limit)
+            diff = value - self.center
+            self.center += self.alpha * diff
+            self.deviation = (1 - self.alpha) * self.deviation + self.alpha * abs(diff)
+        self.count += 1
+        return z, is_anomaly
+
+
+def score_stream(values, **params):
+    """Run a fresh detector over a sequence; returns z-scores and anomaly flags"""
+    detector = EWMARobustZScore(**params)
+    scores = np.zeros(len(values))
+    flags = np.zeros(len(values), dtype=int)
+    for i, value in enumerate(values):
+        scores[i], flags[i] = detector.update(float(value))
+    return scores, flags
+
+
+class OnlineAnomalyDetector:
+    """One EWMARobustZScore per region, created on first reading"""
+
+    def __init__(self, **params):
+        self.params = params
+        self.streams = {}
+
+    def update(self, region: str, value: float):
+        stream = self.streams.get(region)
+        if stream is None:
+            stream = self.streams[region] = EWMARobustZScore(**self.params)
+        return stream.update(value)
+
+    def snapshot(self) -> dict:
+        return {
+            region: [stream.center, stream.deviation, stream.count]
+            for region, stream in list(self.streams.items())
+        }
+
+    def restore(self, snapshot: dict):
+        for region, (center, deviation, count) in snapshot.items():
+            stream = self.streams[region] = EWMARobustZScore(**self.params)
+            stream.center, stream.deviation, stream.count = center, deviation, count
@@ -0,0 +1,232 @@
+"""Chart rendering in a process pool, with content-addressed output files.
+
+A plot is identified by what it depicts: its kind, region, a digest of the
+region's data, the model version, format and dpi. The file is named after
+the SHA-256 of that key, so an existing file is always current and is
+served without re-rendering, while new data or a new model simply produces
+a new name. Old files are never read again and can be deleted at any time;
+the renderer keeps at most max_files of them (AQUAGUARD_PLOT_CACHE_FILES,
+default 5000), dropping the least recently served first.
+
+Workers receive plain NumPy columns, never the model, and draw on a
+standalone matplotlib Figure with the Agg canvas (no pyplot state), so
+rendering thousands of regions scales with the number of cores.
+"""
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+KINDS = ("analysis", "consumption")
+
+
+def _draw_analysis(fig, job):
+    dates = job["date"]
+    ax = fig.add_subplot(3, 1, 1)
+    ax.plot(dates, job["daily_usage"], label="Actual", alpha=0.7)
+    ax.plot(dates, job["predicted_usage"], label="Predicted (Improved)", linewidth=2)
+    ax.set_title(f"{job['region']} Region - Actual vs Predicted Usage")
+    ax.set_ylabel("Usage (liters)")
+    ax.legend()
+    ax.grid(True, alpha=0.3)
+
+    ax = fig.add_subplot(3, 1, 2)
+    ax.plot(dates, job["residual"], label="Residuals", alpha=0.7)
+    ax.axhline(job["threshold"], color="red", linestyle="--", label="Threshold")
+    ax.axhline(-job["threshold"], color="red", linestyle="--")
+    anomalies = job["is_anomaly"]
+    ax.scatter(dates[anomalies], job["residual"][anomalies], color="red", s=50,
+               label="ML Anomalies", zorder=5)
+    ax.set_title(f"{job['region']} Region - Residuals and Anomaly Detection")
+    ax.set_ylabel("Residual")
+    ax.legend()
+    ax.grid(True, alpha=0.3)
+
+    ax = fig.add_subplot(3, 1, 3)
+    ax.plot(dates, job["risk_score"], color="orange", linewidth=2)
+    ax.set_title(f"{job['region']} Region - Combined Risk Score")
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Risk Score (0-100)")
+    ax.grid(True, alpha=0.3)
+
+
+def _draw_consumption(fig, job):
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot(job["date"], job["daily_usage"])
+    ax.set_title(f"Water Consumption – Region {job['region']}")
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Consumption (liters)")
+
+
+FIGURE_SIZES = {"analysis": (15, 10), "consumption": (10, 4)}
+DRAWERS = {"analysis": _draw_analysis, "consumption": _draw_consumption}
+
+
+def render_job(job: dict) -> str:
+    """Draw one plot and write it atomically to job["path"]; runs in a worker process"""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=FIGURE_SIZES[job["kind"]])
+    FigureCanvasAgg(fig)
+    DRAWERS[job["kind"]](fig, job)
+    fig.tight_layout()
+
+    path = Path(job["path"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(f"{path.name}.{os.getpid()}.partial")
+    fig.savefig(partial, format=job["format"], dpi=job["dpi"])
+    os.replace(partial, path)
+    return str(path)
+
+
+def data_digest(*columns) -> str:
+    """Digest of the values a plot depicts"""
+    digest = hashlib.sha256()
+    for column in columns:
+        digest.update(np.ascontiguousarray(column).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def analysis_job(region: str, results, threshold: float) -> dict:
+    """Columns of a result frame (predict_and_detect_anomalies output) for an analysis plot"""
+    return {
+        "kind": "analysis",
+        "region": region,
+        "date": results["date"].to_numpy(),
+        "daily_usage": results["daily_usage"].to_numpy(dtype=np.float64),
+        "predicted_usage": results["predicted_usage"].to_numpy(dtype=np.float64),
+        "residual": results["residual"].to_numpy(dtype=np.float64),
+        "is_anomaly": results["is_anomaly_ml"].to_numpy() == 1,
+        "risk_score": results["combined_risk_score"].to_numpy(dtype=np.float64),
+        "threshold": float(threshold),
+    }
+
+
+def consumption_job(region: str, dates, usage) -> dict:
+    return {
+        "kind": "consumption",
+        "region": region,
+        "date": pd.to_datetime(pd.Series(dates)).to_numpy(),
+        "daily_usage": np.asarray(usage, dtype=np.float64),
+    }
+
+
+class PlotRenderer:
+    def __init__(self, output_dir: str = "outputs/plots", workers: int = None, dpi: int = None,
+                 max_files: int = None):
+        if workers is None:
+            workers = int(os.environ.get("AQUAGUARD_RENDER_WORKERS", "0")) or os.cpu_count() or 1
+        if dpi is None:
+            dpi = int(os.environ.get("AQUAGUARD_PLOT_DPI", "100"))
+        if max_files is None:
+            max_files = int(os.environ.get("AQUAGUARD_PLOT_CACHE_FILES", "5000"))
+        self.output_dir = Path(output_dir)
+        self.workers = workers
+        self.dpi = dpi
+        self.max_files = max_files
+        # Renders since the last prune; the directory is only scanned every max_files/10
+        self._renders_since_prune = None
+        self._pool = None
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn: forking a server process that runs threads is unsafe
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=get_context("spawn"))
+            return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    def path_for(self, job: dict, model_version: str, fmt: str, dpi: int = None) -> Path:
+        """Content-addressed location of a job's output"""
+        dpi = dpi or self.dpi
+        columns = [job[k] for k in sorted(job) if isinstance(job[k], np.ndarray)]
+        key = "|".join([
+            job["kind"], job["region"], data_digest(*columns), str(job.get("threshold")),
+            model_version, fmt, str(dpi),
+        ])
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return self.output_dir / job["kind"] / f"{name}.{fmt}"
+
+    def submit(self, job: dict, model_version: str = "", fmt: str = "png", dpi: int = None):
+        """Future resolving to the output path; existing files and in-flight renders are reused"""
+        path = self.path_for(job, model_version, fmt, dpi)
+        if path.exists():
+            try:
+                os.utime(path)  # mark as recently served for prune()
+            except FileNotFoundError:
+                pass
+            future = Future()
+            future.set_result(str(path))
+            return future
+
+        executor = self._executor()
+        with self._lock:
+            future = self._in_flight.get(path)
+            started = future is None
+            if started:
+                job = {**job, "path": str(path), "format": fmt, "dpi": dpi or self.dpi}
+                future = self._in_flight[path] = executor.submit(render_job, job)
+        if started:
+            future.add_done_callback(lambda f: self._forget(path, f))
+        return future
+
+    def _forget(self, path, future):
+        with self._lock:
+            self._in_flight.pop(path, None)
+            if isinstance(future.exception(), BrokenProcessPool):
+                self._pool = None  # a worker died; start a fresh pool on the next render
+            due = self._renders_since_prune is None or \
+                self._renders_since_prune >= max(1, self.max_files // 10)
+            self._renders_since_prune = 0 if due else self._renders_since_prune + 1
+        if due:
+            self.prune()
+
+    def prune(self) -> int:
+        """Delete the least recently served files beyond max_files, and abandoned partial files"""
+        if not self.output_dir.exists():
+            return 0
+        files, removed = [], 0
+        for path in self.output_dir.glob("*/*"):
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if path.suffix == ".partial":
+                if time.time() - mtime > 3600:
+                    path.unlink(missing_ok=True)
+                    removed += 1
+            else:
+                files.append((mtime, path))
+        files.sort()
+        for _, path in files[:max(0, len(files) - self.max_files)]:
+            path.unlink(missing_ok=True)
+            removed += 1
+        return removed
+
+    def render(self, job: dict, model_version: str = "", fmt: str = "png", dpi: int = None) -> Path:
+        return Path(self.submit(job, model_version, fmt, dpi).result())
+
+    def render_many(self, jobs, model_version: str = "", fmt: str = "png", dpi: int = None) -> dict:
+        """Render all jobs in parallel; returns {region: path}"""
+        futures = {job["region"]: self.submit(job, model_version, fmt, dpi) for job in jobs}
+        return {region: Path(future.result()) for region, future in futures.items()}
+
+
+# Shared by the API; the pool starts on the first render
+plot_renderer = PlotRenderer()
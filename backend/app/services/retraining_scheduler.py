@@ -0,0 +1,219 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+
+class RegionResidualStats:
+    """Rolling residual statistics for a single region"""
+
+    def __init__(self, window: int):
+        self.recent = deque(maxlen=window)
+        self.baseline_mean = None
+        self.baseline_std = None
+        self.baseline_count = 0
+        self.last_observed = None
+
+    def update(self, results, deployment_date):
+        """Refresh baseline and recent residual windows from a scored results frame"""
+        abs_residual = results["abs_residual"].to_numpy(dtype=float)
+        dates = results["date"]
+
+        if deployment_date is not None:
+            history_mask = (dates <= deployment_date).to_numpy()
+        else:
+            history_mask = np.ones(len(results), dtype=bool)
+            history_mask[-self.recent.maxlen:] = False
+
+        baseline = abs_residual[history_mask]
+        baseline = baseline[~np.isnan(baseline)]
+        if len(baseline) > 1:
+            self.baseline_mean = float(baseline.mean())
+            self.baseline_std = float(baseline.std(ddof=1))
+            self.baseline_count = len(baseline)
+
+        live = abs_residual[~history_mask]
+        live = live[~np.isnan(live)]
+        self.recent.clear()
+        self.recent.extend(live[-self.recent.maxlen:].tolist())
+        self.last_observed = datetime.now()
+
+    def drift_statistics(self):
+        """Return (z_score, error_ratio) of the recent window against the baseline"""
+        if self.baseline_mean is None or len(self.recent) == 0:
+            return None, None
+
+        recent_mean = float(np.mean(self.recent))
+        standard_error = (self.baseline_std or 0.0) / np.sqrt(len(self.recent))
+        z_score = (recent_mean - self.baseline_mean) / standard_error if standard_error > 0 else 0.0
+        ratio = recent_mean / self.baseline_mean if self.baseline_mean > 0 else 0.0
+        return float(z_score), float(ratio)
+
+
+class DriftRetrainingScheduler:
+    """Flags regions whose residual distribution has shifted and retrains only those
+
+    Residual statistics are fed from scored results (either request traffic or
+    the periodic background sweep). Drifted regions are retrained on a bounded
+    thread pool and swapped into the owning service one region at a time.
+    """
+
+    def __init__(self, service, window: int = 30, z_threshold: float = 3.0,
+                 min_error_ratio: float = 1.25, max_workers: int = 2,
+                 max_pending: int = 4, cooldown_seconds: int = 3600,
+                 check_interval_seconds: int = 900):
+        self.service = service
+        self.window = window
+        self.z_threshold = z_threshold
+        self.min_error_ratio = min_error_ratio
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.cooldown_seconds = cooldown_seconds
+        self.check_interval_seconds = check_interval_seconds
+
+        self.stats = {}
+        self.pending = set()
+        self.last_retrained = {}
+        # Data version each region was last refit on; no refit until it changes
+        self.retrained_on = {}
+        self.retrain_history = deque(maxlen=50)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start the worker pool and the periodic drift sweep"""
+        if self._thread is not None:
+            return
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="aquaguard-retrain"
+        )
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="aquaguard-drift-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop the sweep thread and wait for running retrains to finish"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval_seconds):
+            for region in self.service.get_available_regions():
+                if self._stop.is_set():
+                    return
+                try:
+                    # Cached results skip observe() in compute_results, so feed them here:
+                    # regions that drifted while the queue was full or in cooldown get resubmitted
+                    results = self.service.compute_results(region)
+                    self.observe(region, results, self.service.deployment_date)
+                except Exception as e:
+                    print(f"Drift check failed for {region}: {e}")
+
+    def observe(self, region: str, results, deployment_date=None):
+        """Update residual statistics for a region and queue a retrain if it drifted"""
+        with self._lock:
+            stats = self.stats.get(region)
+            if stats is None:
+                stats = self.stats[region] = RegionResidualStats(self.window)
+            stats.update(results, deployment_date)
+
+        if self.is_drifted(region):
+            self._submit(region)
+
+    def is_drifted(self, region: str) -> bool:
+        stats = self.stats.get(region)
+        if stats is None:
+            return False
+        z_score, ratio = stats.drift_statistics()
+        if z_score is None:
+            return False
+        return z_score >= self.z_threshold and ratio >= self.min_error_ratio
+
+    def _submit(self, region: str):
+        if self._executor is None:
+            return
+        state = self.service.state
+        with self._lock:
+            if region in self.pending or len(self.pending) >= self.max_pending:
+                return
+            last = self.last_retrained.get(region)
+            if last is not None and time.time() - last < self.cooldown_seconds:
+                return
+            if self.retrained_on.get(region) == state.data_version:
+                return
+            self.pending.add(region)
+        self._executor.submit(self._retrain, region, state)
+
+    def _retrain(self, region: str, state):
+        started = time.perf_counter()
+        stats = self.stats.get(region)
+        z_score, ratio = stats.drift_statistics() if stats else (None, None)
+        try:
+            components = state.model.train_region(state.df, region)
+            # Dropped if a reload or ingest installed newer data in the meantime
+            if self.service.swap_region_models(region, *components,
+                                               data_version=state.data_version):
+                status = "completed"
+            else:
+                status = "stale"
+        except Exception as e:
+            print(f"Retraining failed for {region}: {e}")
+            status = "failed"
+        finally:
+            with self._lock:
+                self.pending.discard(region)
+                self.stats.pop(region, None)
+                if status != "stale":
+                    self.last_retrained[region] = time.time()
+                    self.retrained_on[region] = state.data_version
+
+        self.retrain_history.append({
+            "region": region,
+            "status": status,
+            "z_score": round(z_score, 2) if z_score is not None else None,
+            "error_ratio": round(ratio, 2) if ratio is not None else None,
+            "duration_seconds": round(time.perf_counter() - started, 2),
+            "finished_at": datetime.now().isoformat(),
+        })
+
+    def get_status(self) -> dict:
+        # _retrain updates pending and stats from worker threads
+        with self._lock:
+            pending = set(self.pending)
+            all_stats = list(self.stats.items())
+        regions = {}
+        for region, stats in all_stats:
+            z_score, ratio = stats.drift_statistics()
+            if region in pending:
+                state = "retraining"
+            elif self.is_drifted(region):
+                state = "drifted"
+            else:
+                state = "ok"
+            regions[region] = {
+                "state": state,
+                "z_score": round(z_score, 2) if z_score is not None else None,
+                "error_ratio": round(ratio, 2) if ratio is not None else None,
+                "last_observed": stats.last_observed.isoformat() if stats.last_observed else None,
+            }
+        for region in pending:
+            regions.setdefault(region, {"state": "retraining"})
+
+        return {
+            "running": self._thread is not None,
+            "pending": sorted(pending),
+            "regions": regions,
+            "recent_retrains": list(self.retrain_history),
+        }
@@ -0,0 +1,147 @@
+import json
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+SHARED_STATE_ENV = "AQUAGUARD_SHARED_STATE"
+_ALIGNMENT = 64
+# Attached blocks stay mapped for the lifetime of the worker
+_attached_blocks = []
+
+
+def _frame_columns(frame):
+    """Split a frame into (name, contiguous array, decode info) triples"""
+    columns = []
+    for name in frame.columns:
+        series = frame[name]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            values = series.to_numpy(dtype="datetime64[ns]").view("int64")
+            columns.append((name, np.ascontiguousarray(values), {"kind": "datetime"}))
+        elif pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+            columns.append((name, np.ascontiguousarray(series.to_numpy()), {"kind": "numeric"}))
+        else:
+            categorical = pd.Categorical(series)
+            codes = np.ascontiguousarray(categorical.codes)
+            columns.append((name, codes, {
+                "kind": "categorical",
+                "categories": [str(c) for c in categorical.categories],
+            }))
+    return columns
+
+
+class SharedStatePublisher:
+    """Copies a loaded ServiceState into one shared memory block for worker processes
+
+    The history frame and every region's precomputed results are stored as
+    contiguous column arrays. A small JSON manifest describes the layout and is
+    written next to the model store; workers find it through the
+    AQUAGUARD_SHARED_STATE environment variable.
+    """
+
+    def __init__(self, manifest_path: str = "models/shared_state.json"):
+        self.manifest_path = manifest_path
+        self.shm = None
+
+    def publish(self, state) -> str:
+        regions = [r for r in state.regions if r in state.results]
+        results = pd.concat([state.results[r] for r in regions], ignore_index=True)
+        offsets = np.cumsum([0] + [len(state.results[r]) for r in regions]).tolist()
+
+        sections = {"history": _frame_columns(state.df), "results": _frame_columns(results)}
+
+        layout = {}
+        total = 0
+        for section, columns in sections.items():
+            layout[section] = []
+            for name, values, decode in columns:
+                total = -(-total // _ALIGNMENT) * _ALIGNMENT
+                layout[section].append({
+                    "name": name,
+                    "offset": total,
+                    "dtype": values.dtype.str,
+                    "length": len(values),
+                    **decode,
+                })
+                total += values.nbytes
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(total, 1))
+        for section, columns in sections.items():
+            for (name, values, _), meta in zip(columns, layout[section]):
+                target = np.ndarray(values.shape, dtype=values.dtype,
+                                    buffer=self.shm.buf, offset=meta["offset"])
+                target[:] = values
+
+        manifest = {
+            "shm_name": self.shm.name,
+            "size": total,
+            "version": state.version,
+            "regions": regions,
+            "result_offsets": offsets,
+            "layout": layout,
+        }
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        with open(self.manifest_path, "w") as f:
+            json.dump(manifest, f)
+
+        print(f"Published shared state {state.version} ({total / 1e6:.1f} MB) as {self.shm.name}")
+        return self.manifest_path
+
+    def close(self):
+        """Release and unlink the shared block (parent process only)"""
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+
+def _attach_block(name: str):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always registers the block with the resource tracker.
+        # Uvicorn workers are spawned from the publishing parent and share its
+        # tracker, so the registration is a no-op and the block is only
+        # unlinked once the parent shuts down.
+        return shared_memory.SharedMemory(name=name)
+
+
+def _read_frame(shm, columns, start=0, stop=None):
+    data = {}
+    for meta in columns:
+        values = np.ndarray((meta["length"],), dtype=np.dtype(meta["dtype"]),
+                            buffer=shm.buf, offset=meta["offset"])[start:stop]
+        values.flags.writeable = False
+        if meta["kind"] == "datetime":
+            data[meta["name"]] = values.view("datetime64[ns]")
+        elif meta["kind"] == "categorical":
+            data[meta["name"]] = pd.Categorical.from_codes(values, meta["categories"])
+        else:
+            data[meta["name"]] = values
+    return pd.DataFrame(data, copy=False)
+
+
+def attach_shared_state(manifest_path: str):
+    """Return (history_df, results_by_region, version) backed by the parent's block
+
+    Frames are read-only views into shared memory; nothing is copied. String
+    columns come back as categoricals over the shared codes.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    shm = _attach_block(manifest["shm_name"])
+    df = _read_frame(shm, manifest["layout"]["history"])
+
+    offsets = manifest["result_offsets"]
+    results = {}
+    for i, region in enumerate(manifest["regions"]):
+        results[region] = _read_frame(
+            shm, manifest["layout"]["results"], offsets[i], offsets[i + 1]
+        )
+
+    _attached_blocks.append(shm)
+    return df, results, manifest["version"]
@@ -0,0 +1,276 @@
+"""Water balance: supply-meter inflow reconciled against downstream consumption.
+
+The supply topology (data/supply_topology.json or AQUAGUARD_SUPPLY_TOPOLOGY)
+lists the inflow meters, the regions each one feeds directly and the
+meters nested below it, e.g.
+
+    {"meters": {"Main": {"meters": ["North Trunk", "South Trunk"]},
+                "North Trunk": {"regions": ["North", "East"]},
+                "South Trunk": {"regions": {"South": 1.0, "West": 0.6, "Central": 1.0}},
+                "West Booster": {"regions": {"West": 0.4}}}}
+
+A region's share (default 1) is the fraction of its consumption supplied
+through that meter, for regions fed from several. The topology is held as
+sparse matrices: F (meters x regions, direct feeds) and S (meters x meters,
+S[i, j] = 1 when meter j is meter i itself or nested below it), so the
+consumption downstream of every meter over every day is one sparse
+product, (S @ F) @ usage, for any number of meters and regions.
+
+Daily meter readings come from data/water_inflow.csv (AQUAGUARD_INFLOW_DATA)
+with columns meter, date, inflow. Per meter and day:
+
+- imbalance = inflow - downstream consumption (non-revenue water, liters)
+- nrw_ratio = imbalance / inflow
+- imbalance_z = the ratio's rise above its median of the previous 28 days,
+  in units of the meter's robust spread
+
+Every network loses some water, so a leak shows as a change against the
+meter's own baseline rather than in the raw ratio. A region's signal is
+the share-weighted z of the meters feeding it directly (the smallest
+metered areas containing it); a day without readings for every region
+downstream of a meter cannot be reconciled and stays NaN. The signal's
+severity is added to the region's raw risk by predict_and_detect_anomalies.
+"""
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from app.services.calendar_grid import CalendarGrid
+from app.services.hourly_model import MAD_SCALE, trailing_median
+
+TOPOLOGY_ENV = "AQUAGUARD_SUPPLY_TOPOLOGY"
+INFLOW_ENV = "AQUAGUARD_INFLOW_DATA"
+DEFAULT_TOPOLOGY_PATH = "data/supply_topology.json"
+DEFAULT_INFLOW_PATH = "data/water_inflow.csv"
+
+BASELINE_DAYS = 28
+BASELINE_MIN = 7
+# z at which an imbalance is flagged, and below which it adds no risk
+IMBALANCE_Z = 3.5
+SEVERITY_FLOOR_Z = 1.0
+# Meters per block when computing trailing medians (bounds temporary memory)
+BLOCK_METERS = 1024
+
+_supplies = {}
+
+
+class SupplyTopology:
+    def __init__(self, meters, regions, feeds, children):
+        """feeds: (meters x regions) shares; children: (meters x meters), 1 where j is nested in i"""
+        self.meters = list(meters)
+        self.regions = list(regions)
+        self.meter_index = {m: i for i, m in enumerate(self.meters)}
+        self.region_index = {r: i for i, r in enumerate(self.regions)}
+        self.feeds = sparse.csr_matrix(feeds, dtype=np.float64)
+        self.children = sparse.csr_matrix(children, dtype=np.float64)
+        self.subtree = self._closure(self.children)
+
+    @staticmethod
+    def _closure(children):
+        """I + C + C^2 + ..., one sparse product per nesting level"""
+        n = children.shape[0]
+        subtree = sparse.identity(n, dtype=np.float64, format="csr")
+        frontier = subtree
+        for _ in range(n + 1):
+            frontier = (frontier @ children).tocsr()
+            if not frontier.nnz:
+                subtree.data[:] = 1.0
+                return subtree
+            subtree = subtree + frontier
+        raise ValueError("Supply topology has a cycle of nested meters")
+
+    @classmethod
+    def from_config(cls, config: dict) -> "SupplyTopology":
+        specs = config.get("meters", {})
+        meters = list(specs)
+        for spec in specs.values():
+            meters.extend(m for m in spec.get("meters", []) if m not in specs)
+        meters = list(dict.fromkeys(str(m) for m in meters))
+        meter_index = {m: i for i, m in enumerate(meters)}
+
+        regions, feed_rows, feed_cols, shares = {}, [], [], []
+        child_rows, child_cols = [], []
+        for meter, spec in specs.items():
+            fed = spec.get("regions", {})
+            if not isinstance(fed, dict):
+                fed = {region: 1.0 for region in fed}
+            for region, share in fed.items():
+                feed_rows.append(meter_index[str(meter)])
+                feed_cols.append(regions.setdefault(str(region), len(regions)))
+                shares.append(float(share))
+            for child in spec.get("meters", []):
+                child_rows.append(meter_index[str(meter)])
+                child_cols.append(meter_index[str(child)])
+
+        parents = np.bincount(child_cols, minlength=len(meters)) if child_cols else None
+        if parents is not None and parents.max() > 1:
+            raise ValueError("A meter is nested below more than one parent meter")
+        feeds = sparse.coo_matrix((shares, (feed_rows, feed_cols)), shape=(len(meters), len(regions)))
+        children = sparse.coo_matrix(
+            (np.ones(len(child_rows)), (child_rows, child_cols)), shape=(len(meters), len(meters))
+        )
+        return cls(meters, list(regions), feeds, children)
+
+    @classmethod
+    def from_json(cls, path: str) -> "SupplyTopology":
+        with open(path) as f:
+            return cls.from_config(json.load(f))
+
+    def feeds_for(self, regions) -> sparse.csr_matrix:
+        """Direct feeds with columns in the order of `regions` (zero for regions not in the topology)"""
+        columns = np.array([self.region_index.get(str(r), -1) for r in regions], dtype=np.intp)
+        known = np.flatnonzero(columns >= 0)
+        select = sparse.csr_matrix(
+            (np.ones(len(known)), (columns[known], known)), shape=(len(self.regions), len(regions))
+        )
+        return (self.feeds @ select).tocsr()
+
+    def downstream_for(self, regions) -> sparse.csr_matrix:
+        """Share of each region's consumption that passes each meter (meters x regions)"""
+        return (self.subtree @ self.feeds_for(regions)).tocsr()
+
+    def rollup(self, values: np.ndarray) -> np.ndarray:
+        """Sum per-meter values (meters first) over every meter's subtree"""
+        return self.subtree @ values
+
+
+def load_topology(path: str = None):
+    """SupplyTopology from the configured file (reloaded when it changes), or None if there is none"""
+    path = path or os.environ.get(TOPOLOGY_ENV, DEFAULT_TOPOLOGY_PATH)
+    if not os.path.exists(path):
+        return None
+    key = ("topology", path, os.path.getmtime(path))
+    if key not in _supplies:
+        for stale in [k for k in _supplies if k[0] == "topology"]:
+            del _supplies[stale]
+        _supplies[key] = SupplyTopology.from_json(path)
+    return _supplies[key]
+
+
+def load_supply(topology_path: str = None, inflow_path: str = None):
+    """(SupplyTopology, inflow frame), reloaded when either file changes; None if either is missing"""
+    inflow_path = inflow_path or os.environ.get(INFLOW_ENV, DEFAULT_INFLOW_PATH)
+    topology = load_topology(topology_path)
+    if topology is None or not os.path.exists(inflow_path):
+        return None
+    key = ("inflow", inflow_path, os.path.getmtime(inflow_path))
+    if key not in _supplies:
+        for stale in [k for k in _supplies if k[0] == "inflow"]:
+            del _supplies[stale]
+        inflow = pd.read_csv(inflow_path, usecols=["meter", "date", "inflow"], dtype={"meter": str})
+        _supplies[key] = inflow.rename(columns={"meter": "region"})
+    return topology, _supplies[key]
+
+
+def balance_for(consumption: CalendarGrid):
+    """WaterBalance over the days of a consumption grid, or None without a configured supply"""
+    supply = load_supply()
+    if supply is None:
+        return None
+    topology, inflow = supply
+    return WaterBalance(topology, inflow, consumption)
+
+
+def severity(z: np.ndarray) -> np.ndarray:
+    """0 below SEVERITY_FLOOR_Z, rising linearly to 1 at IMBALANCE_Z (NaN stays NaN)"""
+    return np.clip((z - SEVERITY_FLOOR_Z) / (IMBALANCE_Z - SEVERITY_FLOOR_Z), 0.0, 1.0)
+
+
+class WaterBalance:
+    """Inflow, downstream consumption and imbalance of every meter over a consumption grid's days"""
+
+    def __init__(self, topology: SupplyTopology, inflow: pd.DataFrame, consumption: CalendarGrid):
+        self.topology = topology
+        self.meters = topology.meters
+        self.regions = consumption.regions
+        self.region_index = {r: i for i, r in enumerate(self.regions)}
+        self.dates = consumption.dates
+
+        downstream = topology.downstream_for(consumption.regions)
+        self.consumption = np.asarray(downstream @ consumption.usage)
+        # A meter that feeds none of the grid's regions has nothing to reconcile against
+        self.consumption[np.diff(downstream.indptr) == 0] = np.nan
+
+        meter_grid = CalendarGrid.allocate(self.meters, consumption.start, self.dates[-1]) \
+            if len(self.dates) else CalendarGrid(self.meters, None, np.empty((len(self.meters), 0)))
+        if len(self.dates):
+            meter_grid.scatter(inflow, "date", "inflow")
+        self.inflow = meter_grid.usage
+
+        self.imbalance = self.inflow - self.consumption
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.nrw_ratio = np.where(self.inflow > 0, self.imbalance / self.inflow, np.nan)
+        self.imbalance_z = self._robust_z(self.nrw_ratio)
+
+        # Regions x meters: each region's direct meters, shares normalized to 1
+        direct = topology.feeds_for(consumption.regions).T.tocsr()
+        totals = np.asarray(direct.sum(axis=1)).ravel()
+        with np.errstate(divide="ignore"):
+            scale = np.where(totals > 0, 1.0 / totals, 0.0)
+        self.region_meters = (sparse.diags(scale) @ direct).tocsr()
+
+    @staticmethod
+    def _robust_z(ratio: np.ndarray) -> np.ndarray:
+        deviation = np.empty_like(ratio)
+        for lo in range(0, len(ratio), BLOCK_METERS):
+            block = ratio[lo:lo + BLOCK_METERS]
+            deviation[lo:lo + BLOCK_METERS] = block - trailing_median(block, BASELINE_DAYS, BASELINE_MIN)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # meters without any readings
+            center = np.nanmedian(deviation, axis=1, keepdims=True)
+            spread = MAD_SCALE * np.nanmedian(np.abs(deviation - center), axis=1, keepdims=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(spread > 0, deviation / spread, np.nan)
+
+    def meter_frame(self, meter: str) -> pd.DataFrame:
+        i = self.topology.meter_index[meter]
+        return pd.DataFrame({
+            "date": self.dates,
+            "inflow": self.inflow[i],
+            "consumption": self.consumption[i],
+            "imbalance": self.imbalance[i],
+            "nrw_ratio": self.nrw_ratio[i],
+            "imbalance_z": self.imbalance_z[i],
+            "is_imbalance": self.imbalance_z[i] >= IMBALANCE_Z,
+        })
+
+    def region_signal(self, region: str):
+        """Daily imbalance z and risk severity of a region's supply, or None if no meter feeds it"""
+        row = self.region_index.get(region)
+        if row is None or self.region_meters.indptr[row] == self.region_meters.indptr[row + 1]:
+            return None
+        weights = self.region_meters[row]
+        z = np.asarray(weights @ self.imbalance_z).ravel()
+        return pd.DataFrame({
+            "date": self.dates,
+            "nrw_ratio": np.asarray(weights @ self.nrw_ratio).ravel(),
+            "imbalance_z": z,
+            "balance_severity": severity(z),
+        })
+
+    def summary(self) -> list:
+        """Latest reconciled day of every meter"""
+        reconciled = ~np.isnan(self.imbalance_z)
+        last = np.where(reconciled.any(axis=1), self.imbalance_z.shape[1] - 1 - np.argmax(
+            reconciled[:, ::-1], axis=1), -1)
+        rows = []
+        for i, meter in enumerate(self.meters):
+            if last[i] < 0:
+                rows.append({"meter": meter, "date": None})
+                continue
+            day = last[i]
+            rows.append({
+                "meter": meter,
+                "date": self.dates[day].strftime("%Y-%m-%d"),
+                "inflow": round(float(self.inflow[i, day]), 2),
+                "consumption": round(float(self.consumption[i, day]), 2),
+                "imbalance": round(float(self.imbalance[i, day]), 2),
+                "nrw_ratio": round(float(self.nrw_ratio[i, day]), 4),
+                "imbalance_z": round(float(self.imbalance_z[i, day]), 2),
+                "is_imbalance": bool(self.imbalance_z[i, day] >= IMBALANCE_Z),
+            })
+        return rows
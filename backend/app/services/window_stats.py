@@ -0,0 +1,308 @@
+"""Sliding-window statistics of live series, amortized O(1) per reading.
+
+A SlidingWindow holds the readings of the last `seconds` in a ring of
+preallocated NumPy arrays. Adding a reading first expires the readings
+that left the window and undoes their contribution, so no aggregate is
+ever recomputed by rescanning the window:
+
+- max / min: monotonic queues of ring positions whose fronts are the
+  current extremes (each reading is pushed and popped at most once);
+- mean / std: running sum and sum of squares, taken about a shift (a
+  recent value) so the variance does not cancel catastrophically;
+- quantiles: counts over fixed bins of [lo, hi], interpolated within a bin;
+- persistence: when the current run of readings at or above threshold began.
+
+The ring doubles when a window outgrows it, so its capacity settles at the
+number of readings one window spans. WindowAggregator keeps one window per
+region and summarizes all of them into an immutable WindowStats, with the
+quantiles computed for every region at once.
+"""
+import os
+
+import numpy as np
+
+STAT_FIELDS = ("points", "mean", "std", "min", "max", "p50", "p90", "above_fraction",
+               "persistence_seconds")
+
+
+class MonotonicQueue:
+    """Ring positions of window readings with non-increasing (or non-decreasing) values"""
+
+    __slots__ = ("positions", "start", "size", "largest")
+
+    def __init__(self, capacity: int, largest: bool):
+        self.positions = np.zeros(capacity, dtype=np.int32)
+        self.start = 0
+        self.size = 0
+        self.largest = largest
+
+    def push(self, values, position: int, value: float):
+        """Drop readings the new one dominates from the back, then append it"""
+        positions, capacity = self.positions, len(self.positions)
+        while self.size:
+            back = values[positions[(self.start + self.size - 1) % capacity]]
+            if (back > value) if self.largest else (back < value):
+                break
+            self.size -= 1
+        positions[(self.start + self.size) % capacity] = position
+        self.size += 1
+
+    def expire(self, oldest: int):
+        """Drop the front if it is the reading at ring position oldest"""
+        if self.size and self.positions[self.start] == oldest:
+            self.start = (self.start + 1) % len(self.positions)
+            self.size -= 1
+
+    def front(self):
+        return int(self.positions[self.start]) if self.size else None
+
+    def regrow(self, capacity: int, offset: int, old_capacity: int):
+        """Unroll into a larger ring whose window starts at 0 (was at offset)"""
+        order = (self.start + np.arange(self.size)) % old_capacity
+        positions = np.zeros(capacity, dtype=np.int32)
+        positions[:self.size] = (self.positions[order] - offset) % old_capacity
+        self.positions, self.start = positions, 0
+
+
+class SlidingWindow:
+    """Readings of one series over the last `seconds` (timestamps in epoch seconds)"""
+
+    __slots__ = ("seconds", "lo", "width", "threshold", "timestamps", "values", "histogram",
+                 "maxima", "minima", "start", "size", "shift", "total", "total_sq", "above",
+                 "run_start", "last_timestamp")
+
+    def __init__(self, seconds: float, lo: float = 0.0, hi: float = 100.0, bins: int = 100,
+                 threshold: float = 50.0, capacity: int = 64, histogram: np.ndarray = None):
+        self.seconds = seconds
+        self.lo = lo
+        self.width = (hi - lo) / bins
+        self.threshold = threshold
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros(capacity, dtype=np.float64)
+        # May be a row of a table shared by many windows (see WindowAggregator)
+        self.histogram = np.zeros(bins, dtype=np.int32) if histogram is None else histogram
+        self.maxima = MonotonicQueue(capacity, largest=True)
+        self.minima = MonotonicQueue(capacity, largest=False)
+        self.start = 0
+        self.size = 0
+        self.shift = 0.0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.above = 0
+        self.run_start = None
+        self.last_timestamp = None
+
+    def __len__(self):
+        return self.size
+
+    def _bin(self, value: float) -> int:
+        return min(max(int((value - self.lo) / self.width), 0), len(self.histogram) - 1)
+
+    def expire(self, now: float):
+        """Drop the readings at or before now - seconds"""
+        cutoff = now - self.seconds
+        capacity = len(self.values)
+        while self.size and self.timestamps[self.start] <= cutoff:
+            position = self.start
+            value = float(self.values[position])
+            deviation = value - self.shift
+            self.total -= deviation
+            self.total_sq -= deviation * deviation
+            self.histogram[self._bin(value)] -= 1
+            if value >= self.threshold:
+                self.above -= 1
+            self.maxima.expire(position)
+            self.minima.expire(position)
+            self.start = (position + 1) % capacity
+            self.size -= 1
+        if not self.size:
+            # Nothing left to cancel against; clear the rounding residue
+            self.total = self.total_sq = 0.0
+
+    def add(self, timestamp: float, value: float):
+        if value != value:  # NaN readings carry no information
+            return
+        self.expire(timestamp)
+        if not self.size:
+            self.shift = value
+        if self.size == len(self.values):
+            self._grow()
+        position = (self.start + self.size) % len(self.values)
+        self.timestamps[position] = timestamp
+        self.values[position] = value
+        self.size += 1
+        deviation = value - self.shift
+        self.total += deviation
+        self.total_sq += deviation * deviation
+        self.histogram[self._bin(value)] += 1
+        if value >= self.threshold:
+            self.above += 1
+            if self.run_start is None:
+                self.run_start = timestamp
+        else:
+            self.run_start = None
+        self.maxima.push(self.values, position, value)
+        self.minima.push(self.values, position, value)
+        self.last_timestamp = timestamp
+
+    def _grow(self):
+        old_capacity = len(self.values)
+        capacity = 2 * old_capacity
+        order = (self.start + np.arange(self.size)) % old_capacity
+        for name in ("timestamps", "values"):
+            grown = np.zeros(capacity, dtype=np.float64)
+            grown[:self.size] = getattr(self, name)[order]
+            setattr(self, name, grown)
+        self.maxima.regrow(capacity, self.start, old_capacity)
+        self.minima.regrow(capacity, self.start, old_capacity)
+        self.start = 0
+
+    @property
+    def mean(self) -> float:
+        return self.shift + self.total / self.size if self.size else float("nan")
+
+    @property
+    def std(self) -> float:
+        if not self.size:
+            return float("nan")
+        mean = self.total / self.size
+        return max(self.total_sq / self.size - mean * mean, 0.0) ** 0.5
+
+    @property
+    def maximum(self) -> float:
+        front = self.maxima.front()
+        return float(self.values[front]) if front is not None else float("nan")
+
+    @property
+    def minimum(self) -> float:
+        front = self.minima.front()
+        return float(self.values[front]) if front is not None else float("nan")
+
+    @property
+    def persistence(self) -> float:
+        """Seconds the series has stayed at or above threshold, up to its last reading"""
+        return self.last_timestamp - self.run_start if self.run_start is not None else 0.0
+
+    def quantile(self, q: float) -> float:
+        return float(histogram_quantiles(self.histogram[None, :], (q,), self.lo, self.width)[0, 0])
+
+    def memory_bytes(self) -> int:
+        return (self.timestamps.nbytes + self.values.nbytes + self.histogram.nbytes
+                + self.maxima.positions.nbytes + self.minima.positions.nbytes)
+
+
+def histogram_quantiles(histograms: np.ndarray, qs, lo: float, width: float) -> np.ndarray:
+    """Quantiles qs of each row of bin counts, linear within a bin; shape (len(qs), rows)
+
+    Rows without counts give NaN.
+    """
+    cumulative = np.cumsum(histograms, axis=1, dtype=np.int64)
+    counts = cumulative[:, -1]
+    rows = np.arange(len(histograms))
+    result = np.full((len(qs), len(histograms)), np.nan)
+    for k, q in enumerate(qs):
+        target = q * counts
+        index = np.minimum((cumulative < target[:, None]).sum(axis=1), histograms.shape[1] - 1)
+        inside = histograms[rows, index]
+        before = cumulative[rows, index] - inside
+        fraction = np.clip((target - before) / np.maximum(inside, 1), 0.0, 1.0)
+        result[k] = np.where(counts > 0, lo + width * (index + fraction), np.nan)
+    return result
+
+
+class WindowStats:
+    """Window statistics of every region at one moment; never mutated once built"""
+
+    __slots__ = ("index", "columns")
+
+    def __init__(self, regions, columns: dict):
+        self.index = {region: i for i, region in enumerate(regions)}
+        self.columns = {name: np.asarray(column).tolist() for name, column in columns.items()}
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, region: str):
+        """Statistics of one region as a dict (see STAT_FIELDS), or None"""
+        i = self.index.get(region)
+        if i is None:
+            return None
+        return {name: column[i] for name, column in self.columns.items()}
+
+
+class WindowAggregator:
+    """One SlidingWindow per region, allocated on the region's first reading
+
+    Defaults suit risk scores: bins of one point over [0, 100] and the
+    alert engine's enter threshold of 50 for persistence.
+    """
+
+    def __init__(self, seconds: float = None, lo: float = 0.0, hi: float = 100.0,
+                 bins: int = 100, threshold: float = 50.0):
+        if seconds is None:
+            seconds = float(os.environ.get("AQUAGUARD_LIVE_WINDOW_SECONDS", "3600"))
+        self.seconds = seconds
+        self.lo = lo
+        self.hi = hi
+        self.bins = bins
+        self.threshold = threshold
+        self.windows = {}
+        # Row i holds the bin counts of the i-th window, so quantiles need no gathering
+        self.histograms = np.zeros((64, bins), dtype=np.int32)
+
+    def add(self, region: str, timestamp: float, value: float):
+        window = self.windows.get(region)
+        if window is None:
+            window = self._allocate(region)
+        window.add(timestamp, value)
+
+    def _allocate(self, region: str) -> SlidingWindow:
+        row = len(self.windows)
+        if row == len(self.histograms):
+            grown = np.zeros((2 * row, self.bins), dtype=np.int32)
+            grown[:row] = self.histograms
+            self.histograms = grown
+            for i, window in enumerate(self.windows.values()):
+                window.histogram = grown[i]
+        window = self.windows[region] = SlidingWindow(
+            self.seconds, self.lo, self.hi, self.bins, self.threshold,
+            histogram=self.histograms[row],
+        )
+        return window
+
+    def get(self, region: str):
+        return self.windows.get(region)
+
+    def summarize(self, now: float = None) -> WindowStats:
+        """Statistics of every window, after expiring readings older than now - seconds"""
+        regions = list(self.windows)
+        windows = list(self.windows.values())
+        if now is not None:
+            # Windows that just took a reading at now are already expired
+            for window in windows:
+                if window.last_timestamp < now:
+                    window.expire(now)
+        scalars = np.array(
+            [(w.size, w.mean, w.std, w.minimum, w.maximum, w.above, w.persistence) for w in windows],
+            dtype=np.float64,
+        ).reshape(-1, 7)
+        points, mean, std, minimum, maximum, above, persistence = scalars.T
+        width = (self.hi - self.lo) / self.bins
+        p50, p90 = histogram_quantiles(self.histograms[:len(windows)], (0.5, 0.9), self.lo, width)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return WindowStats(regions, {
+                "points": points.astype(np.int64),
+                "mean": mean,
+                "std": std,
+                "min": minimum,
+                "max": maximum,
+                "p50": p50,
+                "p90": p90,
+                "above_fraction": above / points,
+                "persistence_seconds": persistence,
+            })
+
+    def memory_bytes(self) -> int:
+        return self.histograms.nbytes + sum(
+            w.memory_bytes() - w.histogram.nbytes for w in list(self.windows.values())
+        )
@@ -1,30 +1,36 @@
+"""Per-region consumption charts. Run from backend/ as a module: python -m app.src.load_and_plot"""
 import pandas as pd
-import matplotlib.pyplot as plt
-import os
-
-# Load dataset
-df = pd.read_csv("data/water_consumption_forecasting.csv")
-
-# Parse date
-df['date'] = pd.to_datetime(df['date'])
-
-# Sort
-df = df.sort_values(['region', 'date'])
-
-# Quick sanity check
-print(df.head())
-print(df.info())
-
-# Plot consumption per region
-os.makedirs("outputs", exist_ok=True)
-
-for region in df['region'].unique():
-    temp = df[df['region'] == region]
-    plt.figure(figsize=(10, 4))
-    plt.plot(temp['date'], temp['consumption_liters'])
-    plt.title(f"Water Consumption – Region {region}")
-    plt.xlabel("Date")
-    plt.ylabel("Consumption (liters)")
-    plt.tight_layout()
-    plt.savefig(f"outputs/consumption_{region}.png")
-    plt.close()
+
+from app.services.rendering import PlotRenderer, consumption_job
+
+
+def main():
+    # Load dataset
+    df = pd.read_csv("data/water_consumption_forecasting.csv")
+
+    # Parse date
+    df['date'] = pd.to_datetime(df['date'])
+
+    # Sort
+    df = df.sort_values(['region', 'date'])
+
+    # Quick sanity check
+    print(df.head())
+    print(df.info())
+
+    # Plot consumption per region, in parallel; unchanged regions are not re-rendered
+    renderer = PlotRenderer("outputs/plots")
+    jobs = (
+        consumption_job(region, temp['date'], temp['consumption_liters'])
+        for region, temp in df.groupby('region', sort=False)
+    )
+    try:
+        for region, path in renderer.render_many(jobs).items():
+            print(f"{region}: {path}")
+    finally:
+        renderer.shutdown()
+
+
+# The guard matters: render workers are spawned and re-import this module
+if __name__ == "__main__":
+    main()
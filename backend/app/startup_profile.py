@@ -0,0 +1,125 @@
+"""Startup timing: per-module import cost and per-stage initialization cost.
+
+Set AQUAGUARD_STARTUP_PROFILE=1 to record the import time of every module
+the app pulls in (the report is printed once startup finishes and is also
+served by /ready). Initialization stages are always timed since that only
+costs a couple of clock reads; recording stops once startup finishes, so
+later hot reloads do not pile up in the report. For a one-off report without a server:
+
+    python -m app.startup_profile
+"""
+import builtins
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+STARTUP_PROFILE_ENV = "AQUAGUARD_STARTUP_PROFILE"
+HEAVY_MODULES = ["prophet", "matplotlib.pyplot", "sklearn.ensemble", "pandas", "numpy"]
+
+stage_timings = []
+import_timings = {}
+_recording_stages = True
+_original_import = None
+_import_depth = 0
+
+
+def is_enabled() -> bool:
+    return os.environ.get(STARTUP_PROFILE_ENV) == "1"
+
+
+@contextmanager
+def stage(name: str):
+    """Time one initialization stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _recording_stages:
+            stage_timings.append((name, time.perf_counter() - started))
+
+
+def end_startup():
+    """Stop recording stages; anything loaded after this is not startup cost"""
+    global _recording_stages
+    _recording_stages = False
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    global _import_depth
+    if level != 0 or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+
+    started = time.perf_counter()
+    _import_depth += 1
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _import_depth -= 1
+        # Cumulative time, including the module's own imports
+        import_timings.setdefault(name, (time.perf_counter() - started, _import_depth))
+
+
+def install_import_timer():
+    """Start recording first-import times; a no-op unless profiling is enabled"""
+    global _original_import
+    if not is_enabled() or _original_import is not None:
+        return
+    _original_import = builtins.__import__
+    builtins.__import__ = _timed_import
+
+
+def uninstall_import_timer():
+    global _original_import
+    if _original_import is not None:
+        builtins.__import__ = _original_import
+        _original_import = None
+
+
+def get_report(top: int = 25) -> dict:
+    imports = sorted(import_timings.items(), key=lambda item: item[1][0], reverse=True)
+    return {
+        "imports": [
+            {"module": name, "seconds": round(seconds, 4), "depth": depth}
+            for name, (seconds, depth) in imports[:top]
+        ],
+        "stages": [
+            {"stage": name, "seconds": round(seconds, 4)} for name, seconds in stage_timings
+        ],
+        "heavy_modules_loaded": [m for m in HEAVY_MODULES if m in sys.modules],
+    }
+
+
+def print_report(top: int = 25):
+    report = get_report(top)
+    if report["imports"]:
+        print("Import time (cumulative, first import only):")
+        for row in report["imports"]:
+            indent = "  " * row["depth"]
+            print(f"  {row['seconds']:8.3f}s  {indent}{row['module']}")
+    print("Initialization stages:")
+    for row in report["stages"]:
+        print(f"  {row['seconds']:8.3f}s  {row['stage']}")
+    print(f"Heavy modules loaded now: {', '.join(report['heavy_modules_loaded']) or 'none'}")
+
+
+def main():
+    # Run through the package module so the timings recorded by the service
+    # (which imports app.startup_profile) land in the same lists.
+    from app import startup_profile as profile
+
+    os.environ[STARTUP_PROFILE_ENV] = "1"
+    profile.install_import_timer()
+    with profile.stage("import app.main"):
+        import app.main  # noqa: F401
+    profile.uninstall_import_timer()
+    loaded = [m for m in HEAVY_MODULES if m in sys.modules]
+    print(f"Heavy modules loaded by import: {', '.join(loaded) or 'none'}")
+
+    from app.services.aquaguard_service import aquaguard_service
+    aquaguard_service.startup(start_background_jobs=False)
+    profile.print_report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Memory and throughput of multi-worker serving, with and without shared state.
+
+Starts the backend at each worker count, waits until every worker answers,
+then reports the summed RSS/PSS of the process tree and the request rate of
+a fixed client load. Linux only (reads /proc). Run from backend/:
+
+    python benchmarks/bench_workers.py --workers 1 4 16 --output worker_bench.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+ENDPOINTS = ["/ranking", "/timeseries/North", "/risk/East", "/regions"]
+
+
+def _children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def process_tree(pid):
+    pids = [pid]
+    for child in _children(pid):
+        pids.extend(process_tree(child))
+    return pids
+
+
+def memory_kb(pid):
+    """Return (rss_kb, pss_kb) for one process; PSS splits shared pages fairly"""
+    rss = pss = 0
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Rss:"):
+                    rss = int(line.split()[1])
+                elif line.startswith("Pss:"):
+                    pss = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, pss
+
+
+def wait_until_ready(base_url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(base_url + "/ranking", timeout=5) as r:
+                if r.status == 200:
+                    return True
+        except OSError:
+            time.sleep(0.5)
+    return False
+
+
+def run_load(base_url, clients, duration):
+    counts = [0] * clients
+    errors = [0] * clients
+    stop = time.time() + duration
+
+    def client(i):
+        n = 0
+        while time.time() < stop:
+            path = ENDPOINTS[n % len(ENDPOINTS)]
+            n += 1
+            try:
+                with urllib.request.urlopen(base_url + path, timeout=30) as r:
+                    r.read()
+                counts[i] += 1
+            except OSError:
+                errors[i] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sum(counts), sum(errors)
+
+
+def bench(mode, workers, port, clients, duration, startup_timeout):
+    if mode == "shared":
+        cmd = [sys.executable, "-m", "app.serve", "--workers", str(workers), "--port", str(port)]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", "app.main:app",
+               "--workers", str(workers), "--port", str(port)]
+
+    started = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        if not wait_until_ready(base_url, startup_timeout):
+            return {"mode": mode, "workers": workers, "error": "server did not become ready"}
+        # Let every worker finish its own startup before sampling memory
+        run_load(base_url, workers * 2, 2)
+        ready_seconds = time.perf_counter() - started
+
+        rss = pss = 0
+        for pid in process_tree(proc.pid):
+            r, p = memory_kb(pid)
+            rss += r
+            pss += p
+
+        requests, errors = run_load(base_url, clients, duration)
+        return {
+            "mode": mode,
+            "workers": workers,
+            "startup_seconds": round(ready_seconds, 2),
+            "rss_mb": round(rss / 1024, 1),
+            "pss_mb": round(pss / 1024, 1),
+            "requests": requests,
+            "errors": errors,
+            "requests_per_second": round(requests / duration, 1),
+        }
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--modes", nargs="+", choices=["shared", "plain"], default=["plain", "shared"])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        sys.exit("This benchmark reads /proc and only runs on Linux")
+
+    results = []
+    for workers in args.workers:
+        for mode in args.modes:
+            result = bench(mode, workers, args.port, args.clients, args.duration, args.startup_timeout)
+            print(json.dumps(result))
+            results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"benchmark": "workers", "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Per-region (Prophet per region) vs global model: accuracy and cost.
+
+Both modes are trained on the first part of a synthetic history and scored
+on the held-out tail. Prophet fits dominate per-region cost, so that mode is
+trained on --prophet-regions regions only and its full training time is
+extrapolated linearly; the global model is always trained on every region.
+Accuracy is compared on the regions both modes trained. Run from backend/:
+
+    python -m benchmarks.compare_models --regions 200 --days 730 --output models.json
+"""
+import argparse
+import json
+import logging
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.run import measure, metadata, summarize
+from benchmarks.synthetic import generate_dataset
+
+
+def holdout_errors(model, test, regions):
+    """MAE and MAPE of each region's point forecast over its held-out days"""
+    errors = {}
+    for region in regions:
+        region_test = test[test["region"] == region]
+        forecast = model.models[region].predict(pd.DataFrame({
+            "ds": region_test["date"].to_numpy(),
+            "is_weekend": region_test["is_weekend"].to_numpy(),
+        }))
+        actual = region_test["daily_usage"].to_numpy(dtype=np.float64)
+        error = np.abs(actual - forecast["yhat"].to_numpy())
+        errors[region] = (float(error.mean()), float((error / actual).mean() * 100))
+    return errors
+
+
+def bench_mode(name, model, train, test, trained_regions, compared_regions, repeat):
+    started = time.perf_counter()
+    model.train_all_regions(train)
+    train_seconds = time.perf_counter() - started
+
+    errors = holdout_errors(model, test, compared_regions)
+    score_samples = [
+        measure(lambda r=r: model.predict_and_detect_anomalies(train, r), 1, 0)[0]
+        for r in compared_regions[:repeat]
+    ]
+    store_bytes = len(pickle.dumps(model.store_data()))
+    return {
+        "mode": name,
+        "trained_regions": len(trained_regions),
+        "train_seconds": train_seconds,
+        "train_seconds_per_region": train_seconds / len(trained_regions),
+        "store_bytes": store_bytes,
+        "store_bytes_per_region": store_bytes / len(trained_regions),
+        "holdout_mae": float(np.mean([e[0] for e in errors.values()])),
+        "holdout_mape": float(np.mean([e[1] for e in errors.values()])),
+        "scoring": summarize("predict_and_detect_anomalies", score_samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-region and global AquaGuard models")
+    parser.add_argument("--regions", type=int, default=50)
+    parser.add_argument("--days", type=int, default=730)
+    parser.add_argument("--prophet-regions", type=int, default=5)
+    parser.add_argument("--test-size", type=float, default=0.2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="Write results JSON here")
+    args = parser.parse_args()
+
+    logging.getLogger("cmdstanpy").setLevel(logging.WARNING)
+    logging.getLogger("prophet").setLevel(logging.WARNING)
+
+    from app.services.global_model import GlobalAquaGuardModel
+    from app.services.improved_model import ImprovedAquaGuardModel
+
+    df = ImprovedAquaGuardModel().preprocess(
+        generate_dataset(args.regions, args.days, seed=args.seed)
+    )
+    cutoff = df["date"].min() + pd.Timedelta(days=int(args.days * (1 - args.test_size)))
+    train, test = df[df["date"] < cutoff], df[df["date"] >= cutoff]
+    regions = sorted(df["region"].unique().tolist())
+    prophet_regions = regions[:args.prophet_regions]
+
+    results = [
+        bench_mode("per_region", ImprovedAquaGuardModel(),
+                   train[train["region"].isin(prophet_regions)], test,
+                   prophet_regions, prophet_regions, args.repeat),
+        bench_mode("global", GlobalAquaGuardModel(), train, test,
+                   regions, prophet_regions, args.repeat),
+    ]
+    for result in results:
+        result["estimated_train_seconds_all_regions"] = (
+            result["train_seconds_per_region"] * len(regions)
+        )
+
+    print(f"\n{args.regions} regions x {args.days} days, accuracy on {len(prophet_regions)} shared regions")
+    print(f"{'mode':12} {'MAE':>10} {'MAPE %':>8} {'train s/region':>15} "
+          f"{'est. train all (s)':>19} {'store B/region':>15} {'score median s':>15}")
+    for r in results:
+        print(f"{r['mode']:12} {r['holdout_mae']:10.1f} {r['holdout_mape']:8.2f} "
+              f"{r['train_seconds_per_region']:15.4f} {r['estimated_train_seconds_all_regions']:19.1f} "
+              f"{r['store_bytes_per_region']:15.0f} {r['scoring']['median']:15.4f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": metadata(), "scale": {"regions": args.regions, "days": args.days},
+                       "results": results}, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
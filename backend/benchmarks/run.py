@@ -0,0 +1,259 @@
+"""Reproducible benchmark suite for the AquaGuard backend.
+
+Runs every benchmark at one or more synthetic scales (regions x days) and
+writes the timings as JSON. With --compare, timings are checked against a
+saved baseline and the run fails if any median got slower than the
+tolerance allows. Run from backend/:
+
+    python -m benchmarks.run --scales 5x180 50x365 --output bench.json
+    python -m benchmarks.run --scales 5x180 50x365 --compare bench.json
+
+Prophet fits dominate training cost, so only --train-regions regions are
+actually trained at each scale. The remaining regions reuse the fitted
+components of a trained region built from the same template, which keeps
+the serving benchmarks honest at 50k regions without hours of Stan fits.
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import write_dataset
+
+PRESETS = {
+    "small": (5, 180),
+    "medium": (500, 365),
+    "large": (5000, 1825),
+    "xlarge": (50000, 1825),
+}
+
+
+def parse_scale(token: str):
+    if token in PRESETS:
+        return PRESETS[token]
+    regions, days = token.lower().split("x")
+    return int(regions), int(days)
+
+
+def summarize(name, samples, **extra):
+    ordered = sorted(samples)
+    p95_index = min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))
+    return {
+        "name": name,
+        **extra,
+        "unit": "seconds",
+        "repeat": len(samples),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "mean": statistics.fmean(ordered),
+        "p95": ordered[p95_index],
+    }
+
+
+def measure(fn, repeat: int = 5, warmup: int = 1, quiet: bool = True):
+    """Return per-call wall-clock times of fn, after warmup calls"""
+    sink = io.StringIO()
+    samples = []
+    for i in range(warmup + repeat):
+        with contextlib.redirect_stdout(sink) if quiet else contextlib.nullcontext():
+            started = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - started
+        if i >= warmup:
+            samples.append(elapsed)
+    return samples
+
+
+def share_trained_components(model, regions, trained):
+    """Point untrained regions at the components of a trained region of the same template"""
+    by_template = {}
+    for region in trained:
+        by_template.setdefault(region.rsplit("_", 1)[0], region)
+    fallback = trained[0]
+    for region in regions:
+        if region in model.models:
+            continue
+        source = by_template.get(region.rsplit("_", 1)[0], fallback)
+        model.models[region] = model.models[source]
+        model.anomaly_detectors[region] = model.anomaly_detectors[source]
+        model.scalers[region] = model.scalers[source]
+        model.thresholds[region] = model.thresholds[source]
+
+
+def bench_scale(n_regions, n_days, args):
+    from app.main import app
+    from app.services.aquaguard_service import ServiceState, aquaguard_service
+    from app.services.data_simulator import WaterDataSimulator, simulator
+    from app.services.improved_model import ImprovedAquaGuardModel
+    from fastapi.testclient import TestClient
+
+    scale = {"regions": n_regions, "days": n_days}
+    results = []
+    workdir = tempfile.mkdtemp(prefix="aquaguard-bench-")
+    csv_path = write_dataset(os.path.join(workdir, "history.csv"), n_regions, n_days, seed=args.seed)
+
+    model = ImprovedAquaGuardModel()
+    samples = measure(lambda: model.load_and_preprocess_data(csv_path), args.repeat)
+    results.append(summarize("load_and_preprocess_data", samples, **scale))
+    df = model.load_and_preprocess_data(csv_path)
+    regions = sorted(df["region"].unique().tolist())
+    deployment_date = df["date"].min() + (df["date"].max() - df["date"].min()) * 0.7
+
+    trained = regions[:args.train_regions]
+    train_df = df[df["region"].isin(trained)]
+    samples = measure(lambda: model.train_all_regions(train_df), repeat=1, warmup=0)
+    results.append(summarize("train_all_regions", samples, trained_regions=len(trained), **scale))
+    share_trained_components(model, regions, trained)
+
+    rng = np.random.default_rng(args.seed)
+    sample_regions = list(rng.choice(regions, size=min(len(regions), args.repeat), replace=False))
+    samples = [
+        measure(lambda r=r: model.predict_and_detect_anomalies(df, r, deployment_date), 1, 0)[0]
+        for r in sample_regions
+    ]
+    results.append(summarize("predict_and_detect_anomalies", samples, **scale))
+
+    aquaguard_service.deployment_date = deployment_date
+
+    def ranking_cold():
+        aquaguard_service.install_state(ServiceState(model, df, "bench"))
+        aquaguard_service.get_regional_ranking()
+
+    cold_repeat = 1 if n_regions > 500 else args.repeat
+    samples = measure(ranking_cold, cold_repeat, warmup=0)
+    results.append(summarize("get_regional_ranking_cold", samples, **scale))
+    samples = measure(aquaguard_service.get_regional_ranking, args.repeat)
+    results.append(summarize("get_regional_ranking_warm", samples, **scale))
+    samples = [
+        measure(lambda r=r: aquaguard_service.get_timeseries_data(r), 1, 0)[0]
+        for r in sample_regions
+    ]
+    results.append(summarize("get_timeseries_data", samples, **scale))
+
+    scaled_simulator = WaterDataSimulator()
+    scaled_simulator.regions = regions
+    scaled_simulator.base_consumption = df.groupby("region")["daily_usage"].mean().to_dict()
+    samples = measure(scaled_simulator.tick, args.repeat)
+    results.append(summarize("simulator_tick", samples, **scale))
+
+    # End-to-end through the ASGI stack (routing, validation, JSON encoding)
+    aquaguard_service.ready = True
+    original_regions, original_base = simulator.regions, simulator.base_consumption
+    simulator.regions, simulator.base_consumption = regions, scaled_simulator.base_consumption
+    simulator.tick()
+    try:
+        client = TestClient(app)
+        for name, path in [
+            ("http_ranking", "/ranking"),
+            ("http_timeseries", f"/timeseries/{sample_regions[0]}"),
+            ("http_risk", f"/risk/{sample_regions[0]}"),
+            ("http_live_current", "/live/current"),
+        ]:
+            samples = measure(lambda p=path: client.get(p).raise_for_status(), args.http_repeat)
+            results.append(summarize(name, samples, **scale))
+    finally:
+        simulator.regions, simulator.base_consumption = original_regions, original_base
+        simulator.tick()
+        aquaguard_service.ready = False
+
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "git_commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+    }
+
+
+def compare(current, baseline, tolerance, min_delta=0.001):
+    """Print per-benchmark median ratios; return the list of regressions
+
+    Slowdowns smaller than min_delta seconds are treated as timer noise.
+    """
+    baseline_index = {
+        (r["name"], r["regions"], r["days"]): r for r in baseline["results"]
+    }
+    regressions = []
+    print(f"{'benchmark':34} {'scale':>12} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for result in current["results"]:
+        key = (result["name"], result["regions"], result["days"])
+        base = baseline_index.get(key)
+        if base is None:
+            continue
+        ratio = result["median"] / base["median"] if base["median"] > 0 else float("inf")
+        flag = ""
+        if ratio > 1.0 + tolerance and result["median"] - base["median"] > min_delta:
+            flag = "  REGRESSION"
+            regressions.append({**result, "baseline_median": base["median"], "ratio": ratio})
+        scale = f"{result['regions']}x{result['days']}"
+        print(f"{result['name']:34} {scale:>12} {base['median']:10.4f} "
+              f"{result['median']:10.4f} {ratio:7.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AquaGuard backend benchmarks")
+    parser.add_argument("--scales", nargs="+", default=["small"],
+                        help="RxD tokens (e.g. 50x365) or presets: " + ", ".join(PRESETS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--http-repeat", type=int, default=20)
+    parser.add_argument("--train-regions", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="Write results JSON here")
+    parser.add_argument("--compare", default=None, help="Baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown of the median before failing (0.2 = 20%%)")
+    parser.add_argument("--min-delta", type=float, default=0.001,
+                        help="Ignore slowdowns smaller than this many seconds")
+    args = parser.parse_args()
+
+    logging.getLogger("cmdstanpy").setLevel(logging.WARNING)
+    logging.getLogger("prophet").setLevel(logging.WARNING)
+
+    report = {"meta": metadata(), "results": []}
+    for token in args.scales:
+        n_regions, n_days = parse_scale(token)
+        print(f"Benchmarking {n_regions} regions x {n_days} days")
+        for result in bench_scale(n_regions, n_days, args):
+            print(f"  {result['name']:34} median {result['median']:.4f}s  p95 {result['p95']:.4f}s")
+            report["results"].append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.min_delta)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed beyond {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Synthetic consumption histories scaled up from the bundled dataset.
+
+Each synthetic region copies the weekly profile and noise level of one of
+the real regions (round robin) with its own random level, a yearly cycle
+and a small trend, so the data keeps the shape the model was built for
+while the region count and history length can grow far beyond it.
+"""
+import numpy as np
+import pandas as pd
+
+SOURCE_PATH = "data/water_consumption_cleaned.csv"
+
+
+def source_profiles(path: str = SOURCE_PATH) -> list:
+    """Per-region level, noise and day-of-week profile of the real data"""
+    df = pd.read_csv(path, parse_dates=["date"])
+    profiles = []
+    for region, group in df.groupby("region"):
+        usage = group["daily_usage"]
+        weekly = usage.groupby(group["date"].dt.dayofweek).mean() / usage.mean()
+        profiles.append({
+            "region": region,
+            "mean": float(usage.mean()),
+            "noise": float(usage.std() / usage.mean()),
+            "weekly": weekly.reindex(range(7), fill_value=1.0).to_numpy(),
+        })
+    return profiles
+
+
+def daily_usage(n_regions: int, n_days: int, start: str = "2023-01-01", seed: int = 42,
+                path: str = SOURCE_PATH):
+    """Region names, dates, and (regions, days) matrices of usage and its shock-free expectation"""
+    rng = np.random.default_rng(seed)
+    profiles = source_profiles(path)
+    dates = pd.date_range(start, periods=n_days, freq="D")
+    day_of_week = dates.dayofweek.to_numpy()
+    day_of_year = dates.dayofyear.to_numpy()
+
+    template = np.arange(n_regions) % len(profiles)
+    means = np.array([p["mean"] for p in profiles])[template]
+    noise = np.array([p["noise"] for p in profiles])[template]
+    weekly = np.stack([p["weekly"] for p in profiles])[template][:, day_of_week]
+
+    level = means * rng.lognormal(0.0, 0.15, n_regions)
+    phase = rng.uniform(0, 2 * np.pi, n_regions)
+    yearly = 1.0 + 0.1 * np.sin(2 * np.pi * day_of_year[None, :] / 365.25 + phase[:, None])
+    trend = 1.0 + rng.normal(0.0, 0.05, n_regions)[:, None] * np.linspace(0, 1, n_days)[None, :]
+    shocks = rng.normal(0.0, 1.0, (n_regions, n_days)) * noise[:, None] * 0.5
+
+    expected = level[:, None] * weekly * yearly * trend
+    usage = np.clip(expected * (1.0 + shocks), 0.1 * level[:, None], None).astype(np.float64)
+
+    width = len(str(n_regions))
+    names = np.array([f"{profiles[t]['region']}_{i:0{width}d}" for i, t in enumerate(template)])
+    return names, dates, usage, expected
+
+
+def generate_dataset(n_regions: int, n_days: int, start: str = "2023-01-01",
+                     seed: int = 42, path: str = SOURCE_PATH) -> pd.DataFrame:
+    """Return a long frame (region, date, daily_usage) like the bundled CSV"""
+    names, dates, usage, _ = daily_usage(n_regions, n_days, start, seed, path)
+    return pd.DataFrame({
+        "region": np.repeat(names, n_days),
+        "date": np.tile(dates.strftime("%Y-%m-%d").to_numpy(), n_regions),
+        "daily_usage": np.round(usage.ravel(), 2),
+    })
+
+
+def iter_hourly_dataset(n_regions: int, n_days: int, start: str = "2023-01-01", seed: int = 42,
+                        leak_fraction: float = 0.05, block_regions: int = 100,
+                        path: str = SOURCE_PATH):
+    """Yield long frames (region, timestamp, usage) of block_regions regions at a time
+
+    Each day is spread over its hours with the live simulator's
+    time-of-day curve; the day's deviation from its expected usage falls
+    on the demand above the night-time minimum, so night flow stays close
+    to its baseline as it does in real networks. In leak_fraction of the
+    regions a constant extra flow (15-30% of the mean hourly usage)
+    starts on a random day in the last quarter of the history. The last
+    item yielded is the dict {region: first leak date}.
+    """
+    from app.services.data_simulator import hour_factor
+
+    rng = np.random.default_rng(seed + 1)
+    names, dates, usage, expected = daily_usage(n_regions, n_days, start, seed, path)
+    factor = hour_factor(np.arange(24))
+    profile = factor / factor.sum()
+    demand = (factor - factor.min()) / (factor - factor.min()).sum()
+
+    leaking = rng.choice(n_regions, int(round(leak_fraction * n_regions)), replace=False)
+    leak_starts = {int(i): int(rng.integers(int(n_days * 0.75), n_days)) for i in leaking}
+    leak_flows = {i: rng.uniform(0.15, 0.3) * usage[i].mean() / 24 for i in leak_starts}
+    timestamps = np.tile(
+        pd.date_range(start, periods=n_days * 24, freq="h").strftime("%Y-%m-%dT%H:00").to_numpy(),
+        min(block_regions, n_regions),
+    )
+
+    for lo in range(0, n_regions, block_regions):
+        hi = min(lo + block_regions, n_regions)
+        hourly = expected[lo:hi, :, None] * profile + (usage[lo:hi] - expected[lo:hi])[:, :, None] * demand
+        hourly *= 1.0 + rng.normal(0.0, 0.03, hourly.shape)
+        for i in range(lo, hi):
+            if i in leak_starts:
+                hourly[i - lo, leak_starts[i]:, :] += leak_flows[i]
+        yield pd.DataFrame({
+            "region": np.repeat(names[lo:hi], n_days * 24),
+            "timestamp": timestamps[:(hi - lo) * n_days * 24],
+            "usage": np.round(hourly.ravel(), 2),
+        })
+    yield {str(names[i]): dates[first].strftime("%Y-%m-%d") for i, first in leak_starts.items()}
+
+
+def write_dataset(out_path: str, n_regions: int, n_days: int, seed: int = 42) -> str:
+    generate_dataset(n_regions, n_days, seed=seed).to_csv(out_path, index=False)
+    return out_path
+
+
+def write_hourly_dataset(out_path: str, n_regions: int, n_days: int, seed: int = 42,
+                         leak_fraction: float = 0.05) -> dict:
+    """Write an hourly dataset block by block; returns the injected leaks"""
+    header = True
+    for item in iter_hourly_dataset(n_regions, n_days, seed=seed, leak_fraction=leak_fraction):
+        if isinstance(item, dict):
+            return item
+        item.to_csv(out_path, mode="w" if header else "a", header=header, index=False)
+        header = False